@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+""" Benchmark the job branch updater and pruner on synthetic repositories
+
+For every requested size a local bare repository standing in for origin is
+created with that many jobs under `jobs/` and a number of stale branches,
+cloned, and the pruner and updater are run against it in the same sequence
+as the update-branches job, followed by incremental runs.  One JSON record
+is written per stage with its wall time, the number of git processes (as
+reported by trace2, including those run on the "remote" side), connections
+to the remote, pushes and objects written to the clone.
+
+    python -m aos_cd_jobs.benchmark --sizes 50 500 --stale 100 --no-checkout
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager, redirect_stdout
+import json
+from os import environ, makedirs
+from os.path import dirname, join
+from shutil import rmtree
+from subprocess import check_output
+import sys
+from tempfile import mkdtemp
+from time import time
+
+from git import Repo
+from git.remote import Remote
+
+from aos_cd_jobs import job_index
+from aos_cd_jobs.common import JOBS_DIRECTORY, refresh_repo
+from aos_cd_jobs.pruner import prune_remote_refs
+from aos_cd_jobs.updater import update_branches
+
+CATEGORIES = ('build', 'maintenance', 'scanning', 'signing')
+IDENTITY = ('-c', 'user.name=benchmark', '-c', 'user.email=benchmark@example.com')
+
+
+def git(*args, **kwargs):
+    return check_output(('git',) + IDENTITY + args, **kwargs).decode()
+
+
+def job_name(i):
+    return '{}/job-{}'.format(CATEGORIES[i % len(CATEGORIES)], i)
+
+
+def create_remote(directory, jobs, stale):
+    """ Create a bare repository with `jobs` jobs on master and `stale`
+    branches for jobs which do not exist anymore
+
+    :return: the path to the bare repository and to the clone used to
+    push changes to it
+    """
+    remote = join(directory, 'remote.git')
+    seed = join(directory, 'seed')
+    git('init', '-q', '--bare', remote)
+    git('clone', '-q', remote, seed)
+    git('-C', seed, 'checkout', '-q', '-b', 'master')
+
+    write_file(join(seed, 'Jenkinsfile'), '// update-branches\n')
+    write_file(join(seed, 'README.md'), '# aos-cd-jobs\n')
+    write_file(join(seed, 'pipeline-scripts', 'buildlib.groovy'), 'return this\n')
+    for i in range(jobs):
+        job_directory = join(seed, JOBS_DIRECTORY, job_name(i))
+        write_file(join(job_directory, 'Jenkinsfile'), 'node {{ echo "{}" }}\n'.format(i))
+        write_file(join(job_directory, 'README.md'), '# job {}\n'.format(i))
+    git('-C', seed, 'add', '--all')
+    git('-C', seed, 'commit', '-q', '-m', 'Add {} jobs'.format(jobs))
+    git('-C', seed, 'push', '-q', 'origin', 'master')
+
+    master = git('-C', remote, 'rev-parse', 'master').strip()
+    refs = ''.join(
+        'create refs/heads/stale/job-{} {}\n'.format(i, master)
+        for i in range(stale))
+    git('-C', remote, 'update-ref', '--stdin', input=refs.encode())
+    return remote, seed
+
+
+def change_job(seed, job):
+    """ Push a change to a single job to master """
+    path = join(seed, JOBS_DIRECTORY, job, 'README.md')
+    with open(path, 'a') as f:
+        f.write('changed\n')
+    git('-C', seed, 'commit', '-q', '-a', '-m', 'Change {}'.format(job))
+    git('-C', seed, 'push', '-q', 'origin', 'master')
+
+
+def write_file(path, content):
+    makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def count_objects(repo):
+    counts = dict(
+        line.split(': ') for line in repo.git.count_objects('-v').splitlines())
+    return int(counts['count']) + int(counts['in-pack'])
+
+
+def count_processes(trace):
+    """ Count the git processes started according to a trace2 event log, and
+    how many of them served a connection to the remote """
+    processes = connections = 0
+    with open(trace) as f:
+        for line in f:
+            event = json.loads(line)
+            if event.get('event') != 'start':
+                continue
+            processes += 1
+            command = ' '.join(event['argv'][:2])
+            if 'receive-pack' in command or 'upload-pack' in command:
+                connections += 1
+    return processes, connections
+
+
+@contextmanager
+def measure(repo, directory, record):
+    """ Fill `record` with the cost of the enclosed block """
+    trace = join(directory, 'trace2-{}.json'.format(record['stage']))
+    open(trace, 'w').close()
+    pushes = []
+    push = Remote.push
+
+    def counting_push(self, refspec=None, **kwargs):
+        pushes.append(refspec)
+        return push(self, refspec, **kwargs)
+
+    # the index is cached per process, every stage stands for a new run
+    job_index._memory.clear()
+    objects = count_objects(repo)
+    environ['GIT_TRACE2_EVENT'] = trace
+    Remote.push = counting_push
+    start = time()
+    try:
+        # keep the output of the scripts out of the records
+        with redirect_stdout(sys.stderr):
+            yield
+    finally:
+        record['wall_time'] = round(time() - start, 3)
+        Remote.push = push
+        del environ['GIT_TRACE2_EVENT']
+    record['git_processes'], record['connections'] = count_processes(trace)
+    record['pushes'] = len(pushes)
+    record['objects_written'] = count_objects(repo) - objects
+
+
+def run(size, stale, checkout=True, workers=1, output=sys.stdout):
+    directory = mkdtemp(prefix='aos-cd-jobs-benchmark-')
+    try:
+        remote, seed = create_remote(directory, size, stale)
+        workspace = join(directory, 'workspace')
+        git('clone', '-q', remote, workspace)
+        repo = Repo(workspace)
+        with repo.config_writer() as config:
+            config.set_value('user', 'name', 'benchmark')
+            config.set_value('user', 'email', 'benchmark@example.com')
+
+        def stage(name, function, *args, **kwargs):
+            record = {
+                'stage': name, 'jobs': size, 'stale': stale,
+                'checkout': checkout, 'workers': workers,
+            }
+            with measure(repo, directory, record):
+                function(*args, **kwargs)
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+            output.flush()
+            return record
+
+        options = {'checkout': checkout, 'workers': workers}
+        stage('prune', prune_remote_refs, repo)
+        stage('update-initial', update_branches, repo, **options)
+        stage('refresh', refresh_repo, repo)
+        stage('update-unchanged', update_branches, repo, **options)
+        change_job(seed, job_name(0))
+        stage('refresh-changed', refresh_repo, repo)
+        stage('update-one-changed', update_branches, repo, **options)
+        stage('update-full', update_branches, repo, full=True, **options)
+        repo.close()
+    finally:
+        rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', metavar='N', type=int, nargs='+', default=[50, 500],
+        help='Numbers of jobs in the synthetic repositories')
+    parser.add_argument(
+        '--stale', metavar='M', type=int, default=100,
+        help='Number of stale branches to prune')
+    parser.add_argument(
+        '--no-checkout', dest='checkout', action='store_false',
+        help='Benchmark the updater writing branches to the object database')
+    parser.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='Number of branches the updater generates in parallel')
+    parser.add_argument(
+        '--output', metavar='FILE',
+        help='Write the JSON records to FILE instead of stdout')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for size in args.sizes:
+            run(size, args.stale, args.checkout, args.workers, output)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+from io import StringIO
+import json
+from unittest import TestCase, main
+
+from aos_cd_jobs.benchmark import run
+
+class TestBenchmark(TestCase):
+    def test_run(self):
+        """ every stage should be reported against a real bare repository """
+        output = StringIO()
+        run(3, 2, checkout=False, output=output)
+        records = {
+            record['stage']: record
+            for record in map(json.loads, output.getvalue().splitlines())}
+
+        self.assertEqual(records['prune']['pushes'], 1)
+        self.assertEqual(records['update-initial']['pushes'], 1)
+        self.assertEqual(records['update-initial']['connections'], 1)
+        self.assertGreater(records['update-initial']['objects_written'], 0)
+        self.assertEqual(records['update-unchanged']['pushes'], 0)
+        self.assertEqual(records['update-one-changed']['pushes'], 1)
+        self.assertEqual(records['update-full']['objects_written'], 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,62 @@
 from os import getenv
 from os.path import exists, join
 
-from git import Repo
+from git import PushInfo, Repo
 
 JOBS_DIRECTORY = 'jobs'
+PUSH_FAILURE = (
+    PushInfo.ERROR | PushInfo.REJECTED |
+    PushInfo.REMOTE_REJECTED | PushInfo.REMOTE_FAILURE)
+REPO_URL = 'git@github.com:openshift-eng/aos-cd-jobs.git'
+# every branch other than master is a job branch, the pruner removes the rest
+FETCH_REFSPEC = '+refs/heads/*:refs/remotes/origin/*'
 
 
-def initialize_repo():
+def initialize_repo(reference=None, clone_filter=None, refresh=None):
+    """ Get the clone of aos-cd-jobs in $WORKSPACE, creating it if needed
+
+    An existing clone is refreshed with a fetch of master and the job
+    branches which also prunes the remote refs of deleted branches, unless
+    `refresh` is false.  A new clone can borrow objects from a `reference`
+    repository kept on the agent (e.g. a `git clone --mirror`) and be a
+    partial clone using `clone_filter` (e.g. `blob:none`): branches built
+    with `--no-checkout` only need commits and trees.
+
+    Defaults are read from $AOS_CD_JOBS_REFERENCE, $AOS_CD_JOBS_CLONE_FILTER
+    and $AOS_CD_JOBS_REFRESH (set to 0 to skip the refresh).
+    """
+    if reference is None:
+        reference = getenv('AOS_CD_JOBS_REFERENCE')
+    if clone_filter is None:
+        clone_filter = getenv('AOS_CD_JOBS_CLONE_FILTER')
+    if refresh is None:
+        refresh = getenv('AOS_CD_JOBS_REFRESH', '1') != '0'
+
     repo_dir = join(getenv('WORKSPACE'), 'aos-cd-jobs')
     if exists(repo_dir):
         print('Using current clone of aos-cd-jobs')
-        return Repo(repo_dir)
+        repo = Repo(repo_dir)
+        if refresh:
+            refresh_repo(repo)
+        return repo
 
     print('aos-cd-jobs not detected -- cloning a copy')
-    return Repo.clone_from('git@github.com:openshift-eng/aos-cd-jobs.git', repo_dir)
+    options = {'no_tags': True}
+    if reference:
+        print('Borrowing objects from {}'.format(reference))
+        options['reference_if_able'] = reference
+    if clone_filter:
+        print('Creating a partial clone with filter {}'.format(clone_filter))
+        options['filter'] = clone_filter
+    return Repo.clone_from(REPO_URL, repo_dir, **options)
+
 
+def refresh_repo(repo):
+    """ Fetch master and the job branches from origin and fast-forward the
+    local master to the fetched one """
+    print('Refreshing the clone of aos-cd-jobs')
+    repo.git.fetch('--prune', '--no-tags', 'origin', FETCH_REFSPEC)
+    if not repo.head.is_detached and repo.active_branch.name == 'master':
+        repo.git.merge('--ff-only', 'origin/master')
+    else:
+        repo.git.fetch('.', 'refs/remotes/origin/master:refs/heads/master')
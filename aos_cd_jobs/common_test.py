@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+from unittest import TestCase, main
+from mock import MagicMock, patch
+
+from aos_cd_jobs.common import FETCH_REFSPEC, REPO_URL, initialize_repo, refresh_repo
+
+@patch.dict('os.environ', {'WORKSPACE': '/workspace'}, clear=True)
+class TestCommonMethods(TestCase):
+    @patch('aos_cd_jobs.common.exists', lambda _: True)
+    @patch('aos_cd_jobs.common.refresh_repo')
+    @patch('aos_cd_jobs.common.Repo')
+    def test_initialize_repo_existing(self, repo_mock, refresh_mock):
+        """ existing clones should be refreshed """
+        self.assertEqual(initialize_repo(), repo_mock.return_value)
+        repo_mock.assert_called_once_with('/workspace/aos-cd-jobs')
+        refresh_mock.assert_called_once_with(repo_mock.return_value)
+
+    @patch.dict('os.environ', {'AOS_CD_JOBS_REFRESH': '0'})
+    @patch('aos_cd_jobs.common.exists', lambda _: True)
+    @patch('aos_cd_jobs.common.refresh_repo')
+    @patch('aos_cd_jobs.common.Repo', MagicMock())
+    def test_initialize_repo_existing_no_refresh(self, refresh_mock):
+        """ the refresh can be disabled """
+        initialize_repo()
+        self.assertFalse(refresh_mock.called)
+
+    @patch('aos_cd_jobs.common.exists', lambda _: False)
+    @patch('aos_cd_jobs.common.Repo')
+    def test_initialize_repo_clone(self, repo_mock):
+        """ new clones should not fetch tags """
+        initialize_repo()
+        repo_mock.clone_from.assert_called_once_with(
+            REPO_URL, '/workspace/aos-cd-jobs', no_tags=True)
+
+    @patch.dict('os.environ', {
+        'AOS_CD_JOBS_REFERENCE': '/mirror/aos-cd-jobs.git',
+        'AOS_CD_JOBS_CLONE_FILTER': 'blob:none'})
+    @patch('aos_cd_jobs.common.exists', lambda _: False)
+    @patch('aos_cd_jobs.common.Repo')
+    def test_initialize_repo_clone_reference_filter(self, repo_mock):
+        """ new clones can borrow objects and omit blobs """
+        initialize_repo()
+        repo_mock.clone_from.assert_called_once_with(
+            REPO_URL, '/workspace/aos-cd-jobs', no_tags=True,
+            reference_if_able='/mirror/aos-cd-jobs.git', filter='blob:none')
+
+    def test_refresh_repo_on_master(self):
+        """ a checked out master should be fast-forwarded """
+        repo = MagicMock()
+        repo.head.is_detached = False
+        repo.active_branch.name = 'master'
+        refresh_repo(repo)
+        repo.git.fetch.assert_called_once_with(
+            '--prune', '--no-tags', 'origin', FETCH_REFSPEC)
+        repo.git.merge.assert_called_once_with('--ff-only', 'origin/master')
+
+    def test_refresh_repo_detached(self):
+        """ master should be fast-forwarded without a checkout """
+        repo = MagicMock()
+        repo.head.is_detached = True
+        refresh_repo(repo)
+        repo.git.fetch.assert_called_with(
+            '.', 'refs/remotes/origin/master:refs/heads/master')
+        self.assertFalse(repo.git.merge.called)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+""" Long-running mode of the updater
+
+The daemon keeps a clone (and the job index) warm and regenerates the job
+branches when triggered, either through a local HTTP endpoint or by
+polling master on origin.  Triggers arriving while waiting are coalesced:
+a run only starts once no new trigger arrived for `debounce` seconds, and
+always does an incremental update of a freshly fetched master.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from threading import Condition, Event, Thread
+from time import time
+import traceback
+
+from git.exc import GitCommandError
+
+from aos_cd_jobs.common import refresh_repo
+from aos_cd_jobs.updater import update_branches
+
+
+class UpdaterDaemon(object):
+    def __init__(self, repo, debounce=30, **options):
+        """ `options` are passed on to `update_branches` on every run """
+        self.repo = repo
+        self.debounce = debounce
+        self.options = options
+        self.condition = Condition()
+        self.pending = 0
+        self.first_event = self.last_event = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.remote_master = None
+
+    def trigger(self, source='manual'):
+        with self.condition:
+            now = time()
+            if not self.pending:
+                self.first_event = now
+            self.pending += 1
+            self.last_event = now
+            self.condition.notify_all()
+        print('Update triggered by {}'.format(source))
+
+    def status(self):
+        with self.condition:
+            return {
+                'queue_depth': self.pending,
+                'running': self.running,
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_run': self.last_run,
+            }
+
+    def wait_for_triggers(self, stop):
+        """ Block until triggers are pending and none arrived for `debounce`
+        seconds, or `stop` is set
+
+        :return: the number of triggers coalesced and the time of the first
+        one, or None when stopping
+        """
+        with self.condition:
+            while not stop.is_set():
+                if not self.pending:
+                    self.condition.wait(1)
+                    continue
+                remaining = self.last_event + self.debounce - time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                events, first = self.pending, self.first_event
+                self.pending = 0
+                self.running = True
+                return events, first
+        return None
+
+    def run_once(self, events=0, first_event=None):
+        start = time()
+        error = None
+        try:
+            refresh_repo(self.repo)
+            update_branches(self.repo, **self.options)
+        except Exception as e:
+            traceback.print_exc()
+            error = str(e)
+        end = time()
+        with self.condition:
+            self.running = False
+            self.runs += 1
+            if error:
+                self.failures += 1
+            self.last_run = {
+                'master': self.repo.heads.master.commit.hexsha,
+                'events': events,
+                'started': start,
+                'duration': round(end - start, 3),
+                # from the first coalesced trigger to the branches being pushed
+                'latency': round(end - (first_event or start), 3),
+                'error': error,
+            }
+        print('Update finished: {}'.format(json.dumps(self.last_run)))
+
+    def serve(self, stop):
+        while True:
+            triggers = self.wait_for_triggers(stop)
+            if triggers is None:
+                return
+            self.run_once(*triggers)
+
+    def poll(self, interval, stop):
+        """ Trigger an update whenever master changes on origin """
+        while not stop.is_set():
+            try:
+                refs = self.repo.git.ls_remote('origin', 'refs/heads/master')
+            except GitCommandError as e:
+                print('Failed to poll origin: {}'.format(e))
+            else:
+                sha = refs.split()[0] if refs else None
+                if sha and sha != self.remote_master:
+                    if self.remote_master is not None:
+                        self.trigger('master moved to {}'.format(sha[:7]))
+                    self.remote_master = sha
+            stop.wait(interval)
+
+
+def http_server(daemon, address):
+    """ Serve `POST /trigger` and `GET /status` for `daemon` on `address` """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/status':
+                return self.send_error(404)
+            self.reply(200, daemon.status())
+
+        def do_POST(self):
+            if self.path != '/trigger':
+                return self.send_error(404)
+            daemon.trigger('HTTP request from {}'.format(self.client_address[0]))
+            self.reply(202, daemon.status())
+
+        def reply(self, code, body):
+            content = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return ThreadingHTTPServer(address, Handler)
+
+
+def run_daemon(daemon, listen=None, poll_interval=None, stop=None):
+    """ Run `daemon` until `stop` is set, accepting triggers over HTTP on
+    the `listen` address and/or by polling origin every `poll_interval`
+    seconds """
+    stop = stop or Event()
+    threads = [Thread(target=daemon.serve, args=(stop,))]
+    server = None
+    if listen:
+        server = http_server(daemon, listen)
+        threads.append(Thread(target=server.serve_forever))
+        print('Listening on {}:{}'.format(*server.server_address[:2]))
+    if poll_interval:
+        threads.append(Thread(target=daemon.poll, args=(poll_interval, stop)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    daemon.trigger('startup')
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        for thread in threads:
+            thread.join()
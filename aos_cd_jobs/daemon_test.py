@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import json
+from shutil import rmtree
+from subprocess import check_call
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import sleep, time
+from unittest import TestCase, main
+from urllib.request import Request, urlopen
+from mock import MagicMock, patch
+
+from git import Repo
+
+from aos_cd_jobs.benchmark import change_job, create_remote, job_name
+from aos_cd_jobs.daemon import UpdaterDaemon, http_server, run_daemon
+
+class TestUpdaterDaemon(TestCase):
+    def test_wait_for_triggers_debounce(self):
+        """ triggers should be coalesced until none arrives for a while """
+        daemon = UpdaterDaemon(MagicMock(), debounce=0.2)
+        for _ in range(3):
+            daemon.trigger()
+        self.assertEqual(daemon.status()['queue_depth'], 3)
+
+        start = time()
+        events, first = daemon.wait_for_triggers(Event())
+        self.assertGreaterEqual(time() - start, 0.15)
+        self.assertEqual(events, 3)
+        self.assertLessEqual(first, start)
+        self.assertEqual(daemon.status()['queue_depth'], 0)
+        self.assertTrue(daemon.status()['running'])
+
+    def test_wait_for_triggers_stop(self):
+        stop = Event()
+        stop.set()
+        self.assertIsNone(UpdaterDaemon(MagicMock()).wait_for_triggers(stop))
+
+    @patch('aos_cd_jobs.daemon.refresh_repo')
+    @patch('aos_cd_jobs.daemon.update_branches')
+    def test_run_once(self, update_mock, refresh_mock):
+        repo = MagicMock()
+        repo.heads.master.commit.hexsha = 'abc'
+        daemon = UpdaterDaemon(repo, checkout=False)
+        daemon.run_once(2, time())
+        refresh_mock.assert_called_once_with(repo)
+        update_mock.assert_called_once_with(repo, checkout=False)
+        status = daemon.status()
+        self.assertEqual(status['runs'], 1)
+        self.assertEqual(status['last_run']['events'], 2)
+        self.assertIsNone(status['last_run']['error'])
+
+    @patch('aos_cd_jobs.daemon.refresh_repo', MagicMock())
+    @patch('aos_cd_jobs.daemon.update_branches')
+    def test_run_once_failure(self, update_mock):
+        """ failed runs should be reported without stopping the daemon """
+        update_mock.side_effect = IOError('Error updating branches job0')
+        repo = MagicMock()
+        repo.heads.master.commit.hexsha = 'abc'
+        daemon = UpdaterDaemon(repo)
+        daemon.run_once()
+        status = daemon.status()
+        self.assertEqual(status['failures'], 1)
+        self.assertEqual(
+            status['last_run']['error'], 'Error updating branches job0')
+
+    def test_poll(self):
+        """ only changes to master should trigger updates """
+        repo = MagicMock()
+        repo.git.ls_remote.side_effect = [
+            'abc\trefs/heads/master', 'abc\trefs/heads/master',
+            'def\trefs/heads/master']
+        daemon = UpdaterDaemon(repo)
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, False, True]
+        daemon.poll(0, stop)
+        self.assertEqual(daemon.status()['queue_depth'], 1)
+
+
+class TestUpdaterDaemonRepository(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        self.remote, self.seed = create_remote(self.directory, 3, 0)
+        workspace = self.directory + '/workspace'
+        check_call(['git', 'clone', '-q', self.remote, workspace])
+        self.repo = Repo(workspace)
+        self.addCleanup(self.repo.close)
+        with self.repo.config_writer() as config:
+            config.set_value('user', 'name', 'test')
+            config.set_value('user', 'email', 'test@example.com')
+
+    def wait_for_runs(self, daemon, runs):
+        for _ in range(100):
+            if daemon.status()['runs'] >= runs:
+                return daemon.status()
+            sleep(0.05)
+        self.fail('daemon did not run {} times'.format(runs))
+
+    def test_daemon(self):
+        """ HTTP and polling triggers should update the remote branches """
+        daemon = UpdaterDaemon(self.repo, debounce=0.1, checkout=False)
+        server = http_server(daemon, ('127.0.0.1', 0))
+        address = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        server.server_close()
+
+        stop = Event()
+        thread = Thread(
+            target=run_daemon, args=(daemon,),
+            kwargs={'listen': ('127.0.0.1', server.server_address[1]),
+                    'poll_interval': 0.05, 'stop': stop})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+
+        status = self.wait_for_runs(daemon, 1)
+        self.assertIsNone(status['last_run']['error'])
+        remote = Repo(self.remote)
+        self.assertEqual(len(remote.heads), 4)
+
+        change_job(self.seed, job_name(1))
+        status = self.wait_for_runs(daemon, 2)
+        self.assertEqual(
+            status['last_run']['master'], remote.heads.master.commit.hexsha)
+        self.assertEqual(
+            remote.heads[job_name(1)].commit.message,
+            'Auto-generated commit from {}'.format(status['last_run']['master'][:7]))
+
+        request = Request(address + '/trigger', data=b'', method='POST')
+        self.assertEqual(urlopen(request).getcode(), 202)
+        self.wait_for_runs(daemon, 3)
+        status = json.loads(urlopen(address + '/status').read().decode())
+        self.assertEqual(status['runs'], 3)
+        self.assertEqual(status['failures'], 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import json
+from os import getpid, makedirs, replace
+from os.path import join
+from posixpath import basename, dirname
+
+from git.exc import GitCommandError
+
+from aos_cd_jobs.common import JOBS_DIRECTORY
+
+CACHE_DIRECTORY = 'aos-cd-jobs-index'
+JENKINSFILE = 'Jenkinsfile'
+
+# jobs of the trees already looked up in this process, by tree SHA
+_memory = {}
+
+
+def list_jobs(repo, rev='master'):
+    """ List the jobs defined on `rev`, i.e. every directory under `jobs/`
+    containing a Jenkinsfile, relative to `jobs/`
+
+    Results are cached on disk under the git directory, keyed by the SHA of
+    the `jobs/` tree, so that looking up an unchanged tree again only costs
+    a `rev-parse`.
+    """
+    sha = jobs_tree_sha(repo, rev)
+    if sha is None:
+        return []
+    if sha not in _memory:
+        jobs = read_cache(repo, sha)
+        if jobs is None:
+            jobs = jobs_in_tree(repo, sha)
+            write_cache(repo, sha, jobs)
+        _memory[sha] = jobs
+    return list(_memory[sha])
+
+
+def job_set(repo, rev='master'):
+    """ Same as `list_jobs`, as a set for membership tests """
+    return frozenset(list_jobs(repo, rev))
+
+
+def jobs_tree_sha(repo, rev):
+    try:
+        return repo.git.rev_parse(
+            '--verify', '--quiet', '{}:{}'.format(rev, JOBS_DIRECTORY))
+    except GitCommandError:
+        return None
+
+
+def jobs_in_tree(repo, sha):
+    paths = repo.git.ls_tree('-r', '-z', '--name-only', sha).split('\0')
+    return sorted(
+        dirname(path) for path in paths
+        if basename(path) == JENKINSFILE and dirname(path))
+
+
+def cache_directory(repo):
+    return join(repo.common_dir, CACHE_DIRECTORY)
+
+
+def read_cache(repo, sha):
+    try:
+        with open(join(cache_directory(repo), sha + '.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(repo, sha, jobs):
+    directory = cache_directory(repo)
+    makedirs(directory, exist_ok=True)
+    path = join(directory, sha + '.json')
+    tmp = '{}.{}.tmp'.format(path, getpid())
+    with open(tmp, 'w') as f:
+        json.dump(jobs, f)
+    replace(tmp, path)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+from mock import Mock, patch
+from git.exc import GitCommandError
+
+from aos_cd_jobs import job_index
+from aos_cd_jobs.job_index import job_set, jobs_in_tree, jobs_tree_sha, list_jobs
+
+class TestJobIndexMethods(TestCase):
+    def setUp(self):
+        self.repo = Mock()
+        self.repo.common_dir = mkdtemp()
+        self.addCleanup(rmtree, self.repo.common_dir)
+        job_index._memory.clear()
+
+    def test_jobs_in_tree(self):
+        """ jobs are directories under jobs/ containing a Jenkinsfile """
+        self.repo.git.ls_tree.return_value = '\0'.join((
+            'build/ose/Jenkinsfile',
+            'build/ose/README.md',
+            'build/notajob/README.md',
+            'signing/sign/Jenkinsfile',
+            'Jenkinsfile',
+        ))
+
+        self.assertEqual(
+            jobs_in_tree(self.repo, 'abc'), ['build/ose', 'signing/sign'])
+        self.repo.git.ls_tree.assert_called_once_with(
+            '-r', '-z', '--name-only', 'abc')
+
+    def test_jobs_tree_sha(self):
+        self.repo.git.rev_parse.return_value = 'abc'
+
+        self.assertEqual(jobs_tree_sha(self.repo, 'master'), 'abc')
+        self.repo.git.rev_parse.assert_called_once_with(
+            '--verify', '--quiet', 'master:jobs')
+
+    def test_list_jobs_no_jobs(self):
+        """ a tree without jobs/ defines no jobs """
+        self.repo.git.rev_parse.side_effect = GitCommandError('rev-parse', 1)
+
+        self.assertEqual(list_jobs(self.repo), [])
+
+    @patch('aos_cd_jobs.job_index.jobs_in_tree')
+    def test_list_jobs_cached(self, jobs_in_tree_mock):
+        """ jobs of a known tree should be read from the cache """
+        self.repo.git.rev_parse.return_value = 'abc'
+        jobs_in_tree_mock.return_value = ['build/ose']
+
+        self.assertEqual(list_jobs(self.repo), ['build/ose'])
+        job_index._memory.clear()
+        self.assertEqual(list_jobs(self.repo), ['build/ose'])
+        self.assertEqual(job_set(self.repo), frozenset(['build/ose']))
+        jobs_in_tree_mock.assert_called_once_with(self.repo, 'abc')
+
+    @patch('aos_cd_jobs.job_index.jobs_in_tree')
+    def test_list_jobs_changed_tree(self, jobs_in_tree_mock):
+        """ a different tree should be listed again """
+        self.repo.git.rev_parse.side_effect = ['abc', 'def']
+        jobs_in_tree_mock.side_effect = [['build/ose'], ['build/ocp']]
+
+        self.assertEqual(list_jobs(self.repo), ['build/ose'])
+        self.assertEqual(list_jobs(self.repo), ['build/ocp'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
+from argparse import ArgumentParser
 from os import chdir
-from os.path import join, exists
 
-from aos_cd_jobs.common import JOBS_DIRECTORY, initialize_repo
+from aos_cd_jobs.common import PUSH_FAILURE, initialize_repo
+from aos_cd_jobs.job_index import job_set
 
 
 def prunable_remote_refs(repo):
@@ -13,27 +14,53 @@ def prunable_remote_refs(repo):
     return candidates
 
 
-def remote_ref_needs_pruning(ref):
-    return not exists(jenkinsfile_for_ref(ref))
+def remote_ref_needs_pruning(ref, jobs):
+    return ref.remote_head not in jobs
 
-def jenkinsfile_for_ref(ref):
-    return join(
-        ref.repo.working_dir,
-        JOBS_DIRECTORY,
-        ref.remote_head,
-        'Jenkinsfile'
-    )
 
-def prune_remote_ref(ref):
-    ref.repo.remotes[ref.remote_name].push(':' + ref.remote_head)
+def prune_remote_refs_batch(repo, refs):
+    """ Delete all the `refs` from origin in a single push """
+    refspecs = [':' + ref.remote_head for ref in refs]
+    results = {}
+    for push_info in repo.remotes.origin.push(refspecs):
+        name = push_info.remote_ref_string.replace('refs/heads/', '', 1)
+        results[name] = push_info
+        print('Result for {}: {} {}'.format(
+            name, hex(push_info.flags), push_info.summary.strip()))
 
+    failed = [
+        ref.remote_head for ref in refs
+        if ref.remote_head not in results
+        or results[ref.remote_head].flags & PUSH_FAILURE]
+    if failed:
+        raise IOError('Error deleting branches {}'.format(', '.join(failed)))
 
-def prune_remote_refs(repo):
-    for ref in prunable_remote_refs(repo):
-        if remote_ref_needs_pruning(ref):
-            prune_remote_ref(ref)
+
+def prune_remote_refs(repo, dry_run=False):
+    jobs = job_set(repo)
+    stale = [
+        ref for ref in prunable_remote_refs(repo)
+        if remote_ref_needs_pruning(ref, jobs)]
+    if not stale:
+        print('No branches to prune')
+        return stale
+
+    print('{} the following branches:'.format(
+        'Would prune' if dry_run else 'Pruning'))
+    for ref in stale:
+        print(ref.remote_head)
+    if not dry_run:
+        prune_remote_refs_batch(repo, stale)
+    return stale
 
 if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Delete the branches of jobs no longer present on master')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Only list the branches which would be deleted')
+    args = parser.parse_args()
+
     repo = initialize_repo()
     chdir(repo.working_dir)
-    prune_remote_refs(repo)
+    prune_remote_refs(repo, dry_run=args.dry_run)
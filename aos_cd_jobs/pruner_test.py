@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 from unittest import TestCase, main
 from mock import MagicMock, Mock, patch
+from git import PushInfo
 
-from aos_cd_jobs.pruner import jenkinsfile_for_ref, prunable_remote_refs, prune_remote_refs
+from aos_cd_jobs.pruner import prunable_remote_refs, prune_remote_refs, prune_remote_refs_batch, remote_ref_needs_pruning
 
 class TestPruneMethods(TestCase):
-    def test_jenkinsfile_for_ref(self):
-        """ Jenksinsfile should be under ref path from repo root """
+    def test_remote_ref_needs_pruning(self):
+        """ refs should be pruned when there is no job with their name """
         ref = MagicMock()
-        ref.repo.working_dir = 'base'
-        ref.remote_head = 'path'
+        ref.remote_head = 'build/ose'
 
-        self.assertEqual(jenkinsfile_for_ref(ref), 'base/jobs/path/Jenkinsfile')
+        self.assertFalse(remote_ref_needs_pruning(ref, {'build/ose'}))
+        self.assertTrue(remote_ref_needs_pruning(ref, {'build/ocp'}))
 
     def test_prunable_remote_refs_exclude_head(self):
         """ HEAD should not be considered prunable """
@@ -38,23 +39,68 @@ class TestPruneMethods(TestCase):
 
         self.assertEqual(prunable_remote_refs(repo), repo.remotes.origin.refs)
 
+    @patch('aos_cd_jobs.pruner.job_set', Mock(return_value=frozenset()))
     @patch('aos_cd_jobs.pruner.remote_ref_needs_pruning', Mock(return_value=True))
-    @patch('aos_cd_jobs.pruner.prunable_remote_refs', Mock(return_value=[MagicMock()]))
-    @patch('aos_cd_jobs.pruner.prune_remote_ref')
-    def test_prune_remote_refs_positive(self, prune_remote_ref_mock):
-        """ refs that need pruning should be pruned """
-        prune_remote_refs(MagicMock())
+    @patch('aos_cd_jobs.pruner.prunable_remote_refs', Mock(return_value=[MagicMock()] * 2))
+    @patch('aos_cd_jobs.pruner.prune_remote_refs_batch')
+    def test_prune_remote_refs_positive(self, prune_mock):
+        """ refs that need pruning should be pruned together """
+        repo = MagicMock()
+        stale = prune_remote_refs(repo)
 
-        self.assertTrue(prune_remote_ref_mock.called)
+        prune_mock.assert_called_once_with(repo, stale)
+        self.assertEqual(len(stale), 2)
 
+    @patch('aos_cd_jobs.pruner.job_set', Mock(return_value=frozenset()))
     @patch('aos_cd_jobs.pruner.remote_ref_needs_pruning', Mock(return_value=False))
     @patch('aos_cd_jobs.pruner.prunable_remote_refs', Mock(return_value=[MagicMock()]))
-    @patch('aos_cd_jobs.pruner.prune_remote_ref')
-    def test_prune_remote_refs_negative(self, prune_remote_ref_mock):
+    @patch('aos_cd_jobs.pruner.prune_remote_refs_batch')
+    def test_prune_remote_refs_negative(self, prune_mock):
         """ refs that do not need pruning should not be pruned """
         prune_remote_refs(MagicMock())
 
-        self.assertFalse(prune_remote_ref_mock.called)
+        self.assertFalse(prune_mock.called)
+
+    @patch('aos_cd_jobs.pruner.job_set', Mock(return_value=frozenset()))
+    @patch('aos_cd_jobs.pruner.remote_ref_needs_pruning', Mock(return_value=True))
+    @patch('aos_cd_jobs.pruner.prunable_remote_refs', Mock(return_value=[MagicMock()]))
+    @patch('aos_cd_jobs.pruner.prune_remote_refs_batch')
+    def test_prune_remote_refs_dry_run(self, prune_mock):
+        """ a dry run should only report the refs that need pruning """
+        self.assertEqual(len(prune_remote_refs(MagicMock(), dry_run=True)), 1)
+
+        self.assertFalse(prune_mock.called)
+
+    @staticmethod
+    def refs_and_results(flags):
+        refs, results = [], []
+        for i, flag in enumerate(flags):
+            ref = MagicMock()
+            ref.remote_head = 'job{}'.format(i)
+            refs.append(ref)
+            result = MagicMock()
+            result.remote_ref_string = 'refs/heads/job{}'.format(i)
+            result.flags = flag
+            results.append(result)
+        return refs, results
+
+    def test_prune_remote_refs_batch(self):
+        """ all refs should be deleted with a single push """
+        refs, results = self.refs_and_results([PushInfo.DELETED] * 3)
+        repo = MagicMock()
+        repo.remotes.origin.push.return_value = results
+        prune_remote_refs_batch(repo, refs)
+
+        repo.remotes.origin.push.assert_called_once_with([':job0', ':job1', ':job2'])
+
+    def test_prune_remote_refs_batch_failure(self):
+        """ failures should be reported after the push """
+        refs, results = self.refs_and_results([PushInfo.DELETED, PushInfo.ERROR])
+        repo = MagicMock()
+        repo.remotes.origin.push.return_value = results
+
+        with self.assertRaisesRegex(IOError, 'job1$'):
+            prune_remote_refs_batch(repo, refs)
 
 
 if __name__ == '__main__':
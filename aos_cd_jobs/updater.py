@@ -1,14 +1,27 @@
 #!/usr/bin/env python
-from os import chdir, listdir, remove, rename, walk
-from os.path import isdir, join, relpath
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from os import chdir, listdir, remove, rename
+from os.path import isdir, join
+from queue import Queue
 from shutil import rmtree
+from tempfile import mkdtemp
 import pprint
-from git import PushInfo
+import re
+from git import Commit, Repo, Tree
+from git.exc import BadName
+from git.objects.fun import tree_to_stream
+from gitdb import IStream
 
-from aos_cd_jobs.common import JOBS_DIRECTORY, initialize_repo
+from aos_cd_jobs.common import JOBS_DIRECTORY, PUSH_FAILURE, initialize_repo
+from aos_cd_jobs.job_index import list_jobs
 
+GENERATED_FROM = re.compile(r'^Auto-generated commit from ([0-9a-f]{7,40})\b')
 
-def update_branches(repo):
+
+def update_branches(repo, full=False, checkout=True, workers=1):
     jobs = list_jobs(repo)
     print('Found the following jobs to update:')
     pprint.pprint(jobs)
@@ -28,23 +41,158 @@ def update_branches(repo):
                 print('Creating head: {job} => master'.format(job=job))
                 repo.create_head(job, 'master')
 
-        print('Created remote branch: {job}'.format(job=job))
-        create_remote_branch(repo, job)
+    outdated = jobs
+    if not full:
+        outdated = outdated_jobs(repo, jobs)
+        print('Jobs affected by changes on master:')
+        pprint.pprint(outdated)
+
+    generate_branches(repo, outdated, checkout=checkout, workers=workers)
+    # not only the branches which got a new commit: those which failed to
+    # push in a previous run are pushed again
+    publish_branches(repo, unpublished_jobs(repo, jobs))
+
+
+def unpublished_jobs(repo, jobs):
+    """ Select the jobs whose branch is missing from origin or differs from it """
+    refs = repo.remotes['origin'].refs
+    return [
+        job for job in jobs
+        if job not in refs or refs[job].commit != repo.branches[job].commit]
+
+
+def outdated_jobs(repo, jobs):
+    """ Select the jobs whose branch may differ from what master generates
+
+    Every generated commit records the master commit it was created from,
+    so only the jobs touched by the diff between that commit and master
+    need to be regenerated.  Branches which were not generated by us, or
+    whose source commit is unknown, are always regenerated.
+    """
+    master = repo.heads.master.commit
+    changes = {}
+    outdated = []
+    for job in jobs:
+        base = generated_from(repo, repo.branches[job])
+        if base is None:
+            outdated.append(job)
+            continue
+        if base.hexsha not in changes:
+            changes[base.hexsha] = changed_paths(repo, base, master)
+        if job_affected(master.tree, job, changes[base.hexsha]):
+            outdated.append(job)
+    return outdated
+
+
+def generated_from(repo, branch):
+    match = GENERATED_FROM.match(branch.commit.message)
+    if not match:
+        return None
+    try:
+        return repo.commit(match.group(1))
+    except (BadName, ValueError):
+        return None
+
+
+def changed_paths(repo, base, head):
+    if base == head:
+        return []
+    return repo.git.diff(
+        '--name-only', '--no-renames', base.hexsha, head.hexsha).splitlines()
+
+
+def job_affected(tree, job, paths):
+    """ Whether any of the changed `paths` ends up in the branch for `job`
+
+    Paths under the job directory always do.  Other paths under `jobs/`
+    never do, and top-level paths only do when the job directory does not
+    provide an entry with the same name, which replaces them.
+    """
+    prefix = '{}/{}/'.format(JOBS_DIRECTORY, job)
+    for path in paths:
+        if path.startswith(prefix):
+            return True
+        if path.startswith(JOBS_DIRECTORY + '/'):
+            continue
+        if not shadowed_by_job(tree, job, path):
+            return True
+    return False
+
+
+def shadowed_by_job(tree, job, path):
+    try:
+        tree.join('/'.join((JOBS_DIRECTORY, job, path.split('/')[0])))
+    except KeyError:
+        return False
+    return True
+
+
+def generate_branches(repo, jobs, checkout=True, workers=1):
+    """ Generate the branches for `jobs`, using up to `workers` threads
 
+    :return: the jobs whose branch got a new commit
+    """
+    if workers <= 1:
+        results = [generate_branch(repo, job, checkout=checkout) for job in jobs]
+    else:
+        with worker_repos(repo, workers, checkout) as repos:
+            def generate(job):
+                worker = repos.get()
+                try:
+                    return generate_branch(worker, job, checkout=checkout)
+                finally:
+                    repos.put(worker)
 
-def list_jobs(repo):
-    jobs = []
-    jobs_directory = join(repo.working_dir, JOBS_DIRECTORY)
-    for (dirpath, _, filenames) in walk(jobs_directory, followlinks=True):
-        if 'Jenkinsfile' in filenames:
-            jobs.append(relpath(dirpath, jobs_directory))
-    return jobs
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(generate, jobs))
+    return [job for job, changed in zip(jobs, results) if changed]
 
 
-def create_remote_branch(repo, name):
+@contextmanager
+def worker_repos(repo, count, checkout=True):
+    """ Provide a queue of `count` repositories sharing the objects and
+    refs of `repo`, one per worker thread
+
+    Branches populated through the working tree each get a detached
+    worktree of their own, while branches written to the object database
+    only need a separate `Repo` instance, since those are not thread-safe.
+    """
+    if checkout:
+        # a branch can only be checked out in one worktree, and a previous
+        # serial run leaves the main one on the last job branch
+        repo.git.checkout('--detach')
+    directory = mkdtemp(prefix='aos-cd-jobs-worktrees-')
+    repos = Queue()
+    workers = []
+    try:
+        for i in range(count):
+            if checkout:
+                path = join(directory, str(i))
+                repo.git.worktree('add', '--detach', path, 'master')
+                worker = Repo(path)
+            else:
+                worker = Repo(repo.git_dir)
+            workers.append(worker)
+            repos.put(worker)
+        yield repos
+    finally:
+        for worker in workers:
+            worker.close()
+        rmtree(directory)
+        if checkout:
+            repo.git.worktree('prune')
+
+
+def generate_branch(repo, name, checkout=True):
+    """ Bring the branch for job `name` up to date with master
+
+    :return: whether a new commit was created on the branch
+    """
+    print('Generating branch: {}'.format(name))
     branch = repo.branches[name]
-    populate_branch(repo, branch)
-    publish_branch(repo, name)
+    if checkout:
+        return populate_branch(repo, branch)
+    return synthesize_branch(repo, branch)
 
 
 def populate_branch(repo, branch):
@@ -55,22 +203,68 @@ def populate_branch(repo, branch):
     repo.git.add(all=True)
     if not branch.repo.index.diff(branch.commit):
         print('No difference in {} at {}'.format(branch.name, branch.commit))
-        return
+        return False
 
     print('Detected a difference in {} at {}'.format(branch.name, branch.commit))
+    # hooks share COMMIT_EDITMSG between worktrees, which races when
+    # several branches are populated in parallel
     repo.index.commit(
         'Auto-generated commit from {}'.format(
-            repo.heads.master.commit.hexsha[:7]))
+            repo.heads.master.commit.hexsha[:7]),
+        skip_hooks=True)
+    return True
+
+
+def synthesize_branch(repo, branch):
+    """ Equivalent of `populate_branch` working on git objects only
+
+    The branch tree is assembled from the entries of the root tree of master
+    and of the job directory, so neither the working tree nor the index are
+    touched and a commit is only written when the resulting tree changed.
+    """
+    master = repo.heads.master.commit
+    tree = job_tree(repo, master.tree, branch.name)
+    if tree.binsha == branch.commit.tree.binsha:
+        print('No difference in {} at {}'.format(branch.name, branch.commit))
+        return False
+
+    print('Detected a difference in {} at {}'.format(branch.name, branch.commit))
+    branch.commit = Commit.create_from_tree(
+        repo, tree,
+        'Auto-generated commit from {}'.format(master.hexsha[:7]),
+        parent_commits=[branch.commit])
+    return True
+
+
+def job_tree(repo, tree, job):
+    entries = {e.name: e for e in tree if e.name != JOBS_DIRECTORY}
+    entries.update(
+        (e.name, e) for e in tree.join('/'.join((JOBS_DIRECTORY, job))))
+    return write_tree(
+        repo, [(e.binsha, e.mode, e.name) for e in entries.values()])
+
+
+def write_tree(repo, entries):
+    # git orders tree entries as if directory names had a trailing slash
+    entries = sorted(
+        entries, key=lambda e: e[2] + '/' if e[1] >> 12 == 0o04 else e[2])
+    stream = BytesIO()
+    tree_to_stream(entries, stream.write)
+    size = stream.tell()
+    stream.seek(0)
+    istream = repo.odb.store(IStream(Tree.type, size, stream))
+    return Tree(repo, istream.binsha)
 
 
 def clean_file_tree(directory):
     for f in listdir(directory):
         if f == '.git':
             continue
-        if isdir(f):
-            rmtree(f)
+        path = join(directory, f)
+        if isdir(path):
+            rmtree(path)
         else:
-            remove(f)
+            remove(path)
 
 
 def create_job_file_tree(repo, branch):
@@ -80,15 +274,71 @@ def create_job_file_tree(repo, branch):
     rmtree(join(repo.working_dir, JOBS_DIRECTORY))
 
 
-def publish_branch(repo, name):
-    print('Pushing branch {}'.format(name))
-    for push_info in repo.remotes.origin.push(name):
-        print('Result: {}'.format(hex(push_info.flags)))
-        if push_info.flags & PushInfo.ERROR:
-            raise IOError('Error updating branch {}'.format(name))
+def publish_branches(repo, names):
+    """ Push all the `names` branches to origin in a single push
+
+    Results are reported per branch and an error is raised once all of
+    them have been reported if any branch failed to update.
+    """
+    if not names:
+        print('No branches to push')
+        return
+
+    print('Pushing branches:')
+    pprint.pprint(names)
+    results = {}
+    for push_info in repo.remotes.origin.push(names):
+        name = push_info.remote_ref_string.replace('refs/heads/', '', 1)
+        results[name] = push_info
+        print('Result for {}: {} {}'.format(
+            name, hex(push_info.flags), push_info.summary.strip()))
+
+    failed = [
+        name for name in names
+        if name not in results or results[name].flags & PUSH_FAILURE]
+    if failed:
+        raise IOError('Error updating branches {}'.format(', '.join(failed)))
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Generate a branch for every job under {}/'.format(JOBS_DIRECTORY))
+    parser.add_argument(
+        '--full', action='store_true',
+        help='Regenerate every branch instead of only those affected by changes on master')
+    parser.add_argument(
+        '--no-checkout', dest='checkout', action='store_false',
+        help='Write branch contents directly to the object database instead of the working tree')
+    parser.add_argument(
+        '--jobs', dest='workers', metavar='N', type=int, default=1,
+        help='Generate up to N branches in parallel, each in its own worktree')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='Keep running and update the branches when triggered')
+    parser.add_argument(
+        '--listen', metavar='HOST:PORT',
+        help='With --daemon, accept POST /trigger and GET /status on HOST:PORT')
+    parser.add_argument(
+        '--poll', metavar='SECONDS', type=float,
+        help='With --daemon, trigger an update when master changes on origin')
+    parser.add_argument(
+        '--debounce', metavar='SECONDS', type=float, default=30,
+        help='With --daemon, wait for SECONDS without triggers before updating')
+    args = parser.parse_args()
+
     repo = initialize_repo()
     chdir(repo.working_dir)
-    update_branches(repo)
+    if args.daemon:
+        from aos_cd_jobs.daemon import UpdaterDaemon, run_daemon
+        listen = None
+        if args.listen:
+            host, port = args.listen.rsplit(':', 1)
+            listen = (host, int(port))
+        run_daemon(
+            UpdaterDaemon(
+                repo, debounce=args.debounce, full=args.full,
+                checkout=args.checkout, workers=args.workers),
+            listen=listen, poll_interval=args.poll)
+    else:
+        update_branches(
+            repo, full=args.full, checkout=args.checkout, workers=args.workers)
@@ -1,24 +1,14 @@
 #!/usr/bin/env python
 from unittest import TestCase, main
+from contextlib import contextmanager
+from queue import Queue
+
 from mock import MagicMock, Mock, call, patch
+from git import PushInfo
 
-from aos_cd_jobs.updater import create_job_file_tree, create_remote_branch, list_jobs, publish_branch, populate_branch, update_branches
+from aos_cd_jobs.updater import create_job_file_tree, generate_branch, generate_branches, generated_from, job_affected, job_tree, outdated_jobs, publish_branches, populate_branch, synthesize_branch, unpublished_jobs, update_branches, worker_repos
 
 class TestUpdateMethods(TestCase):
-    @patch('aos_cd_jobs.updater.walk')
-    def test_list_jobs_positive(self, walk_mock):
-        walk_mock.return_value = (('dir/jobs/job0', None, ['Jenkinsfile']),)
-        repo = Mock()
-        repo.working_dir = 'dir'
-        self.assertEqual(list_jobs(repo), ['job0'])
-
-    @patch('aos_cd_jobs.updater.walk')
-    def test_list_jobs_negative(self, walk_mock):
-        walk_mock.return_value = (('dir/jobs/notajob', None, ['']),)
-        repo = Mock()
-        repo.working_dir = 'dir'
-        self.assertEqual(list_jobs(repo), [])
-
     @patch('aos_cd_jobs.updater.listdir', lambda _: ('Jenkinsfile', 'README'))
     @patch('aos_cd_jobs.updater.rename')
     @patch('aos_cd_jobs.updater.rmtree')
@@ -38,27 +28,68 @@ class TestUpdateMethods(TestCase):
         rmtree_mock.assert_called_once_with('/tmp/aos-cd-jobs/jobs')
 
     @patch('aos_cd_jobs.updater.list_jobs', lambda *_: ('job0', 'job1'))
-    @patch('aos_cd_jobs.updater.create_remote_branch')
-    def test_update_branches(self, create_mock):
-        repo = Mock()
+    @patch('aos_cd_jobs.updater.publish_branches')
+    @patch('aos_cd_jobs.updater.generate_branch')
+    def test_update_branches(self, create_mock, publish_mock):
+        create_mock.return_value = True
+        repo = MagicMock()
         repo.working_dir = '/tmp/aos-cd-jobs'
         repo.branches = {'job0': Mock(), 'job1': Mock()}
+        update_branches(repo, full=True)
+        create_mock.assert_has_calls((
+            call(repo, 'job0', checkout=True), call(repo, 'job1', checkout=True)))
+        publish_mock.assert_called_once_with(repo, ['job0', 'job1'])
+
+    @patch('aos_cd_jobs.updater.list_jobs', lambda *_: ('job0', 'job1'))
+    @patch('aos_cd_jobs.updater.publish_branches')
+    @patch('aos_cd_jobs.updater.generate_branch')
+    def test_update_branches_unchanged(self, create_mock, publish_mock):
+        create_mock.side_effect = lambda _, job, **__: job == 'job1'
+        repo = MagicMock()
+        repo.branches = {'job0': Mock(), 'job1': Mock()}
+        repo.remotes['origin'].refs = {'job0': repo.branches['job0']}
+        update_branches(repo, full=True)
+        publish_mock.assert_called_once_with(repo, ['job1'])
+
+    @patch('aos_cd_jobs.updater.list_jobs', lambda *_: ('job0', 'job1', 'job2'))
+    @patch('aos_cd_jobs.updater.outdated_jobs', lambda *_: ['job1'])
+    @patch('aos_cd_jobs.updater.publish_branches')
+    @patch('aos_cd_jobs.updater.generate_branch', lambda *_, **__: True)
+    def test_update_branches_unpublished(self, publish_mock):
+        repo = MagicMock()
+        repo.branches = {'job0': Mock(), 'job1': Mock(), 'job2': Mock()}
+        # the push of job0 failed in a previous run
+        repo.remotes['origin'].refs = {'job0': Mock(), 'job2': repo.branches['job2']}
         update_branches(repo)
-        create_mock.assert_has_calls((call(repo, 'job0'), call(repo, 'job1')))
+        publish_mock.assert_called_once_with(repo, ['job0', 'job1'])
+
+    @patch('aos_cd_jobs.updater.list_jobs', lambda *_: ('job0', 'job1'))
+    @patch('aos_cd_jobs.updater.outdated_jobs', lambda *_: ['job1'])
+    @patch('aos_cd_jobs.updater.publish_branches', lambda *_: None)
+    @patch('aos_cd_jobs.updater.generate_branch')
+    def test_update_branches_incremental(self, create_mock):
+        repo = MagicMock()
+        repo.branches = {'job0': Mock(), 'job1': Mock()}
+        update_branches(repo, checkout=False)
+        create_mock.assert_called_once_with(repo, 'job1', checkout=False)
 
     @patch('aos_cd_jobs.updater.list_jobs', lambda *_: ('job0',))
-    @patch('aos_cd_jobs.updater.create_remote_branch')
+    @patch('aos_cd_jobs.updater.publish_branches', lambda *_: None)
+    @patch('aos_cd_jobs.updater.unpublished_jobs', lambda *_: [])
+    @patch('aos_cd_jobs.updater.generate_branch')
     def test_update_branches_remote(self, create_mock):
         repo = Mock()
         repo.working_dir = '/tmp/aos-cd-jobs'
         repo.branches = []
         repo.remotes = MagicMock()
         repo.remotes['origin'].refs = {'job0': Mock()}
-        update_branches(repo)
+        update_branches(repo, full=True)
         repo.create_head.assert_has_calls((call('job0', 'origin/job0'),))
-        create_mock.assert_has_calls((call(repo, 'job0'),))
+        create_mock.assert_has_calls((call(repo, 'job0', checkout=True),))
 
-    @patch('aos_cd_jobs.updater.create_remote_branch', lambda *_: None)
+    @patch('aos_cd_jobs.updater.unpublished_jobs', lambda *_: [])
+    @patch('aos_cd_jobs.updater.generate_branch', lambda *_, **__: None)
+    @patch('aos_cd_jobs.updater.publish_branches', lambda *_: None)
     @patch('aos_cd_jobs.updater.list_jobs')
     def test_update_branches_new(self, list_jobs_mock):
         list_jobs_mock.return_value = ['job0']
@@ -66,9 +97,105 @@ class TestUpdateMethods(TestCase):
         repo.branches = []
         repo.remotes = MagicMock()
         repo.remotes['origin'].refs = []
-        update_branches(repo)
+        update_branches(repo, full=True)
         repo.create_head.assert_called_once_with('job0', 'master')
 
+    @patch('aos_cd_jobs.updater.generate_branch')
+    def test_generate_branches(self, generate_mock):
+        generate_mock.side_effect = lambda _, job, **__: job != 'job1'
+        repo = Mock()
+        self.assertEqual(
+            generate_branches(repo, ['job0', 'job1', 'job2'], checkout=False),
+            ['job0', 'job2'])
+        generate_mock.assert_has_calls((
+            call(repo, 'job0', checkout=False),
+            call(repo, 'job1', checkout=False),
+            call(repo, 'job2', checkout=False)))
+
+    @patch('aos_cd_jobs.updater.generate_branch')
+    @patch('aos_cd_jobs.updater.worker_repos')
+    def test_generate_branches_parallel(self, worker_repos_mock, generate_mock):
+        workers = [Mock(), Mock()]
+
+        @contextmanager
+        def worker_repos(repo, count, checkout):
+            repos = Queue()
+            for worker in workers[:count]:
+                repos.put(worker)
+            yield repos
+
+        worker_repos_mock.side_effect = worker_repos
+        generate_mock.side_effect = lambda _, job, **__: job != 'job1'
+        repo = Mock()
+        self.assertEqual(
+            generate_branches(repo, ['job0', 'job1', 'job2'], workers=2),
+            ['job0', 'job2'])
+        worker_repos_mock.assert_called_once_with(repo, 2, True)
+        self.assertEqual(generate_mock.call_count, 3)
+        for args, _ in generate_mock.call_args_list:
+            self.assertIn(args[0], workers)
+
+    @patch('aos_cd_jobs.updater.rmtree')
+    @patch('aos_cd_jobs.updater.mkdtemp', lambda **_: '/tmp/worktrees')
+    @patch('aos_cd_jobs.updater.Repo')
+    def test_worker_repos_detach(self, repo_mock, _):
+        repo = Mock()
+        with worker_repos(repo, 2) as repos:
+            self.assertEqual(repos.qsize(), 2)
+        self.assertEqual(repo.git.mock_calls[:3], [
+            call.checkout('--detach'),
+            call.worktree('add', '--detach', '/tmp/worktrees/0', 'master'),
+            call.worktree('add', '--detach', '/tmp/worktrees/1', 'master')])
+
+    def test_unpublished_jobs(self):
+        repo = MagicMock()
+        repo.branches = {'job0': Mock(), 'job1': Mock(), 'job2': Mock()}
+        repo.remotes['origin'].refs = {'job0': repo.branches['job0'], 'job1': Mock()}
+        self.assertEqual(unpublished_jobs(repo, ['job0', 'job1', 'job2']), ['job1', 'job2'])
+
+    def test_generated_from(self):
+        repo = Mock()
+        branch = Mock()
+        branch.commit.message = 'Auto-generated commit from 0123456'
+        self.assertEqual(generated_from(repo, branch), repo.commit.return_value)
+        repo.commit.assert_called_once_with('0123456')
+
+    def test_generated_from_foreign_commit(self):
+        repo = Mock()
+        branch = Mock()
+        branch.commit.message = 'Add a new job'
+        self.assertIsNone(generated_from(repo, branch))
+        self.assertFalse(repo.commit.called)
+
+    def test_job_affected_job_directory(self):
+        tree = Mock()
+        self.assertTrue(job_affected(tree, 'build/ose', ['jobs/build/ose/Jenkinsfile']))
+        self.assertFalse(job_affected(tree, 'build/ose', ['jobs/build/ocp/Jenkinsfile']))
+        self.assertFalse(job_affected(tree, 'build/os', ['jobs/build/ose/Jenkinsfile']))
+
+    def test_job_affected_shared_file(self):
+        tree = Mock()
+        tree.join.side_effect = KeyError
+        self.assertTrue(job_affected(tree, 'build/ose', ['pipeline-scripts/buildlib.groovy']))
+        tree.join.assert_called_once_with('jobs/build/ose/pipeline-scripts')
+
+    def test_job_affected_shadowed_file(self):
+        tree = Mock()
+        self.assertFalse(job_affected(tree, 'build/ose', ['Jenkinsfile']))
+        tree.join.assert_called_once_with('jobs/build/ose/Jenkinsfile')
+
+    @patch('aos_cd_jobs.updater.changed_paths')
+    @patch('aos_cd_jobs.updater.generated_from')
+    def test_outdated_jobs(self, generated_from_mock, changed_paths_mock):
+        base = Mock()
+        base.hexsha = 'abcdef'
+        generated_from_mock.side_effect = lambda _, branch: branch
+        changed_paths_mock.return_value = ['jobs/job1/Jenkinsfile']
+        repo = MagicMock()
+        repo.branches = {'job0': base, 'job1': base, 'job2': None}
+        self.assertEqual(outdated_jobs(repo, ['job0', 'job1', 'job2']), ['job1', 'job2'])
+        changed_paths_mock.assert_called_once_with(repo, base, repo.heads.master.commit)
+
     @patch('aos_cd_jobs.updater.clean_file_tree', lambda *_: None)
     @patch('aos_cd_jobs.updater.create_job_file_tree', lambda *_: None)
     def test_populate_branch(self):
@@ -78,13 +205,84 @@ class TestUpdateMethods(TestCase):
         populate_branch(repo, branch)
         repo.git.add.assert_called_once_with(all=True)
         repo.index.commit.assert_called_once_with(
-            'Auto-generated commit from 0123456')
+            'Auto-generated commit from 0123456', skip_hooks=True)
+
+    @patch('aos_cd_jobs.updater.job_tree')
+    @patch('aos_cd_jobs.updater.Commit')
+    def test_synthesize_branch(self, commit_mock, job_tree_mock):
+        repo = MagicMock()
+        repo.heads.master.commit.hexsha = '01234567abcdef'
+        branch = Mock()
+        parent = branch.commit
+        synthesize_branch(repo, branch)
+        commit_mock.create_from_tree.assert_called_once_with(
+            repo, job_tree_mock.return_value,
+            'Auto-generated commit from 0123456', parent_commits=[parent])
+        self.assertEqual(branch.commit, commit_mock.create_from_tree.return_value)
+
+    @patch('aos_cd_jobs.updater.job_tree')
+    @patch('aos_cd_jobs.updater.Commit')
+    def test_synthesize_branch_unchanged(self, commit_mock, job_tree_mock):
+        branch = Mock()
+        job_tree_mock.return_value.binsha = branch.commit.tree.binsha
+        synthesize_branch(MagicMock(), branch)
+        self.assertFalse(commit_mock.create_from_tree.called)
+
+    @patch('aos_cd_jobs.updater.write_tree')
+    def test_job_tree(self, write_tree_mock):
+        def entry(name):
+            e = Mock()
+            e.name, e.binsha, e.mode = name, name + '-sha', 0o100644
+            return e
+        tree = MagicMock()
+        tree.__iter__.return_value = [entry('jobs'), entry('Jenkinsfile'), entry('README.md')]
+        tree.join.return_value = [entry('Jenkinsfile')]
+        tree.join.return_value[0].binsha = 'job-sha'
+        repo = Mock()
+        job_tree(repo, tree, 'build/ose')
+        tree.join.assert_called_once_with('jobs/build/ose')
+        write_tree_mock.assert_called_once_with(repo, [
+            ('job-sha', 0o100644, 'Jenkinsfile'),
+            ('README.md-sha', 0o100644, 'README.md')])
+
+    @patch('aos_cd_jobs.updater.populate_branch')
+    @patch('aos_cd_jobs.updater.synthesize_branch')
+    def test_generate_branch_no_checkout(self, synthesize_mock, populate_mock):
+        repo = MagicMock()
+        self.assertEqual(
+            generate_branch(repo, 'job0', checkout=False),
+            synthesize_mock.return_value)
+        synthesize_mock.assert_called_once_with(repo, repo.branches['job0'])
+        self.assertFalse(populate_mock.called)
+
+    @staticmethod
+    def push_info(name, flags):
+        push_info = Mock()
+        push_info.remote_ref_string = 'refs/heads/' + name
+        push_info.flags = flags
+        push_info.summary = '[up to date]\n'
+        return push_info
+
+    def test_publish_branches(self):
+        repo = Mock()
+        repo.remotes.origin.push.return_value = [
+            self.push_info('job0', PushInfo.FAST_FORWARD),
+            self.push_info('job1', PushInfo.NEW_HEAD)]
+        publish_branches(repo, ['job0', 'job1'])
+        repo.remotes.origin.push.assert_called_once_with(['job0', 'job1'])
+
+    def test_publish_branches_nothing_changed(self):
+        repo = Mock()
+        publish_branches(repo, [])
+        self.assertFalse(repo.remotes.origin.push.called)
 
-    def test_publish_branch(self):
+    def test_publish_branches_failure(self):
         repo = Mock()
-        name = 'job0'
-        publish_branch(repo, name)
-        repo.remotes.origin.push.assert_called_once_with(name)
+        repo.remotes.origin.push.return_value = [
+            self.push_info('job0', PushInfo.REJECTED),
+            self.push_info('job1', PushInfo.FAST_FORWARD)]
+        with self.assertRaisesRegex(IOError, 'job0, job2$'):
+            publish_branches(repo, ['job0', 'job1', 'job2'])
 
 
 if __name__ == '__main__':
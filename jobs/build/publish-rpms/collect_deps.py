@@ -2,12 +2,26 @@
 
 import argparse
 import asyncio
+import configparser
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import pwd
+import re
+import shutil
+import sys
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
-from urllib.parse import quote
+from typing import Dict, List, Optional, Set, TextIO
+from urllib.parse import quote, urlsplit
+
+import repodata
+import rpmverify
 
 PACKAGES = {
     8: [
@@ -43,6 +57,7 @@ YUM_CONF_TEMPLATES = {
     8: """[main]
 cachedir={CACHE_DIR}
 keepcache=0
+metadata_expire=0
 debuglevel=2
 exactarch=1
 obsoletes=1
@@ -80,6 +95,7 @@ module_hotfixes=1
     9: """[main]
 cachedir={CACHE_DIR}
 keepcache=0
+metadata_expire=0
 debuglevel=2
 exactarch=1
 obsoletes=1
@@ -122,7 +138,307 @@ module_hotfixes=1
 LOGGER = logging.getLogger(__name__)
 
 
-async def download_rpms(ocp_version: str, arch: str, rhel_major: int, output_dir: os.PathLike):
+@contextmanager
+def locked(lock_file: Path, exclusive: bool):
+    """ Hold a shared or exclusive lock on lock_file """
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MetadataCache:
+    """ Persistent dnf metadata cache shared between collect runs.
+
+    Entries are keyed by repo baseurl and arch. Before a run, the entries of the repos it uses are hardlinked into the
+    private dnf cache directory of the run. dnf is configured with metadata_expire=0, so it only downloads repomd.xml
+    to revalidate them and fetches the rest of the metadata again only if its checksums changed. After a successful run,
+    entries dnf rewrote (new inodes) replace the shared ones. Concurrent runs are serialized with a lock file, which is
+    only held while linking files.
+    """
+
+    def __init__(self, cache_dir: os.PathLike, max_age: float = 7 * 24 * 3600, max_size: int = 20 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir).absolute()
+        self.max_age = max_age
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _lock(self, exclusive: bool):
+        return locked(self.cache_dir / ".lock", exclusive)
+
+    @property
+    def index_dir(self) -> Path:
+        """ Where the repodata module keeps its package indexes, next to the entries """
+        return self.cache_dir / "index"
+
+    def _entry_dir(self, arch: str, baseurl: str) -> Path:
+        return self.cache_dir / hashlib.sha256(f"{arch} {baseurl}".encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _repo_files(directory: Path, repo_id: str):
+        """ dnf keeps the metadata of a repo in <repo id>-<hash>/ and the solv files <repo id>.solv and
+        <repo id>-filenames.solvx """
+        for path in directory.iterdir():
+            if path.name == f"{repo_id}.solv" or path.name.startswith(f"{repo_id}-"):
+                yield path
+
+    @staticmethod
+    def _link(src: Path, dst: Path):
+        if src.is_dir():
+            shutil.copytree(src, dst, copy_function=os.link, symlinks=True)
+        else:
+            os.link(src, dst)
+
+    @staticmethod
+    def _inodes(path: Path):
+        paths = path.rglob("*") if path.is_dir() else [path]
+        return {(str(p.relative_to(path)), p.stat().st_ino) for p in paths if p.is_file()}
+
+    def seed(self, dnf_cache_dir: Path, arch: str, repos: Dict[str, str]):
+        """ Link the cached metadata of `repos` ({repo id: baseurl}) into the dnf cache directory of a run """
+        with self._lock(exclusive=False):
+            for repo_id, baseurl in repos.items():
+                entry_dir = self._entry_dir(arch, baseurl)
+                if not entry_dir.is_dir():
+                    LOGGER.info("Metadata cache miss for %s (%s)", repo_id, baseurl)
+                    continue
+                LOGGER.info("Metadata cache hit for %s (%s)", repo_id, baseurl)
+                for path in entry_dir.iterdir():
+                    self._link(path, dnf_cache_dir / path.name)
+                os.utime(entry_dir)
+
+    def publish(self, dnf_cache_dir: Path, arch: str, repos: Dict[str, str]):
+        """ Store the metadata of `repos` refreshed by a run, then evict old entries """
+        with self._lock(exclusive=True):
+            for repo_id, baseurl in repos.items():
+                entry_dir = self._entry_dir(arch, baseurl)
+                entry_dir.mkdir(exist_ok=True)
+                for path in self._repo_files(dnf_cache_dir, repo_id):
+                    cached = entry_dir / path.name
+                    if cached.exists() and self._inodes(cached) == self._inodes(path):
+                        continue
+                    LOGGER.info("Updating cached metadata %s for %s", path.name, baseurl)
+                    if cached.is_dir():
+                        shutil.rmtree(cached)
+                    elif cached.exists():
+                        cached.unlink()
+                    self._link(path, cached)
+                os.utime(entry_dir)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        for entry_dir in self.cache_dir.iterdir():
+            if not entry_dir.is_dir() or entry_dir == self.index_dir:
+                continue
+            mtime = entry_dir.stat().st_mtime
+            if now - mtime > self.max_age:
+                LOGGER.info("Evicting metadata cache entry %s unused for %.1f days", entry_dir.name,
+                            (now - mtime) / 86400)
+                shutil.rmtree(entry_dir)
+                continue
+            size = sum(p.stat().st_size for p in entry_dir.rglob("*") if p.is_file())
+            entries.append((mtime, size, entry_dir))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+            LOGGER.info("Evicting metadata cache entry %s to keep the cache under %d bytes", entry_dir.name,
+                        self.max_size)
+            shutil.rmtree(entry_dir)
+            total -= size
+
+
+class RpmStore:
+    """ Content-addressed store of RPMs, shared by the output directories of every version, arch and RHEL major.
+
+    RPMs are stored once as <store_dir>/<checksum type>/<2 first digits>/<checksum>.rpm, keyed by the checksum the
+    repodata gives for them, and output directories are assembled from hardlinks to them. The link count of a blob is
+    then the number of output directories using it plus one, and blobs only linked from the store are garbage. The
+    store must be on the same filesystem as the output directories.
+    """
+
+    def __init__(self, store_dir: os.PathLike):
+        self.store_dir = Path(store_dir).absolute()
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def _lock(self, exclusive: bool):
+        return locked(self.store_dir / ".lock", exclusive)
+
+    def blob(self, checksum_type: str, checksum: str) -> Path:
+        return self.store_dir / checksum_type / checksum[:2] / f"{checksum}.rpm"
+
+    @staticmethod
+    def _digest(path: Path, checksum_type: str) -> str:
+        digest = hashlib.new("sha1" if checksum_type == "sha" else checksum_type)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _link(src: Path, dst: Path):
+        tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+
+    def _add(self, path: Path, checksum_type: str, checksum: str, verified: bool = False) -> Path:
+        """ Store path if it has the expected checksum, unless that was already verified """
+        if not verified:
+            digest = self._digest(path, checksum_type)
+            if digest != checksum:
+                raise IOError(f"{path} has {checksum_type} checksum {digest} instead of {checksum}")
+        blob = self.blob(checksum_type, checksum)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        if not blob.exists():
+            self._link(path, blob)
+        return blob
+
+    def checkout(self, output_dir: Path, checksums: Dict[str, tuple]) -> List[str]:
+        """ Link the stored RPMs among checksums ({file name: (checksum type, checksum)}) into output_dir
+
+        RPMs already in output_dir but not in the store are added to it, or deleted if they do not match their
+        checksum.
+        :return: the file names of the RPMs which still need to be downloaded
+        """
+        needed = []
+        with self._lock(exclusive=False):
+            for name, (checksum_type, checksum) in sorted(checksums.items()):
+                path = output_dir / name
+                blob = self.blob(checksum_type, checksum)
+                if blob.exists():
+                    if not path.exists() or not path.samefile(blob):
+                        self._link(blob, path)
+                elif path.exists():
+                    try:
+                        self._add(path, checksum_type, checksum)
+                    except IOError:
+                        LOGGER.warning("Deleting %s which does not match its checksum", path)
+                        path.unlink()
+                        needed.append(name)
+                else:
+                    needed.append(name)
+        return needed
+
+    def add(self, download_dir: Path, output_dir: Path, checksums: Dict[str, tuple], verified: bool = False):
+        """ Store the RPMs downloaded to download_dir and link them into output_dir """
+        with self._lock(exclusive=False):
+            for name, (checksum_type, checksum) in sorted(checksums.items()):
+                blob = self._add(download_dir / name, checksum_type, checksum, verified=verified)
+                self._link(blob, output_dir / name)
+
+    def gc(self):
+        """ Delete the RPMs no output directory links to anymore """
+        count = size = 0
+        with self._lock(exclusive=True):
+            for blob in self.store_dir.glob("*/*/*.rpm"):
+                stat = blob.stat()
+                if stat.st_nlink == 1:
+                    blob.unlink()
+                    count += 1
+                    size += stat.st_size
+        LOGGER.info("Deleted %s unused RPMs (%s MiB) from the store", count, size // 1024 ** 2)
+
+
+class Telemetry:
+    """ Structured events of a collection, parsed from the output of the commands it runs.
+
+    dnf prints a line for every metadata file and package it downloads, e.g.
+        rhel-server-9-baseos                            12 MB/s |  40 MB     00:03
+        (1/16): criu-3.18-1.el9.x86_64.rpm             1.2 MB/s | 560 kB     00:00
+    """
+
+    PROGRESS = re.compile(
+        r"^(?:\((?P<index>\d+)/\d+\): )?(?P<name>\S+)\s+(?P<speed>[\d.]+)\s*(?P<speed_unit>[kMGTP]?)B/s\s*\|"
+        r"\s*(?P<size>[\d.]+)\s*(?P<size_unit>[kMGTP]?)B\s+(?P<time>[\d:]+)")
+    UNITS = {"": 1, "k": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+
+    def __init__(self):
+        self.events: List[Dict] = []
+        # file name and URL of every RPM resolved, and baseurl of every repo, to attribute downloads to repos
+        self.urls: Dict[str, str] = {}
+        self.repos: Dict[str, str] = {}
+
+    def parse(self, line: str):
+        match = self.PROGRESS.match(line.strip())
+        if not match or match["name"] == "Total":
+            return
+        seconds = 0
+        for part in match["time"].split(":"):
+            seconds = seconds * 60 + int(part)
+        event = {
+            "bytes": int(float(match["size"]) * self.UNITS[match["size_unit"]]),
+            "seconds": seconds,
+            "throughput": int(float(match["speed"]) * self.UNITS[match["speed_unit"]]),
+        }
+        if match["index"] or match["name"].endswith((".rpm", "...")):
+            self.events.append(dict(event, type="package", name=match["name"]))
+        else:
+            self.events.append(dict(event, type="metadata", repo=match["name"]))
+
+    def command(self, step: str, seconds: float, status: int):
+        self.events.append({"type": "command", "step": step, "seconds": round(seconds, 3), "status": status})
+
+    def _repo(self, name: str) -> str:
+        """ Find the repo a package was downloaded from. dnf cuts long file names to the width of the terminal,
+        with or without ..., so a name is also matched as the prefix of a single resolved file name """
+        url = self.urls.get(name)
+        if not url:
+            prefix = name[:-3] if name.endswith("...") else name
+            urls = [url for filename, url in self.urls.items() if filename.startswith(prefix)]
+            url = urls[0] if len(urls) == 1 else None
+        for repo_id, baseurl in self.repos.items():
+            if url and url.startswith(repodata.join_url(baseurl, "")):
+                return repo_id
+        return "unknown"
+
+    def summary(self) -> Dict:
+        packages = [event for event in self.events if event["type"] == "package"]
+        repos = {}
+        for event in packages:
+            repo = repos.setdefault(self._repo(event["name"]), {"packages": 0, "bytes": 0, "seconds": 0})
+            repo["packages"] += 1
+            repo["bytes"] += event["bytes"]
+            # dnf only reports whole seconds, use the throughput it measured instead
+            repo["seconds"] += event["bytes"] / event["throughput"] if event["throughput"] else event["seconds"]
+        for repo_id, repo in repos.items():
+            repo["repo"] = repo_id
+            repo["host"] = urlsplit(self.repos.get(repo_id, "")).netloc
+            repo["throughput"] = int(repo["bytes"] / repo["seconds"]) if repo["seconds"] else None
+            repo["seconds"] = round(repo["seconds"], 3)
+        total_bytes = sum(event["bytes"] for event in packages)
+        download_seconds = sum(event["seconds"] for event in self.events
+                               if event["type"] == "command" and event["step"] == "dnf download")
+        return {
+            "packages": {
+                "count": len(packages),
+                "bytes": total_bytes,
+                "seconds": download_seconds,
+                "throughput": int(total_bytes / download_seconds) if download_seconds else None,
+            },
+            "metadata": [event for event in self.events if event["type"] == "metadata"],
+            "commands": [event for event in self.events if event["type"] == "command"],
+            # slowest first
+            "repos": sorted(repos.values(), key=lambda repo: repo["throughput"] or 0),
+        }
+
+
+async def download_rpms(ocp_version: str, arch: str, rhel_major: int, output_dir: os.PathLike,
+                        logger: logging.Logger = LOGGER, log_file: Optional[TextIO] = None,
+                        cache: Optional[MetadataCache] = None, resolver: str = "dnf",
+                        store: Optional[RpmStore] = None, telemetry: Optional[Telemetry] = None,
+                        verify: bool = True):
+    """ Make output_dir contain the RPMs worker nodes need, downloading only those it does not have yet
+
+    With resolver "python", dependencies are resolved from the repodata by the repodata module instead of dnf.
+    With a store, RPMs already in it are linked instead of downloaded.
+    RPMs are downloaded to a staging directory, and with verify checked with verify_rpms before they are moved to the
+    store or output_dir.
+    :return: the file names of the RPMs downloaded and removed
+    """
     yum_conf_tmpl = YUM_CONF_TEMPLATES.get(rhel_major)
     if not yum_conf_tmpl:
         raise ValueError(f"Unsupported RHEL version '{rhel_major}'")
@@ -131,13 +447,18 @@ async def download_rpms(ocp_version: str, arch: str, rhel_major: int, output_dir
         working_dir = Path(working_dir).absolute()
         install_root_dir = working_dir / "install-root"
         yum_conf_filename = working_dir / "yum.conf"
-        cache_dir = working_dir / "cache"
+        # yum doesn't honor cachedir in the yum.conf. It keeps a user specific cache
+        # https://unix.stackexchange.com/questions/92257/yum-user-temp-files-var-tmp-yum-fills-up-with-repo-data
+        # override the location using TMPDIR, and name the cache as dnf would so that it is used either way
+        tmp_dir = working_dir / "tmp"
+        cache_dir = tmp_dir / f"dnf-{pwd.getpwuid(os.geteuid()).pw_name}-cache"
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
 
         yum_conf = yum_conf_tmpl.format(yum_conf_tmpl, OCP_VERSION=quote(
             ocp_version), ARCH=arch, CACHE_DIR=cache_dir, EL=rhel_major).strip()
         with open(yum_conf_filename, "w") as f:
             f.write(yum_conf)
-        packages = PACKAGES[rhel_major]
+        packages = list(PACKAGES[rhel_major])
         if arch == 'x86_64':
             packages.append('openshift-clients-redistributable')
         cmd = [
@@ -146,50 +467,340 @@ async def download_rpms(ocp_version: str, arch: str, rhel_major: int, output_dir
             f"--releasever={rhel_major}",
             "-c", f"{yum_conf_filename}",
             "--disableplugin=subscription-manager",
-            "--downloadonly",
             "--skip-broken",
             #f"--installroot={Path(install_root_dir).absolute()}",
-            f"--destdir={output_dir}",
             f"--forcearch={arch}",
         ]
-        if rhel_major == 8:
-            cmd.extend(['--resolve', '--alldeps'])
 
-        cmd.append('--')
-        cmd.extend(packages)
+        loop = asyncio.get_running_loop()
+        repos = get_repos(yum_conf)
+        if cache:
+            await loop.run_in_executor(None, cache.seed, cache_dir, arch, repos)
 
-        LOGGER.info("Running command %s", cmd)
         env = os.environ.copy()
-        # yum doesn't honor cachedir in the yum.conf. It keeps a user specific cache
-        # https://unix.stackexchange.com/questions/92257/yum-user-temp-files-var-tmp-yum-fills-up-with-repo-data
-        # override the location using TMPDIR
-        tmp_dir = working_dir / "tmp"
-        tmp_dir.mkdir(parents=True, exist_ok=True)
         env['TMPDIR'] = str(tmp_dir)
-        process = await asyncio.subprocess.create_subprocess_exec(*cmd, env=env)
-        rc = await process.wait()
-        if rc != 0:
-            raise ChildProcessError(f"Process {cmd} exited with status {rc}")
 
+        # resolve first, and only download the RPMs which are not already in output_dir
+        index_dir = cache.index_dir if cache else working_dir / "index"
+        if resolver == "python":
+            logger.info("Resolving %s", packages)
+            urls = await loop.run_in_executor(None, resolve_packages, yum_conf, arch, packages, rhel_major == 8,
+                                              index_dir)
+        else:
+            resolve_cmd = cmd + ["--url"]
+            if rhel_major == 8:
+                resolve_cmd.extend(['--resolve', '--alldeps'])
+            resolve_cmd.append('--')
+            resolve_cmd.extend(packages)
+            logger.info("Running command %s", resolve_cmd)
+            output = await run_command(resolve_cmd, env=env, log_file=log_file, capture=True,
+                                       telemetry=telemetry, step="dnf resolve")
+            urls = {
+                line.rsplit("/", 1)[-1]: line for line in output.splitlines()
+                if "://" in line and line.endswith(".rpm")
+            }
+        wanted = set(urls)
+        if telemetry:
+            telemetry.urls.update(urls)
+            telemetry.repos.update(repos)
+        if not wanted:
+            raise ValueError(f"dnf resolved no RPMs for {packages}")
+
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        present = {path.name for path in output_dir.glob("*.rpm")}
+        missing = sorted(wanted - present)
+        removed = sorted(present - wanted)
+        logger.info("%s RPMs resolved, %s already present, %s to download, %s to remove",
+                    len(wanted), len(wanted & present), len(missing), len(removed))
+
+        # downloaded RPMs are staged, so that output_dir never holds one which was not verified
+        download_dir = working_dir / "download"
+        checksums = {}
+        if missing and (store or verify):
+            checksums = await loop.run_in_executor(None, get_checksums, yum_conf, arch, set(missing), index_dir)
+        if missing and store:
+            unknown = set(missing) - checksums.keys()
+            if unknown:
+                raise ValueError(f"No checksum found in the repodata for {sorted(unknown)}")
+            needed = await loop.run_in_executor(None, store.checkout, output_dir, checksums)
+            logger.info("%s RPMs linked from the store", len(missing) - len(needed))
+            missing = needed
+
+        if missing:
+            download_cmd = cmd + ["--downloadonly", f"--destdir={download_dir}", "--"]
+            # file names are <name>-<version>-<release>.<arch>.rpm, which dnf accepts as NEVRA
+            download_cmd.extend(name[:-len(".rpm")] for name in missing)
+            logger.info("Running command %s", download_cmd)
+            await run_command(download_cmd, env=env, log_file=log_file, telemetry=telemetry, step="dnf download")
+            not_downloaded = [name for name in missing if not (download_dir / name).exists()]
+            if not_downloaded:
+                raise IOError(f"dnf did not download {not_downloaded}")
+            if verify:
+                await verify_rpms({download_dir / name: checksums.get(name) for name in missing},
+                                  logger=logger, telemetry=telemetry)
+            if store:
+                await loop.run_in_executor(None, store.add, download_dir, output_dir,
+                                           {name: checksums[name] for name in missing}, verify)
+            else:
+                for name in missing:
+                    shutil.move(download_dir / name, output_dir / name)
+        for name in removed:
+            logger.info("Removing %s", name)
+            (output_dir / name).unlink()
+
+        if cache:
+            await loop.run_in_executor(None, cache.publish, cache_dir, arch, repos)
+        return missing, removed
+
+
+async def verify_rpms(rpms: Dict[Path, Optional[tuple]], logger: logging.Logger = LOGGER,
+                      telemetry: Optional[Telemetry] = None):
+    """ Check the header and payload digests of RPMs ({path: (checksum type, checksum) from the repodata, or None}),
+    and their checksum if known, in a process pool
+
+    :raise rpmverify.VerificationError: as soon as an RPM does not match, after deleting it so that it is downloaded
+    again next time
+    """
+    if not rpms:
+        return
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    pool = ProcessPoolExecutor(max_workers=min(len(rpms), os.cpu_count() or 1))
+    futures = [
+        loop.run_in_executor(pool, rpmverify.verify_rpm, str(path), *(checksum or (None, None)))
+        for path, checksum in rpms.items()
+    ]
+    try:
+        done, _ = await asyncio.wait(futures, return_when=asyncio.FIRST_EXCEPTION)
+        size = sum(future.result() for future in done)
+    except Exception as e:
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future in futures:
+            future.cancel()
+        if telemetry:
+            telemetry.command("verify", time.monotonic() - start, 1)
+        if isinstance(e, rpmverify.VerificationError):
+            logger.error("Deleting invalid RPM %s", e)
+            Path(e.path).unlink(missing_ok=True)
+        raise
+    pool.shutdown()
+    seconds = time.monotonic() - start
+    if telemetry:
+        telemetry.command("verify", seconds, 0)
+    logger.info("Verified %s RPMs (%s MiB) in %.1fs, %.0f MiB/s", len(rpms), size // 1024 ** 2, seconds,
+                size / 1024 ** 2 / seconds if seconds else 0)
+
+
+def get_repos(yum_conf: str) -> Dict[str, str]:
+    """ Map the id of each repo defined in yum_conf to its baseurl """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(yum_conf)
+    return {section: parser[section]["baseurl"] for section in parser.sections() if section != "main"}
+
+
+def get_excludes(yum_conf: str) -> Dict[str, List[str]]:
+    """ Map the id of each repo defined in yum_conf to the package globs it excludes """
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(yum_conf)
+    return {section: parser[section].get("exclude", "").split() for section in parser.sections() if section != "main"}
+
+
+def get_checksums(yum_conf: str, arch: str, names: Set[str], index_dir: Path) -> Dict[str, tuple]:
+    """ Look up the checksums of the RPMs named names in the repodata of the repos of yum_conf
+
+    :return: {file name: (checksum type, checksum)}
+    """
+    checksums = {}
+    for repo_id, baseurl in get_repos(yum_conf).items():
+        for package in repodata.load_index(repo_id, baseurl, index_dir).packages:
+            if package.filename in names and package.arch in (arch, "noarch"):
+                checksums.setdefault(package.filename, (package.checksum_type, package.checksum))
+    return checksums
+
+
+def resolve_packages(yum_conf: str, arch: str, packages: List[str], closure: bool,
+                     index_dir: Path) -> Dict[str, str]:
+    """ Resolve packages from the repos of yum_conf without dnf, like dnf download --resolve --alldeps with closure
+
+    :return: the file names and URLs of the RPMs to download
+    """
+    indexes = [repodata.load_index(repo_id, baseurl, index_dir) for repo_id, baseurl in get_repos(yum_conf).items()]
+    resolver = repodata.Resolver(indexes, arch, get_excludes(yum_conf))
+    return {package.filename: resolver.url(package) for package in resolver.resolve(packages, closure=closure)}
 
-async def create_repo(directory: str):
-    cmd = ["createrepo_c", "-v", "--", f"{directory}"]
-    LOGGER.info("Running command %s", cmd)
-    process = await asyncio.subprocess.create_subprocess_exec(*cmd, env=os.environ.copy())
+
+async def create_repo(directory: str, logger: logging.Logger = LOGGER, log_file: Optional[TextIO] = None,
+                      telemetry: Optional[Telemetry] = None) -> bool:
+    """ Create or update the repodata of directory
+
+    The previous repodata and a checksum cache are reused, so only added or removed RPMs are processed. The cache and
+    the RPM set of the last run are kept in <parent>/.createrepo/<name>, out of the published directory. If the RPM set
+    did not change at all, the repodata is left untouched so that its timestamps stay the same.
+    :return: whether the repodata was regenerated
+    """
+    directory = Path(directory)
+    state_dir = directory.parent / ".createrepo" / directory.name
+    state_file = state_dir / "rpms.json"
+    rpms = sorted(
+        [path.name, stat.st_size, stat.st_mtime_ns]
+        for path, stat in ((path, path.stat()) for path in directory.glob("*.rpm"))
+    )
+    try:
+        with open(state_file) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if previous == rpms and (directory / "repodata" / "repomd.xml").exists():
+        logger.info("RPMs in %s did not change, keeping the existing repodata", directory)
+        return False
+
+    state_dir.mkdir(parents=True, exist_ok=True)
+    state_file.unlink(missing_ok=True)
+    # createrepo_c resolves a relative --cachedir against directory
+    cmd = ["createrepo_c", "-v", "--update", f"--cachedir={state_dir.absolute() / 'checksums'}", "--", f"{directory}"]
+    logger.info("Running command %s", cmd)
+    await run_command(cmd, env=os.environ.copy(), log_file=log_file, telemetry=telemetry, step="createrepo")
+    with open(state_file, "w") as f:
+        json.dump(rpms, f)
+    return True
+
+
+async def run_command(cmd: List[str], env: Dict[str, str], log_file: Optional[TextIO] = None,
+                      capture: bool = False, telemetry: Optional[Telemetry] = None,
+                      step: Optional[str] = None) -> Optional[str]:
+    """ Run cmd, streaming its output to log_file if given instead of ours, and to telemetry
+
+    With capture, stdout is returned instead, and only stderr is streamed. The duration of the command is recorded in
+    telemetry as step.
+    """
+    out = log_file or sys.stdout
+    start = time.monotonic()
+    process = await asyncio.subprocess.create_subprocess_exec(
+        *cmd, env=env, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE if capture else asyncio.subprocess.STDOUT)
+
+    async def stream(reader: asyncio.StreamReader):
+        async for line in reader:
+            line = line.decode(errors="replace")
+            out.write(line)
+            out.flush()
+            if telemetry:
+                telemetry.parse(line)
+
+    if capture:
+        stdout, _ = await asyncio.gather(process.stdout.read(), stream(process.stderr))
+    else:
+        stdout = None
+        await stream(process.stdout)
     rc = await process.wait()
+    if telemetry:
+        telemetry.command(step or cmd[0], time.monotonic() - start, rc)
     if rc != 0:
         raise ChildProcessError(f"Process {cmd} exited with status {rc}")
+    return stdout.decode() if capture else None
 
 
-async def collect(ocp_version: str, arch: str, rhel_major: int, base_dir: Optional[str]):
+def get_output_dir(base_dir: Optional[str], ocp_version: str, arch: str, rhel_major: int, per_arch: bool = False) -> Path:
+    """ Repos are written to <base_dir>/<version>-el<N>-beta, or <base_dir>/<arch>/<version>-el<N>-beta
+    when collecting for several arches at once """
     version_suffix = f"-el{rhel_major}" if rhel_major != 7 else ""
     base_dir = Path(base_dir or ".")
-    output_dir = Path(base_dir, f"{ocp_version}{version_suffix}-beta")
-    LOGGER.info(
+    if per_arch:
+        base_dir = base_dir / arch
+    return Path(base_dir, f"{ocp_version}{version_suffix}-beta")
+
+
+async def collect(ocp_version: str, arch: str, rhel_major: int, base_dir: Optional[str], per_arch: bool = False,
+                  logger: logging.Logger = LOGGER, log_file: Optional[TextIO] = None,
+                  cache: Optional[MetadataCache] = None, resolver: str = "dnf", store: Optional[RpmStore] = None,
+                  telemetry: Optional[Telemetry] = None, verify: bool = True):
+    output_dir = get_output_dir(base_dir, ocp_version, arch, rhel_major, per_arch)
+    logger.info(
         f"Downloading rpms to {output_dir} for OCP {ocp_version} - RHEL {rhel_major}...")
-    await download_rpms(ocp_version, arch, rhel_major, output_dir)
-    LOGGER.info(f"Creating repo {output_dir} for {arch} OCP {ocp_version} - RHEL {rhel_major}...")
-    await create_repo(output_dir)
+    downloaded, removed = await download_rpms(ocp_version, arch, rhel_major, output_dir,
+                                              logger=logger, log_file=log_file, cache=cache, resolver=resolver,
+                                              store=store, telemetry=telemetry, verify=verify)
+    if removed:
+        logger.info("Removed from %s: %s", output_dir, " ".join(removed))
+    logger.info(f"Creating repo {output_dir} for {arch} OCP {ocp_version} - RHEL {rhel_major}...")
+    repodata_updated = await create_repo(output_dir, logger=logger, log_file=log_file, telemetry=telemetry)
+    return {"downloaded": downloaded, "removed": removed, "repodata_updated": repodata_updated}
+
+
+async def collect_matrix(ocp_versions: List[str], arches: List[str], rhel_majors: List[int], base_dir: Optional[str],
+                         concurrency: int = 1, log_dir: Optional[str] = None,
+                         cache: Optional[MetadataCache] = None, resolver: str = "dnf",
+                         store: Optional[RpmStore] = None, verify: bool = True) -> List[Dict]:
+    """ Collect every combination of OCP version, arch and RHEL major, running up to `concurrency` of them at once
+
+    With log_dir, the output of the commands run for each combination goes to <log_dir>/<version>-el<N>-<arch>.log.
+    :return: one result per combination with its duration and error, if any
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    per_arch = len(arches) > 1
+    if log_dir:
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    async def _collect(ocp_version: str, arch: str, rhel_major: int):
+        name = f"{ocp_version}-el{rhel_major}-{arch}"
+        logger = LOGGER.getChild(name)
+        result = {"ocp_version": ocp_version, "arch": arch, "el": rhel_major, "error": None}
+        telemetry = Telemetry()
+        async with semaphore:
+            start = time.monotonic()
+            log_file = open(Path(log_dir, f"{name}.log"), "w") if log_dir else None
+            try:
+                result.update(await collect(ocp_version, arch, rhel_major, base_dir, per_arch=per_arch,
+                                            logger=logger, log_file=log_file, cache=cache,
+                                            resolver=resolver, store=store, telemetry=telemetry,
+                                            verify=verify))
+            except Exception as e:
+                logger.exception("Failed to collect %s", name)
+                result["error"] = str(e)
+            finally:
+                if log_file:
+                    log_file.close()
+            result["duration"] = round(time.monotonic() - start, 1)
+            result["telemetry"] = telemetry.summary()
+        return result
+
+    results = await asyncio.gather(*(
+        _collect(ocp_version, arch, rhel_major)
+        for ocp_version in ocp_versions for rhel_major in rhel_majors for arch in arches))
+
+    LOGGER.info("Summary:")
+    for result in results:
+        if result["error"]:
+            outcome = f"FAILED ({result['error']})"
+        else:
+            outcome = (f"succeeded ({len(result['downloaded'])} downloaded, {len(result['removed'])} removed, "
+                       f"repodata {'updated' if result['repodata_updated'] else 'unchanged'})")
+        LOGGER.info("%s-el%s-%s: %s in %ss", result["ocp_version"], result["el"], result["arch"],
+                    outcome, result["duration"])
+    return results
+
+
+def summarize(results: List[Dict]) -> Dict:
+    """ Summarize the telemetry of the results of collect_matrix, with the repos downloads were slowest from """
+    repos = {}
+    for result in results:
+        for repo in result["telemetry"]["repos"]:
+            total = repos.setdefault(repo["repo"], {"repo": repo["repo"], "host": repo["host"], "packages": 0,
+                                                    "bytes": 0, "seconds": 0})
+            for key in ("packages", "bytes", "seconds"):
+                total[key] += repo[key]
+    for repo in repos.values():
+        repo["throughput"] = int(repo["bytes"] / repo["seconds"]) if repo["seconds"] else None
+    total_bytes = sum(result["telemetry"]["packages"]["bytes"] for result in results)
+    download_seconds = sum(result["telemetry"]["packages"]["seconds"] for result in results)
+    return {
+        "results": results,
+        "bytes": total_bytes,
+        "download_seconds": round(download_seconds, 3),
+        "throughput": int(total_bytes / download_seconds) if download_seconds else None,
+        "slowest_repos": sorted(repos.values(), key=lambda repo: repo["throughput"] or 0)[:5],
+    }
 
 
 async def main():
@@ -199,19 +810,57 @@ async def main():
                         help="Write repos to specified directory")
     parser.add_argument("--arch", required=False,
                         default='x86_64',
-                        help="Write repos to specified directory")
+                        help="Comma separated architectures to collect RPMs for. "
+                             "With more than one, repos are written to <base-dir>/<arch>/")
     parser.add_argument("--el", required=False,
                         default='8',
-                        help="The RHEL version from which to publish RPMs")
-    parser.add_argument("ocp_version", help="OCP version. e.g. 4.11")
+                        help="Comma separated RHEL versions from which to publish RPMs")
+    parser.add_argument("--concurrency", required=False, type=int, default=1,
+                        help="How many version/arch/RHEL combinations to collect at once")
+    parser.add_argument("--log-dir", required=False,
+                        help="Write the output of each combination to <log-dir>/<version>-el<N>-<arch>.log")
+    parser.add_argument("--cache-dir", required=False,
+                        help="Keep dnf metadata in this directory between runs")
+    parser.add_argument("--cache-max-age", required=False, type=float, default=7,
+                        help="Evict cached metadata unused for this many days")
+    parser.add_argument("--cache-max-size", required=False, type=float, default=20,
+                        help="Evict the least recently used metadata when the cache exceeds this many GiB")
+    parser.add_argument("--resolver", required=False, choices=["dnf", "python"], default="dnf",
+                        help="Resolve dependencies with dnf, or in process from the repodata. The latter does not "
+                             "filter modular packages")
+    parser.add_argument("--store-dir", required=False,
+                        help="Assemble repos from hardlinks to RPMs stored once in this directory, by checksum. "
+                             "Must be on the same filesystem as --base-dir")
+    parser.add_argument("--no-verify", dest="verify", action="store_false",
+                        help="Do not check the digests of the downloaded RPMs")
+    parser.add_argument("--summary", required=False,
+                        help="Write a JSON summary of the run, with download throughput per repo, to this file")
+    parser.add_argument("ocp_version", nargs="+", help="OCP versions. e.g. 4.11")
     args = parser.parse_args()
 
-    tasks = list()
-    tasks.append(collect(args.ocp_version,
-                         args.arch,
-                         int(args.el), base_dir=args.base_dir))
-    await asyncio.gather(*tasks)
+    cache = None
+    if args.cache_dir:
+        cache = MetadataCache(args.cache_dir, max_age=args.cache_max_age * 86400,
+                              max_size=int(args.cache_max_size * 1024 ** 3))
+    store = RpmStore(args.store_dir) if args.store_dir else None
+
+    results = await collect_matrix(args.ocp_version,
+                                   args.arch.split(","),
+                                   [int(el) for el in args.el.split(",")],
+                                   base_dir=args.base_dir,
+                                   concurrency=args.concurrency,
+                                   log_dir=args.log_dir,
+                                   cache=cache,
+                                   resolver=args.resolver,
+                                   store=store,
+                                   verify=args.verify)
+    if store:
+        store.gc()
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summarize(results), f, indent=2)
+    return 1 if any(result["error"] for result in results) else 0
 
 
 if __name__ == "__main__":
-    asyncio.get_event_loop().run_until_complete(main())
+    sys.exit(asyncio.get_event_loop().run_until_complete(main()))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+from unittest.mock import AsyncMock, patch
+
+import collect_deps
+import rpmverify
+from rpmverify_test import make_rpm
+
+
+class TestCreateRepo(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        Path("base", "repo").mkdir(parents=True)
+        Path("base", "repo", "a-1-1.x86_64.rpm").write_bytes(b"rpm")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @patch("collect_deps.run_command", new_callable=AsyncMock)
+    def test_create_repo_relative_base_dir(self, run_mock):
+        """ the checksum cache is passed as an absolute path, createrepo_c resolves relative ones against the repo """
+        self.assertTrue(asyncio.run(collect_deps.create_repo("base/repo")))
+        cmd = run_mock.call_args.args[0]
+        cachedir = Path(cmd[cmd.index("--") - 1].split("=", 1)[1])
+        self.assertTrue(cachedir.is_absolute())
+        self.assertEqual(cachedir, Path(self.tmp.name, "base", ".createrepo", "repo", "checksums").resolve())
+        self.assertEqual(cmd[-1], "base/repo")
+        self.assertTrue(Path("base", ".createrepo", "repo", "rpms.json").exists())
+
+    @patch("collect_deps.run_command", new_callable=AsyncMock)
+    def test_create_repo_unchanged(self, run_mock):
+        """ the repodata is kept when the RPMs did not change """
+        asyncio.run(collect_deps.create_repo("base/repo"))
+        Path("base", "repo", "repodata").mkdir()
+        Path("base", "repo", "repodata", "repomd.xml").write_text("")
+        self.assertFalse(asyncio.run(collect_deps.create_repo("base/repo")))
+        self.assertEqual(run_mock.call_count, 1)
+
+
+class TestDownloadRpms(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.rpms = {f"{name}-1.0-1.el9.x86_64.rpm": make_rpm(name) for name in ("criu", "runc")}
+        # what the repos serve
+        self.served = dict(self.rpms)
+        self.downloads = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def run_command(self, cmd, env, log_file=None, capture=False, telemetry=None, step=None):
+        """ dnf, resolving to the RPMs served and downloading them """
+        if capture:
+            return "\n".join(f"https://example.com/os/Packages/{name}" for name in self.served)
+        destdir = Path(next(arg for arg in cmd if arg.startswith("--destdir=")).split("=", 1)[1])
+        destdir.mkdir(parents=True, exist_ok=True)
+        for nevra in cmd[cmd.index("--") + 1:]:
+            self.downloads.append(f"{nevra}.rpm")
+            (destdir / f"{nevra}.rpm").write_bytes(self.served[f"{nevra}.rpm"])
+
+    def get_checksums(self, yum_conf, arch, names, index_dir):
+        return {name: ("sha256", hashlib.sha256(self.rpms[name]).hexdigest()) for name in names}
+
+    def download(self, **kwargs):
+        with patch("collect_deps.run_command", self.run_command), \
+                patch("collect_deps.get_checksums", self.get_checksums):
+            return asyncio.run(collect_deps.download_rpms("4.16", "x86_64", 9, "out", **kwargs))
+
+    def test_download(self):
+        self.assertEqual(self.download(), (sorted(self.rpms), []))
+        self.assertEqual({path.name: path.read_bytes() for path in Path("out").iterdir()}, self.rpms)
+        # nothing to do the next time
+        self.assertEqual(self.download(), ([], []))
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_download_invalid(self):
+        """ an RPM failing verification is not published, and downloaded again the next time """
+        self.served["runc-1.0-1.el9.x86_64.rpm"] = self.rpms["runc-1.0-1.el9.x86_64.rpm"][:-1]
+        with self.assertRaises(rpmverify.VerificationError):
+            self.download()
+        # criu was fine, but was not verified when the run stopped
+        self.assertEqual(list(Path("out").iterdir()), [])
+        self.served = dict(self.rpms)
+        self.assertEqual(self.download(), (sorted(self.rpms), []))
+        self.assertEqual({path.name: path.read_bytes() for path in Path("out").iterdir()}, self.rpms)
+
+    def test_download_store(self):
+        """ with a store, RPMs are verified before they are stored """
+        store = collect_deps.RpmStore("store")
+        self.served["runc-1.0-1.el9.x86_64.rpm"] = b"not an RPM" * 100
+        with self.assertRaises(rpmverify.VerificationError):
+            self.download(store=store)
+        self.assertEqual(list(Path("store").glob("*/*/*.rpm")), [])
+        self.served = dict(self.rpms)
+        self.download(store=store)
+        self.assertEqual(len(list(Path("store").glob("*/*/*.rpm"))), 2)
+        self.assertEqual({path.name: path.read_bytes() for path in Path("out").iterdir()}, self.rpms)
+
+
+class TestTelemetry(TestCase):
+    def setUp(self):
+        self.telemetry = collect_deps.Telemetry()
+        self.telemetry.repos = {"baseos": "https://example.com/baseos/os", "ose": "https://example.com/ose/os/"}
+        self.telemetry.urls = {
+            name: f"https://example.com/{repo}/os/Packages/{name}" for repo, name in [
+                ("baseos", "criu-3.18-1.el9.x86_64.rpm"),
+                ("ose", "openshift-clients-4.16.0-202406131906.p0.el9.x86_64.rpm"),
+                ("ose", "openshift-clients-redistributable-4.16.0-202406131906.p0.el9.x86_64.rpm"),
+            ]
+        }
+
+    def repos(self, *lines):
+        for line in lines:
+            self.telemetry.parse(line)
+        return {repo["repo"]: repo["packages"] for repo in self.telemetry.summary()["repos"]}
+
+    def test_parse(self):
+        self.telemetry.parse("rhel-server-9-baseos                            12 MB/s |  40 MB     00:03")
+        self.telemetry.parse("(1/16): criu-3.18-1.el9.x86_64.rpm             1.2 MB/s | 560 kB     00:00")
+        self.assertEqual(self.telemetry.events, [
+            {"type": "metadata", "repo": "rhel-server-9-baseos", "bytes": 40 * 1024 ** 2, "seconds": 3,
+             "throughput": 12 * 1024 ** 2},
+            {"type": "package", "name": "criu-3.18-1.el9.x86_64.rpm", "bytes": 560 * 1024, "seconds": 0,
+             "throughput": int(1.2 * 1024 ** 2)},
+        ])
+
+    def test_repo_truncated_names(self):
+        """ names cut by dnf, with or without ..., are attributed to the repo of the only file they start with """
+        self.assertEqual(self.repos(
+            "(1/4): criu-3.18-1.el9.x86_64.rpm             1.2 MB/s | 560 kB     00:00",
+            "(2/4): openshift-clients-4.16.0-20240613 5.0 MB/s |  50 MB     00:10",
+            "(3/4): openshift-clients-redistributable-... 5.0 MB/s |  60 MB     00:12",
+            "(4/4): openshift-clients-                    5.0 MB/s |  60 MB     00:12",
+        ), {"baseos": 1, "ose": 2, "unknown": 1})
+
+
+if __name__ == "__main__":
+    main()
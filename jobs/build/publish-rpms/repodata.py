@@ -0,0 +1,329 @@
+"""
+Resolve package dependencies from repodata without dnf.
+
+The primary metadata of every repo is stream-parsed into a compact index of
+packages and what they provide and require. Indexes are stored next to the
+metadata they were built from, keyed by its checksum, and kept in memory, so
+that resolving again or for another version sharing the same repos only costs
+the dependency walk. Repos can be remote (http(s)://) or local (file:// or a
+path), which allows resolving against fixture repos.
+"""
+
+import bz2
+import fnmatch
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import pickle
+import re
+import shutil
+import urllib.request
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Dict, IO, Iterable, List, NamedTuple, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+
+# bump when the index format changes, to ignore indexes stored by older versions
+INDEX_VERSION = 1
+
+_INDEXES: Dict[str, "RepoIndex"] = {}
+
+
+class EVR(NamedTuple):
+    epoch: int
+    version: str
+    release: Optional[str]
+
+
+class Dependency(NamedTuple):
+    name: str
+    flags: Optional[str]
+    evr: Optional[EVR]
+
+
+class Package(NamedTuple):
+    name: str
+    arch: str
+    evr: EVR
+    location: str
+    checksum_type: str
+    checksum: str
+    size: int
+    provides: Tuple[Dependency, ...]
+    requires: Tuple[Dependency, ...]
+
+    @property
+    def filename(self) -> str:
+        return self.location.rsplit("/", 1)[-1]
+
+    @property
+    def nevra(self) -> str:
+        epoch = f"{self.evr.epoch}:" if self.evr.epoch else ""
+        return f"{self.name}-{epoch}{self.evr.version}-{self.evr.release}.{self.arch}"
+
+
+class RepoIndex(NamedTuple):
+    repo_id: str
+    baseurl: str
+    packages: Tuple[Package, ...]
+
+
+def vercmp(a: str, b: str) -> int:
+    """ Compare two version or release strings the way rpm does """
+    if a == b:
+        return 0
+    while a or b:
+        a = re.sub(r"^[^a-zA-Z0-9~^]+", "", a)
+        b = re.sub(r"^[^a-zA-Z0-9~^]+", "", b)
+        if a.startswith("~") or b.startswith("~"):
+            if not a.startswith("~"):
+                return 1
+            if not b.startswith("~"):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        if a.startswith("^") or b.startswith("^"):
+            if not a:
+                return -1
+            if not b:
+                return 1
+            if not a.startswith("^"):
+                return 1
+            if not b.startswith("^"):
+                return -1
+            a, b = a[1:], b[1:]
+            continue
+        if not a or not b:
+            break
+        pattern = r"[0-9]+" if a[0].isdigit() else r"[a-zA-Z]+"
+        sa = re.match(pattern, a).group()
+        mb = re.match(pattern, b)
+        if not mb:
+            # numeric segments are newer than alphabetic ones
+            return 1 if a[0].isdigit() else -1
+        sb = mb.group()
+        a, b = a[len(sa):], b[len(sb):]
+        if sa[0].isdigit():
+            sa, sb = sa.lstrip("0"), sb.lstrip("0")
+            if len(sa) != len(sb):
+                return 1 if len(sa) > len(sb) else -1
+        if sa != sb:
+            return 1 if sa > sb else -1
+    if not a and not b:
+        return 0
+    return 1 if a else -1
+
+
+def evrcmp(a: EVR, b: EVR) -> int:
+    """ Compare a with b, ignoring the release if b does not have one """
+    if a.epoch != b.epoch:
+        return 1 if a.epoch > b.epoch else -1
+    result = vercmp(a.version, b.version)
+    if result or not b.release or not a.release:
+        return result
+    return vercmp(a.release, b.release)
+
+
+def satisfies(provide: Dependency, require: Dependency) -> bool:
+    """ Whether provide satisfies require, both having the same name. Unversioned provides satisfy any requirement,
+    like rpm """
+    if not require.flags or not provide.flags or provide.evr is None:
+        return True
+    if provide.flags != "EQ":
+        # ranges are rare in provides, accept them rather than resolving nothing
+        return True
+    result = evrcmp(provide.evr, require.evr)
+    return {
+        "EQ": result == 0,
+        "LT": result < 0,
+        "LE": result <= 0,
+        "GT": result > 0,
+        "GE": result >= 0,
+    }[require.flags]
+
+
+def _evr(element: ET.Element) -> Optional[EVR]:
+    if element.get("ver") is None:
+        return None
+    return EVR(int(element.get("epoch") or 0), element.get("ver"), element.get("rel"))
+
+
+def _dependencies(format_element: ET.Element, tag: str) -> Tuple[Dependency, ...]:
+    container = format_element.find(RPM_NS + tag)
+    if container is None:
+        return ()
+    return tuple(Dependency(entry.get("name"), entry.get("flags"), _evr(entry)) for entry in container)
+
+
+def parse_primary(f: IO[bytes]) -> Iterable[Package]:
+    """ Stream the packages of a primary.xml """
+    context = ET.iterparse(f, events=("start", "end"))
+    _, root = next(context)
+    for event, element in context:
+        if event != "end" or element.tag != COMMON_NS + "package":
+            continue
+        if element.get("type") == "rpm":
+            checksum = element.find(COMMON_NS + "checksum")
+            format_element = element.find(COMMON_NS + "format")
+            files = tuple(Dependency(file.text, None, None) for file in format_element.iter(COMMON_NS + "file"))
+            yield Package(
+                name=element.findtext(COMMON_NS + "name"),
+                arch=element.findtext(COMMON_NS + "arch"),
+                evr=_evr(element.find(COMMON_NS + "version")),
+                location=element.find(COMMON_NS + "location").get("href"),
+                checksum_type=checksum.get("type"),
+                checksum=checksum.text,
+                size=int(element.find(COMMON_NS + "size").get("package")),
+                provides=_dependencies(format_element, "provides") + files,
+                requires=_dependencies(format_element, "requires"),
+            )
+        # only keep the package being parsed in memory
+        root.clear()
+
+
+def _open_compressed(path: Path) -> IO[bytes]:
+    openers = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open, ".xml": open}
+    opener = openers.get(path.suffix)
+    if not opener:
+        raise ValueError(f"Unsupported compression for {path}")
+    return opener(path, "rb")
+
+
+def join_url(baseurl: str, href: str) -> str:
+    if "://" not in baseurl:
+        baseurl = Path(baseurl).absolute().as_uri()
+    return f"{baseurl.rstrip('/')}/{href}"
+
+
+def load_index(repo_id: str, baseurl: str, index_dir: os.PathLike) -> RepoIndex:
+    """ Get the index of a repo, only downloading and parsing its primary metadata if it changed since it was last
+    indexed in index_dir """
+    with urllib.request.urlopen(join_url(baseurl, "repodata/repomd.xml")) as f:
+        repomd = ET.parse(f).getroot()
+    primary = next(data for data in repomd.iter(REPO_NS + "data") if data.get("type") == "primary")
+    checksum = primary.findtext(REPO_NS + "checksum")
+    href = primary.find(REPO_NS + "location").get("href")
+    prefix = hashlib.sha256(f"{INDEX_VERSION} {baseurl}".encode()).hexdigest()[:16]
+    name = f"{prefix}-{checksum[:32]}"
+    if name in _INDEXES:
+        return _INDEXES[name]
+
+    index_dir = Path(index_dir)
+    index_path = index_dir / f"{name}.pickle"
+    try:
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+        os.utime(index_path)
+        LOGGER.info("Using the index of %s in %s", repo_id, index_path)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        index_dir.mkdir(parents=True, exist_ok=True)
+        metadata_path = index_dir / f"{name}-{href.rsplit('/', 1)[-1]}"
+        LOGGER.info("Downloading %s", join_url(baseurl, href))
+        with urllib.request.urlopen(join_url(baseurl, href)) as src, open(metadata_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        try:
+            with _open_compressed(metadata_path) as f:
+                index = RepoIndex(repo_id, baseurl, tuple(parse_primary(f)))
+        finally:
+            metadata_path.unlink()
+        LOGGER.info("Indexed %s packages of %s", len(index.packages), repo_id)
+        tmp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+        # the indexes of previous versions of the metadata of the repo will not be used anymore
+        for path in index_dir.glob(f"{prefix}-*.pickle"):
+            if path != index_path:
+                path.unlink(missing_ok=True)
+    _INDEXES[name] = index
+    return index
+
+
+class Resolver:
+    """ Dependency resolution over the packages of several repos installable on arch """
+
+    def __init__(self, indexes: List[RepoIndex], arch: str, excludes: Optional[Dict[str, List[str]]] = None):
+        """ excludes maps repo ids to the globs of the names of packages to ignore in them, like the exclude option of
+        a yum.conf """
+        excludes = excludes or {}
+        # packages are keyed by id, hashing them would hash all their dependencies
+        self.baseurls: Dict[int, str] = {}
+        self.by_name: Dict[str, List[Package]] = {}
+        self.provides: Dict[str, List[Tuple[Dependency, Package]]] = {}
+        for index in indexes:
+            patterns = excludes.get(index.repo_id, [])
+            for package in index.packages:
+                if package.arch not in (arch, "noarch"):
+                    continue
+                if any(fnmatch.fnmatchcase(package.name, p) or fnmatch.fnmatchcase(f"{package.name}.{package.arch}", p)
+                       for p in patterns):
+                    continue
+                self.baseurls[id(package)] = index.baseurl
+                self.by_name.setdefault(package.name, []).append(package)
+                for provide in package.provides:
+                    self.provides.setdefault(provide.name, []).append((provide, package))
+        self.arch = arch
+
+    def _best(self, packages: List[Package]) -> Package:
+        best = packages[0]
+        for package in packages[1:]:
+            result = evrcmp(package.evr, best.evr)
+            if result > 0 or result == 0 and package.arch == self.arch and best.arch != self.arch:
+                best = package
+        return best
+
+    def providers(self, require: Dependency) -> List[Package]:
+        return [package for provide, package in self.provides.get(require.name, ()) if satisfies(provide, require)]
+
+    def resolve(self, names: List[str], closure: bool = True) -> List[Package]:
+        """ Select the latest version of each package in names and, with closure, everything they require
+
+        Requirements nothing provides are logged and skipped, like dnf --skip-broken.
+        """
+        missing = [name for name in names if name not in self.by_name]
+        if missing:
+            raise ValueError(f"No package {', '.join(missing)} available")
+        selected: Dict[int, Package] = {}
+        queue = [self._best(self.by_name[name]) for name in names]
+        queued = {id(package) for package in queue}
+        selected_names = {(package.name, package.arch) for package in queue}
+        while queue:
+            package = queue.pop()
+            if id(package) in selected:
+                continue
+            selected[id(package)] = package
+            if not closure:
+                continue
+            for require in package.requires:
+                if require.name.startswith(("rpmlib(", "(")):
+                    # rpm internal capabilities, and rich dependencies which are not worth supporting here
+                    continue
+                candidates = self.providers(require)
+                if not candidates:
+                    LOGGER.warning("Nothing provides %s needed by %s", require.name, package.nevra)
+                    continue
+                if any(id(candidate) in selected or id(candidate) in queued for candidate in candidates):
+                    continue
+                # like dnf, only install one version of each package
+                candidates = [candidate for candidate in candidates
+                              if (candidate.name, candidate.arch) not in selected_names]
+                if not candidates:
+                    LOGGER.warning("%s needed by %s is only provided by other versions of selected packages",
+                                   require.name, package.nevra)
+                    continue
+                same_name = [candidate for candidate in candidates if candidate.name == require.name]
+                best = self._best(same_name or candidates)
+                selected_names.add((best.name, best.arch))
+                queued.add(id(best))
+                queue.append(best)
+        return sorted(selected.values(), key=lambda package: package.filename)
+
+    def url(self, package: Package) -> str:
+        return join_url(self.baseurls[id(package)], package.location)
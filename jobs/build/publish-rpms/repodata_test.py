@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import repodata
+from repodata import EVR, Dependency, Resolver, evrcmp, load_index, satisfies, vercmp
+
+FIXTURE_REPO = Path(__file__).absolute().parent / "fixtures" / "repo"
+
+
+class TestVersions(TestCase):
+    def test_vercmp(self):
+        """ versions compare like rpmvercmp """
+        for a, b, expected in [
+            ("1.0", "1.0", 0),
+            ("1.0", "1.0.1", -1),
+            ("1.10", "1.9", 1),
+            ("1.01", "1.1", 0),
+            ("2_0", "2.0", 0),
+            ("1.0a", "1.0", 1),
+            # numeric segments are newer than alphabetic ones
+            ("1.1", "1.a", 1),
+            ("1.a", "1.1", -1),
+            ("a", "b", -1),
+            # a tilde sorts before anything, even the end of the version
+            ("1.0~rc1", "1.0", -1),
+            ("1.0~rc1", "1.0~rc2", -1),
+            ("1.0~~", "1.0~", -1),
+            # a caret sorts after the end of the version, but before anything else
+            ("1.0^", "1.0", 1),
+            ("1.0^git1", "1.0.1", -1),
+            ("1.0^git1", "1.0^git2", -1),
+        ]:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(vercmp(a, b), expected)
+                self.assertEqual(vercmp(b, a), -expected)
+
+    def test_evrcmp(self):
+        """ the epoch comes first, and a missing release matches any """
+        self.assertEqual(evrcmp(EVR(1, "1.0", "1"), EVR(0, "2.0", "1")), 1)
+        self.assertEqual(evrcmp(EVR(0, "1.0", "2"), EVR(0, "1.0", "10")), -1)
+        self.assertEqual(evrcmp(EVR(0, "1.0", "2"), EVR(0, "1.0", None)), 0)
+        self.assertEqual(evrcmp(EVR(0, "1.1", "1"), EVR(0, "1.0", None)), 1)
+
+    def test_satisfies(self):
+        """ versioned requirements are checked against EQ provides """
+        provide = Dependency("conmon", "EQ", EVR(2, "2.1.10", "1.el9"))
+        self.assertTrue(satisfies(provide, Dependency("conmon", None, None)))
+        self.assertTrue(satisfies(provide, Dependency("conmon", "GE", EVR(2, "2.1", None))))
+        self.assertTrue(satisfies(provide, Dependency("conmon", "EQ", EVR(2, "2.1.10", None))))
+        self.assertFalse(satisfies(provide, Dependency("conmon", "LT", EVR(2, "2.1.10", None))))
+        self.assertFalse(satisfies(provide, Dependency("conmon", "GT", EVR(2, "2.1.10", "1.el9"))))
+        self.assertFalse(satisfies(provide, Dependency("conmon", "GE", EVR(3, "1.0", None))))
+        # unversioned provides satisfy anything
+        self.assertTrue(satisfies(Dependency("conmon", None, None), Dependency("conmon", "LT", EVR(0, "1", None))))
+
+
+class TestFixtureRepo(TestCase):
+    def setUp(self):
+        repodata._INDEXES.clear()
+        self.index_dir = tempfile.TemporaryDirectory()
+        self.index = load_index("fixture", str(FIXTURE_REPO), self.index_dir.name)
+
+    def tearDown(self):
+        repodata._INDEXES.clear()
+        self.index_dir.cleanup()
+
+    def resolve(self, names, arch="x86_64", excludes=None, closure=True):
+        resolver = Resolver([self.index], arch, excludes)
+        return [package.nevra for package in resolver.resolve(names, closure=closure)]
+
+    def test_load_index(self):
+        """ the primary metadata is parsed with provides, requires and files """
+        self.assertEqual(len(self.index.packages), 12)
+        bash = next(package for package in self.index.packages if package.name == "bash")
+        self.assertEqual(bash.evr, EVR(0, "5.1.8", "9.el9"))
+        self.assertEqual(bash.filename, "bash-5.1.8-9.el9.x86_64.rpm")
+        self.assertEqual((bash.checksum_type, bash.size), ("sha256", 1500))
+        self.assertIn(Dependency("/bin/sh", None, None), bash.provides)
+
+    def test_load_index_file_url(self):
+        """ file:// URLs work like paths """
+        index = load_index("fixture", FIXTURE_REPO.as_uri(), self.index_dir.name)
+        self.assertEqual([package.nevra for package in index.packages],
+                         [package.nevra for package in self.index.packages])
+
+    def test_load_index_stored(self):
+        """ the stored index is used instead of parsing the metadata again, and replaces older ones """
+        stored = list(Path(self.index_dir.name).glob("*.pickle"))
+        self.assertEqual(len(stored), 1)
+        outdated = stored[0].with_name(stored[0].name.split("-")[0] + "-outdated.pickle")
+        outdated.write_bytes(b"")
+        repodata._INDEXES.clear()
+        with patch("repodata.parse_primary", side_effect=AssertionError("parsed again")):
+            self.assertEqual(load_index("fixture", str(FIXTURE_REPO), self.index_dir.name), self.index)
+        # a new version of the metadata
+        stored[0].unlink()
+        repodata._INDEXES.clear()
+        load_index("fixture", str(FIXTURE_REPO), self.index_dir.name)
+        self.assertEqual(list(Path(self.index_dir.name).glob("*.pickle")), stored)
+
+    def test_resolve_closure(self):
+        """ the latest version of everything required is selected, skipping rpmlib and rich dependencies """
+        self.assertEqual(self.resolve(["cri-o"]), [
+            "bash-5.1.8-9.el9.x86_64",
+            "conmon-2:2.1.10-1.el9.x86_64",
+            "cri-o-1.29.1-1.el9.x86_64",
+            "glibc-2.34-100.el9.x86_64",
+        ])
+
+    def test_resolve_no_closure(self):
+        self.assertEqual(self.resolve(["cri-o", "conmon"], closure=False),
+                         ["conmon-2:2.1.10-1.el9.x86_64", "cri-o-1.29.1-1.el9.x86_64"])
+
+    def test_resolve_arch(self):
+        """ only packages of the arch or noarch are installable """
+        self.assertEqual(self.resolve(["skopeo"], arch="aarch64"), ["skopeo-2:1.14.2-1.el9.noarch"])
+        with self.assertRaisesRegex(ValueError, "No package cri-o available"):
+            self.resolve(["cri-o"], arch="aarch64")
+
+    def test_resolve_excludes(self):
+        """ excluded packages are neither selected nor used to resolve requirements """
+        with self.assertLogs(repodata.LOGGER, "WARNING") as logs:
+            resolved = self.resolve(["cri-o"], excludes={"fixture": ["conmon", "bash.x86_64"]})
+        self.assertEqual(resolved, ["cri-o-1.29.1-1.el9.x86_64", "glibc-2.34-100.el9.x86_64"])
+        self.assertEqual(logs.output, [
+            "WARNING:repodata:Nothing provides conmon needed by cri-o-1.29.1-1.el9.x86_64",
+            "WARNING:repodata:Nothing provides /bin/sh needed by cri-o-1.29.1-1.el9.x86_64",
+        ])
+        with self.assertRaisesRegex(ValueError, "No package conmon available"):
+            self.resolve(["conmon"], excludes={"fixture": ["con*"]})
+
+    def test_resolve_one_version(self):
+        """ only one version of each name.arch is selected, even if another one provides a requirement """
+        with self.assertLogs(repodata.LOGGER, "WARNING") as logs:
+            resolved = self.resolve(["criu"])
+        self.assertEqual(resolved, ["criu-3.19-1.el9.x86_64", "criu-libs-3.19-1.el9.x86_64"])
+        self.assertEqual(logs.output, [
+            "WARNING:repodata:libcriu.so.1()(64bit) needed by criu-3.19-1.el9.x86_64 is only provided by other "
+            "versions of selected packages",
+        ])
+
+    def test_resolve_missing_provider(self):
+        """ requirements nothing provides are skipped """
+        with self.assertLogs(repodata.LOGGER, "WARNING") as logs:
+            resolved = self.resolve(["runc"])
+        self.assertEqual(resolved, ["criu-libs-3.19-1.el9.x86_64", "runc-4:1.1.12-1.el9.x86_64"])
+        self.assertEqual(logs.output, [
+            "WARNING:repodata:Nothing provides libseccomp.so.2()(64bit) needed by runc-4:1.1.12-1.el9.x86_64",
+        ])
+
+    def test_url(self):
+        resolver = Resolver([self.index], "x86_64")
+        cri_o = resolver.resolve(["cri-o"], closure=False)[0]
+        self.assertEqual(resolver.url(cri_o), f"{FIXTURE_REPO.as_uri()}/Packages/c/cri-o-1.29.1-1.el9.x86_64.rpm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Verify downloaded RPMs before they are published.
+
+An RPM is a lead, a signature header and a header followed by the payload.
+The signature header holds a digest of the header, and the header a digest of
+the payload, so a truncated or corrupted file fails at least one of them. The
+whole file is also checked against the checksum the repodata gives for it.
+Files are memory-mapped, so that hashing does not copy them around, and
+verify_rpm is meant to be run for many files in a process pool.
+"""
+
+import hashlib
+import mmap
+import struct
+from typing import Dict, Optional, Tuple
+
+LEAD_SIZE = 96
+LEAD_MAGIC = b"\xed\xab\xee\xdb"
+HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+
+# signature header tags
+SIGTAG_SIZE = 1000
+SIGTAG_MD5 = 1004
+SIGTAG_SHA1 = 269
+SIGTAG_SHA256 = 273
+SIGTAG_LONGSIZE = 270
+
+# header tags
+RPMTAG_PAYLOADDIGEST = 5092
+RPMTAG_PAYLOADDIGESTALGO = 5093
+
+# OpenPGP hash algorithm ids used by rpm
+HASH_ALGORITHMS = {1: "md5", 2: "sha1", 8: "sha256", 9: "sha384", 10: "sha512", 11: "sha224"}
+
+TYPE_INT32 = 4
+TYPE_INT64 = 5
+TYPE_STRING = 6
+TYPE_BIN = 7
+TYPE_STRING_ARRAY = 8
+
+
+class VerificationError(Exception):
+    def __init__(self, path: str, reason: str):
+        super().__init__(path, reason)
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return f"{self.path}: {self.reason}"
+
+
+def _read_header(data: mmap.mmap, offset: int, path: str) -> Tuple[Dict[int, object], int]:
+    """ Parse the header structure at offset
+
+    :return: the values of its tags and the offset of its end
+    """
+    if data[offset:offset + 4] != HEADER_MAGIC:
+        raise VerificationError(path, f"no header at offset {offset}")
+    if offset + 16 > len(data):
+        raise VerificationError(path, "truncated header")
+    count, size = struct.unpack(">II", data[offset + 8:offset + 16])
+    store = offset + 16 + 16 * count
+    end = store + size
+    if end > len(data):
+        raise VerificationError(path, "truncated header")
+    tags = {}
+    for i in range(count):
+        tag, tag_type, tag_offset, tag_count = struct.unpack(">IIII", data[offset + 16 + 16 * i:offset + 32 + 16 * i])
+        start = store + tag_offset
+        if tag_type == TYPE_INT32:
+            tags[tag] = struct.unpack(f">{tag_count}I", data[start:start + 4 * tag_count])
+        elif tag_type == TYPE_INT64:
+            tags[tag] = struct.unpack(f">{tag_count}Q", data[start:start + 8 * tag_count])
+        elif tag_type == TYPE_BIN:
+            tags[tag] = bytes(data[start:start + tag_count])
+        elif tag_type in (TYPE_STRING, TYPE_STRING_ARRAY):
+            values = []
+            for _ in range(tag_count):
+                stop = data.find(b"\0", start, end)
+                values.append(data[start:stop].decode())
+                start = stop + 1
+            tags[tag] = values
+    return tags, end
+
+
+def _digest(algorithm: str, data: mmap.mmap, start: int = 0, end: Optional[int] = None) -> str:
+    """ Hash data[start:end] without copying it """
+    digest = hashlib.new(algorithm)
+    with memoryview(data) as view, view[start:end] as part:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def verify_rpm(path: str, checksum_type: Optional[str] = None, checksum: Optional[str] = None) -> int:
+    """ Check the header and payload digests of the RPM at path, and its checksum if given
+
+    :return: the size of the file
+    :raise VerificationError: if any of them does not match
+    """
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise VerificationError(path, "empty file")
+    with data:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        if len(data) < LEAD_SIZE or data[:4] != LEAD_MAGIC:
+            raise VerificationError(path, "not an RPM")
+        signature, signature_end = _read_header(data, LEAD_SIZE, path)
+        # the signature header is padded to 8 bytes
+        header_start = signature_end + (8 - signature_end % 8) % 8
+        header, payload_start = _read_header(data, header_start, path)
+
+        size = (signature.get(SIGTAG_LONGSIZE) or signature.get(SIGTAG_SIZE) or (None,))[0]
+        if size is not None and size != len(data) - header_start:
+            raise VerificationError(path, f"size is {len(data) - header_start} instead of {size}")
+
+        if SIGTAG_SHA256 in signature:
+            if _digest("sha256", data, header_start, payload_start) != signature[SIGTAG_SHA256][0]:
+                raise VerificationError(path, "header SHA256 digest mismatch")
+        elif SIGTAG_SHA1 in signature:
+            if _digest("sha1", data, header_start, payload_start) != signature[SIGTAG_SHA1][0]:
+                raise VerificationError(path, "header SHA1 digest mismatch")
+
+        if RPMTAG_PAYLOADDIGEST in header:
+            algorithm = HASH_ALGORITHMS.get((header.get(RPMTAG_PAYLOADDIGESTALGO) or (8,))[0], "sha256")
+            if _digest(algorithm, data, payload_start) != header[RPMTAG_PAYLOADDIGEST][0]:
+                raise VerificationError(path, "payload digest mismatch")
+        elif SIGTAG_MD5 in signature:
+            # RPMs predating payload digests only have an MD5 of the header and payload
+            if _digest("md5", data, header_start) != signature[SIGTAG_MD5].hex():
+                raise VerificationError(path, "header and payload MD5 digest mismatch")
+
+        if checksum:
+            if _digest("sha1" if checksum_type == "sha" else checksum_type, data) != checksum:
+                raise VerificationError(path, f"{checksum_type} checksum does not match the repodata")
+        return len(data)
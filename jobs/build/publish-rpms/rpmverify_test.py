@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import hashlib
+import struct
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+
+import rpmverify
+from rpmverify import VerificationError, verify_rpm
+
+
+def make_header(entries) -> bytes:
+    """ A header structure with entries [(tag, type, count, data)] """
+    index = store = b""
+    for tag, tag_type, count, data in entries:
+        if tag_type == rpmverify.TYPE_INT32:
+            store += b"\0" * ((4 - len(store) % 4) % 4)
+        index += struct.pack(">IIII", tag, tag_type, len(store), count)
+        store += data
+    return rpmverify.HEADER_MAGIC + b"\0" * 4 + struct.pack(">II", len(entries), len(store)) + index + store
+
+
+def make_rpm(name: str, payload: bytes = b"payload") -> bytes:
+    """ A minimal RPM: a lead, a signature header with the SHA256 of the header and the size, and a header with the
+    SHA256 of the payload """
+    header = make_header([
+        (1000, rpmverify.TYPE_STRING, 1, name.encode() + b"\0"),
+        (rpmverify.RPMTAG_PAYLOADDIGEST, rpmverify.TYPE_STRING_ARRAY, 1,
+         hashlib.sha256(payload).hexdigest().encode() + b"\0"),
+        (rpmverify.RPMTAG_PAYLOADDIGESTALGO, rpmverify.TYPE_INT32, 1, struct.pack(">I", 8)),
+    ])
+    signature = make_header([
+        (rpmverify.SIGTAG_SHA256, rpmverify.TYPE_STRING, 1, hashlib.sha256(header).hexdigest().encode() + b"\0"),
+        (rpmverify.SIGTAG_SIZE, rpmverify.TYPE_INT32, 1, struct.pack(">I", len(header) + len(payload))),
+    ])
+    signature += b"\0" * ((8 - len(signature) % 8) % 8)
+    return rpmverify.LEAD_MAGIC + b"\0" * (rpmverify.LEAD_SIZE - 4) + signature + header + payload
+
+
+class TestVerifyRpm(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rpm = make_rpm("criu-3.19-1.el9.x86_64")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, data: bytes) -> str:
+        path = Path(self.tmp.name, "criu-3.19-1.el9.x86_64.rpm")
+        path.write_bytes(data)
+        return str(path)
+
+    def assertInvalid(self, data: bytes, reason: str, *args):
+        path = self.write(data)
+        with self.assertRaises(VerificationError) as context:
+            verify_rpm(path, *args)
+        self.assertEqual(context.exception.path, path)
+        self.assertRegex(context.exception.reason, reason)
+
+    def test_valid(self):
+        self.assertEqual(verify_rpm(self.write(self.rpm)), len(self.rpm))
+        self.assertEqual(verify_rpm(self.write(self.rpm), "sha256", hashlib.sha256(self.rpm).hexdigest()),
+                         len(self.rpm))
+        self.assertEqual(verify_rpm(self.write(self.rpm), "sha", hashlib.sha1(self.rpm).hexdigest()), len(self.rpm))
+
+    def test_not_an_rpm(self):
+        self.assertInvalid(b"", "empty file")
+        self.assertInvalid(self.rpm[:50], "not an RPM")
+        self.assertInvalid(b"<html>" + self.rpm[6:], "not an RPM")
+
+    def test_truncated_header(self):
+        """ files cut in the preamble, index or store of a header """
+        signature_start = rpmverify.LEAD_SIZE
+        for end in (signature_start, signature_start + 6, signature_start + 20, signature_start + 40):
+            with self.subTest(end=end):
+                self.assertInvalid(self.rpm[:end], "truncated header|no header")
+        self.assertInvalid(self.rpm[:signature_start + 6], "^truncated header$")
+
+    def test_truncated_payload(self):
+        self.assertInvalid(self.rpm[:-1], "size is")
+
+    def test_size_mismatch(self):
+        self.assertInvalid(self.rpm + b"\0", "size is .* instead of")
+
+    def test_header_digest_mismatch(self):
+        corrupted = self.rpm.replace(b"criu-3.19", b"criu-3.18")
+        self.assertInvalid(corrupted, "header SHA256 digest mismatch")
+
+    def test_payload_digest_mismatch(self):
+        self.assertInvalid(self.rpm[:-1] + b"X", "payload digest mismatch")
+
+    def test_checksum_mismatch(self):
+        self.assertInvalid(self.rpm, "sha256 checksum does not match the repodata", "sha256", "0" * 64)
+
+
+if __name__ == "__main__":
+    main()
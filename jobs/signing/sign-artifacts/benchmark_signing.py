@@ -0,0 +1,252 @@
+#!/usr/bin/env python2
+"""Measure the signing round trip of umb_producer against a fake robosignatory.
+
+AMQProducer and AMQConsumer are replaced with an in-process bus: every
+request sent gets its reply after --delay (plus up to --jitter) seconds, and
+can be accompanied by stale replies and replies to other requests, like on
+the real consumer queue. The latency of a request is the time from its send
+until its signature was written (bus mode) or handed back (service mode).
+Nothing connects to UMB, and rhmsg does not need to be installed.
+
+    ./benchmark_signing.py --delay 0.5 --foreign 2 --sizes 1,10,100
+"""
+import base64
+import contextlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    import rhmsg.activemq.producer  # noqa: F401
+    import rhmsg.activemq.consumer  # noqa: F401
+except ImportError:
+    # umb_producer imports these at load time, they are replaced below anyway
+    for name in ("rhmsg", "rhmsg.activemq", "rhmsg.activemq.producer", "rhmsg.activemq.consumer"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["rhmsg.activemq.producer"].AMQProducer = None
+    sys.modules["rhmsg.activemq.consumer"].AMQConsumer = None
+
+import click
+
+import umb_producer
+
+
+class FakeMessage(object):
+    def __init__(self, body):
+        self.body = body
+
+
+class FakeBus(object):
+    """The signing topic, robosignatory and the queue of its replies"""
+
+    def __init__(self, delay, jitter=0.0, stale=0, foreign=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.stale = stale
+        self.foreign = foreign
+        self.replies = queue.Queue()
+        self.sent = {}
+        self.released = 0
+
+    def _reply(self, request_id, timestamp=None):
+        self.replies.put(json.dumps({
+            "timestamp": timestamp or time.time(),
+            "msg": {
+                "request_id": request_id,
+                "signing_status": "success",
+                "signed_artifact": base64.b64encode(request_id.encode()).decode(),
+            },
+        }))
+
+    def sign(self, body):
+        request_id = json.loads(body)["request_id"]
+        self.sent[request_id] = time.time()
+        for _ in range(self.stale):
+            self._reply(str(uuid.uuid4()), time.time() - 3 * 3600)
+        for _ in range(self.foreign):
+            self._reply(str(uuid.uuid4()))
+        timer = threading.Timer(self.delay + random.uniform(0, self.jitter), self._reply, args=(request_id,))
+        timer.daemon = True
+        timer.start()
+
+    def producer(self, **kwargs):
+        bus = self
+
+        class FakeProducer(object):
+            def send_msgs(self, messages):
+                for _, body in messages:
+                    bus.sign(body)
+
+            def send_msg(self, props, body):
+                self.send_msgs([(props, body)])
+
+        return FakeProducer()
+
+    def consumer(self, **kwargs):
+        bus = self
+
+        class FakeConsumer(object):
+            def consume(self, address, callback, data=None, selector=None, auto_accept=True,
+                        subscription_name=None):
+                while True:
+                    body = bus.replies.get()
+                    result, accept = callback(FakeMessage(body), data)
+                    if not accept:
+                        # delivered to the consumer waiting for it instead
+                        bus.released += 1
+                    if result is not None:
+                        return result
+
+        return FakeConsumer()
+
+
+def build_messages(count, out_dir):
+    messages = []
+    for i in range(count):
+        request_id = "benchmark-{}-{}".format(count, i)
+        message = {
+            "artifact": base64.b64encode(request_id.encode()).decode(),
+            "artifact_meta": {
+                "product": "openshift",
+                "release_name": "4.0.0",
+                "name": request_id,
+                "type": "json-digest",
+            },
+            "request_id": request_id,
+            "requestor": "benchmark",
+            "sig_keyname": "test",
+        }
+        messages.append((request_id, json.dumps(message), os.path.join(out_dir, request_id)))
+    return messages
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def run_bus(messages, timeout):
+    """All the requests in one request_signatures call, like the batch command"""
+    done = {}
+    write_signature = umb_producer.write_signature
+
+    def timed_write_signature(signed_artifact, out_file):
+        write_signature(signed_artifact, out_file)
+        done[os.path.basename(out_file)] = time.time()
+
+    umb_producer.write_signature = timed_write_signature
+    try:
+        failed = umb_producer.request_signatures("stage", "cert", "key", "ca", messages, timeout)
+    finally:
+        umb_producer.write_signature = write_signature
+    return done, len(failed)
+
+
+def run_service(messages, timeout):
+    """One caller thread per request, going through a signing service"""
+    service = umb_producer.SigningService("stage", "cert", "key", "ca", timeout)
+    service.start()
+    done = {}
+    failed = []
+
+    def sign(to_send):
+        request = service.sign(json.loads(to_send))
+        if request.error:
+            failed.append(request)
+        else:
+            done[request.request_id] = time.time()
+
+    threads = [threading.Thread(target=sign, args=(to_send,)) for _, to_send, _ in messages]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return done, len(failed)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    # nearest rank
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option("--mode", type=click.Choice(["bus", "service"]), default="bus", show_default=True,
+              help="bus: one request_signatures call for all requests, service: concurrent callers of a "
+              "signing service")
+@click.option("--sizes", default="1,10,100", show_default=True, help="Numbers of concurrent requests to run")
+@click.option("--delay", type=float, default=0.5, show_default=True,
+              help="Seconds robosignatory takes to reply")
+@click.option("--jitter", type=float, default=0.0, show_default=True,
+              help="Up to this many seconds added to each reply delay")
+@click.option("--stale", type=int, default=0, show_default=True,
+              help="Stale replies on the queue for each request sent")
+@click.option("--foreign", type=int, default=0, show_default=True,
+              help="Replies to other requests on the queue for each request sent")
+@click.option("--timeout", type=int, default=60, show_default=True, help="Fail requests taking longer than this")
+@click.option("--json", "as_json", is_flag=True, help="Print the results as JSON")
+@click.option("--verbose", is_flag=True, help="Show the output of umb_producer")
+def main(mode, sizes, delay, jitter, stale, foreign, timeout, as_json, verbose):
+    results = []
+    for size in [int(s) for s in sizes.split(",")]:
+        bus = FakeBus(delay, jitter, stale, foreign)
+        umb_producer.AMQProducer = bus.producer
+        umb_producer.AMQConsumer = bus.consumer
+        # every broker is as fast, and probing must not reach out to the real ones
+        umb_producer.probe_broker = lambda url, *args, **kwargs: 0.0
+        out_dir = tempfile.mkdtemp(prefix="benchmark-signing-")
+        try:
+            messages = build_messages(size, out_dir)
+            start = time.time()
+            with quiet(verbose):
+                done, failed = (run_bus if mode == "bus" else run_service)(messages, timeout)
+            end = time.time()
+        finally:
+            shutil.rmtree(out_dir)
+        latencies = [done[request_id] - bus.sent[request_id] for request_id in done]
+        results.append({
+            "mode": mode,
+            "requests": size,
+            "failed": failed,
+            "p50": round(percentile(latencies, 50), 4) if latencies else None,
+            "p95": round(percentile(latencies, 95), 4) if latencies else None,
+            "max": round(max(latencies), 4) if latencies else None,
+            "wall": round(end - start, 4),
+            "throughput": round(len(done) / (end - start), 2),
+            "released": bus.released,
+        })
+
+    if as_json:
+        print(json.dumps(results, indent=4))
+        return
+    row = "{mode:<8} {requests:>8} {failed:>6} {p50:>8} {p95:>8} {max:>8} {wall:>8} {throughput:>10} {released:>8}"
+    print(row.format(mode="mode", requests="requests", failed="failed", p50="p50", p95="p95", max="max",
+                     wall="wall", throughput="req/s", released="released"))
+    for result in results:
+        print(row.format(**dict((key, "-" if value is None else value) for key, value in result.items())))
+
+
+if __name__ == '__main__':
+    main()
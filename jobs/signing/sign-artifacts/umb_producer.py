@@ -1,12 +1,30 @@
 #!/usr/bin/env python2
 import base64
-from datetime import datetime, timedelta
+import collections
+import hashlib
 import json
 import logging
+import os
+import re
+import shutil
 import ssl
+import heapq
+import socket
 import subprocess
 import sys
 import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPException
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    import queue
+except ImportError:  # Python 2
+    from httplib import HTTPConnection, HTTPException
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    import Queue as queue
 
 import click
 import requests
@@ -59,6 +77,9 @@ SIGN_REQUEST_MESSAGE_FIELDS = [
     "sig_keyname",
 ]
 
+# The keys robosignatory may be asked to sign with
+SIG_KEYNAMES = ['test', 'redhatrelease2', 'beta2']
+
 ART_CONSUMER = 'Consumer.openshift-art-signatory.{env}.VirtualTopic.eng.robosignatory.art.sign'
 
 
@@ -91,7 +112,7 @@ request_id = click.option("--request-id", required=True, metavar="BUILDURL",
                           help="Unique build job identifier for this signing request, "
                           "use the job URL from Jenkins: $env.BUILD_URL")
 sig_keyname = click.option("--sig-keyname", required=True,
-                           type=click.Choice(['test', 'redhatrelease2', 'beta2']),
+                           type=click.Choice(SIG_KEYNAMES),
                            help="Name of the key to have sign our request")
 release_name_opt = click.option("--release-name", required=True, metavar="SEMVER",
                             help="Numerical name of this release, for example: 4.1.0-rc.10")
@@ -121,8 +142,18 @@ ca_certs = click.option("--ca-certs", type=click.Path(exists=True),
 digest = click.option("--digest", metavar="DIGEST", help="Pass the digest that should be signed")
 
 # ---------------------------------------------------------------------
-
-env_value = None  # Will be set to value of click_env_obj parameter
+timeout_opt = click.option("--timeout", type=int, default=None, metavar="SECONDS",
+                           help="Fail if a signature did not come back after this long")
+signature_cache_opt = click.option("--signature-cache", metavar="DIR", type=click.Path(file_okay=False),
+                                   envvar="UMB_SIGNATURE_CACHE",
+                                   help="Reuse the signatures stored there for artifacts already signed "
+                                   "with the same key, and store the new ones")
+digest_cache_opt = click.option("--digest-cache", metavar="DIR", type=click.Path(file_okay=False),
+                                envvar="UMB_DIGEST_CACHE",
+                                help="Keep the digests of release images looked up there for a few minutes")
+daemon_opt = click.option("--daemon", metavar="SOCKET",
+                          help="Request signatures through the signing service listening "
+                          "there (see the serve command) instead of connecting to the bus")
 
 
 @click.group(context_settings=context_settings)
@@ -141,25 +172,6 @@ the global context (before the sub-command).
 
 ######################################################################
 # Helpers
-def get_digest_base64(location):
-    """Download the sha256sum.txt message digest file at the given
-`location`.
-
-    :return: A `string` of the base64-encoded message digest
-"""
-    res = requests.get(location,
-                       verify=ssl.get_default_verify_paths().openssl_cafile)
-    if res.status_code == 200:
-        # b64encode needs a bytes type input, use the dedicated
-        # 'encode' method to turn str=>bytes. The result of
-        # `b64encode` is a bytes type. Later when we go to serialize
-        # this with json it needs to be a str type so we will decode
-        # the bytes=>str now.
-        return base64.b64encode(res.text.encode()).decode()
-    else:
-        raise(Exception(res.reason))
-
-
 def presend_validation(message):
     """Verify the message we want to send over the bus has all the
 required fields
@@ -181,131 +193,278 @@ call
     return json.loads(image_info_raw)
 
 
-def get_bus_producer(env, certificate, private_key, trusted_certificates):
-    """This is just a wrapper around creating a producer. We're going to
-need this in multiple places so we want to ensure we do it the
-same way each time.
+def oc_manifest_list(pullspec):
+    """Get the digests of the manifest list at the given `pullspec` and
+of the manifests in it with 'oc image info', which uses the registry
+credentials of the job
+
+    :return: the digest of the manifest list and the digests of its
+manifests, none if it is a manifest
     """
-    return AMQProducer(urls=URLS[env or 'stage'],
-                       certificate=certificate,
-                       private_key=private_key,
-                       trusted_certificates=trusted_certificates,
-                       topic=TOPIC)
+    image_info = json.loads(subprocess.check_output(
+        ['oc', 'image', 'info', '--show-multiarch', '-o', 'json', pullspec]))
+    if isinstance(image_info, dict):
+        return image_info['digest'], []
+    return image_info[0]['listDigest'], [info['digest'] for info in image_info
+                                         if info.get('config', {}).get('architecture') != 'unknown']
 
 
-def producer_thread(producer, args):
-    print(args)
-    producer.send_msg(*args)
+def concurrently(function, items, workers=8):
+    """Call `function` on each of `items` from up to `workers` threads
 
+    :return: a dict of the result for each item
+    :raise: the first exception raised by `function`
+    """
+    items = list(items)
+    todo = queue.Queue()
+    for item in items:
+        todo.put(item)
+    results = {}
+    errors = []
 
-def producer_send_msg(producer, *args):
-    t = threading.Thread(target=producer_thread, args=(producer, args))
-    t.start()
-    t.join()
+    def work():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[item] = function(item)
+            except Exception as e:
+                errors.append(e)
 
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
 
-def get_bus_consumer(env, certificate, private_key, trusted_certificates):
-    """This is just a wrapper around creating a consumer. We're going to
-do need this in multiple places though, so we want to ensure we do it
-the same way each time.
+
+class DigestResolver(object):
+    """Look up what gets signed: the sha256sum.txt files on the mirror and
+the digests of release images.
+
+Every lookup goes through one pooled requests session, and `prefetch` runs
+them concurrently, so signing many arches or releases costs about one
+round trip. Image digests come from a HEAD of the manifest on the registry,
+with an anonymous pull token when it asks for one, instead of spawning
+`oc image info`, which is only used when that fails, e.g. for private
+repositories, as for manifest lists. Digests are stored for
+`ttl` seconds in `cache_dir` if given. `registry_urls` overrides the base
+URL of registries, e.g. {"quay.io": "http://127.0.0.1:5000"} to resolve
+against a local stand-in.
     """
-    return AMQConsumer(urls=URLS[env or 'stage'], certificate=certificate,
-                       private_key=private_key, trusted_certificates=trusted_certificates)
 
+    MANIFEST_TYPES = ", ".join([
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+    ])
 
-def art_consumer_callback(msg, data):
-    """`msg` is a `Message` object which has various attributes. Such as `body`.
+    def __init__(self, cache_dir=None, ttl=300, registry_urls=None, session=None, workers=8):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.registry_urls = registry_urls or {}
+        self.workers = workers
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.verify = ssl.get_default_verify_paths().openssl_cafile
+        self.session = session
+        self.lock = threading.Lock()
+        self.sha256sums = {}
+        self.digests = {}
+        self.tokens = {}
 
-    `data` user data
-    """
-    print(msg)
-    body = json.loads(msg.body)
-    print(json.dumps(body, indent=4))
-    if body['msg']['request_id'] != data["request_id"]:
-        print("Expecting request_id {}, but got {}".format(data['request_id'], body['msg']['request_id']))
-        if (datetime.utcnow() - datetime.utcfromtimestamp(body["timestamp"])) >= timedelta(hours=2):
-            print("Pop stale message {} off the bus.".format(data['request_id']))
-            return None, True
-        return None, False  # this received message doesn't match our request id; ignore it and continue receiving messages
-    if body['msg']['signing_status'] != 'success':
-        return IOError("ERROR: robosignatory failed to sign artifact"), True
-    else:
-        # example: https://datagrepper.stage.engineering.redhat.com/id?id=2019-0304004b-d1e6-4e03-b28d-cfa1e5f59948&is_raw=true&size=extra-large
-        result = body['msg']['signed_artifact']
-        out_file = body['msg']['artifact_meta']['name']
-        with open(out_file, 'w') as fp:
-            fp.write(base64.decodestring(result))
-            fp.flush()
-        print("Wrote {} to disk".format(body['msg']['artifact_meta']['name']))
-        return True, True
-
-
-def consumer_thread(consumer, request_id):
-    global env_value
-    if not env_value:
-        raise ValueError('env_value has not been set yet.')
-    result = consumer.consume(ART_CONSUMER.format(env=env_value), art_consumer_callback, data={"request_id": request_id}, auto_accept=False)
-    if isinstance(result, IOError):
-        print(str(result))
-        exit(1)
+    def prefetch(self, urls=(), pullspecs=()):
+        """Look up all of `urls` and `pullspecs` at once"""
+        jobs = [(self.sha256sum_base64, url) for url in set(urls)]
+        jobs += [(self.image_digest, pullspec) for pullspec in set(pullspecs)]
+        concurrently(lambda job: job[0](job[1]), jobs, self.workers)
 
-def consumer_start(consumer, request_id):
-    t = threading.Thread(target=consumer_thread, args=(consumer, request_id))
-    t.start()
-    return t
+    def sha256sum_base64(self, url):
+        """Download the sha256sum.txt message digest file at `url`
 
+        :return: A `string` of the base64-encoded message digest
+        """
+        with self.lock:
+            if url in self.sha256sums:
+                return self.sha256sums[url]
+        res = self.session.get(url, timeout=60)
+        if res.status_code != 200:
+            raise Exception(res.reason)
+        # b64encode needs a bytes type input, use the dedicated
+        # 'encode' method to turn str=>bytes. The result of
+        # `b64encode` is a bytes type. Later when we go to serialize
+        # this with json it needs to be a str type so we will decode
+        # the bytes=>str now.
+        artifact = base64.b64encode(res.text.encode()).decode()
+        with self.lock:
+            self.sha256sums[url] = artifact
+        return artifact
 
-def get_producer_consumer(env, certificate, private_key, trusted_certificates):
-    producer = get_bus_producer(env, certificate, private_key, trusted_certificates)
-    consumer = get_bus_consumer(env, certificate, private_key, trusted_certificates)
-    return (producer, consumer)
+    def image_digest(self, pullspec):
+        """:return: the digest of the manifest (list) `pullspec` points to"""
+        if "@" in pullspec:
+            return pullspec.split("@", 1)[1]
+        with self.lock:
+            if pullspec in self.digests:
+                return self.digests[pullspec]
+        digest = self._cached_digest(pullspec)
+        if digest is None:
+            try:
+                digest = self._registry_digest(pullspec)
+            except (requests.RequestException, IOError, KeyError, ValueError) as e:
+                print("Could not get the digest of {} from the registry ({}), using oc".format(pullspec, e))
+                digest = oc_image_info(pullspec)['digest']
+            self._cache_digest(pullspec, digest)
+        with self.lock:
+            self.digests[pullspec] = digest
+        return digest
 
+    def _registry_request(self, method, pullspec):
+        """Request the manifest `pullspec` points to, by tag or digest"""
+        name, reference = pullspec.split("@", 1) if "@" in pullspec else pullspec.rsplit(":", 1)
+        registry, repository = name.split("/", 1)
+        url = "{}/v2/{}/manifests/{}".format(
+            self.registry_urls.get(registry, "https://" + registry), repository, reference)
+        headers = {"Accept": self.MANIFEST_TYPES}
+        with self.lock:
+            token = self.tokens.get((registry, repository))
+        if token:
+            headers["Authorization"] = token
+        res = self.session.request(method, url, headers=headers, timeout=30, allow_redirects=True)
+        if res.status_code == 401:
+            token = self._token(res, repository)
+            with self.lock:
+                self.tokens[(registry, repository)] = token
+            headers["Authorization"] = token
+            res = self.session.request(method, url, headers=headers, timeout=30, allow_redirects=True)
+        res.raise_for_status()
+        return res
 
-######################################################################
-@cli.command("message-digest", short_help="Sign a sha256sum.txt file")
-@requestor
-@product
-@request_id
-@sig_keyname
-@release_name_opt
-@client_cert
-@client_key
-@client_type
-@env_click_obj
-@noop
-@ca_certs
-@arch_opt
-@click.pass_context
-def message_digest(ctx, requestor, product, request_id, sig_keyname,
-                   release_name, client_cert, client_key, client_type, env, noop,
-                   ca_certs, arch):
-    """Sign a 'message digest'. These are sha256sum.txt files produced by
-the 'sha256sum` command (hence the strange command name). In the ART
-world, this is for signing message digests from extracting OpenShift
-tools, as well as RHCOS bare-betal message digests.
-"""
-    global env_value
-    env_value = env
+    def _registry_digest(self, pullspec):
+        res = self._registry_request("HEAD", pullspec)
+        digest = res.headers.get("Docker-Content-Digest")
+        if not digest:
+            # the digest is the hash of the manifest, as served
+            res = self._registry_request("GET", pullspec)
+            digest = "sha256:" + hashlib.sha256(res.content).hexdigest()
+        return digest
+
+    def manifest_list(self, pullspec):
+        """:return: the digest of the manifest list `pullspec` points to, and
+        the digests of the manifests it lists, none if it is a manifest
+        """
+        try:
+            res = self._registry_request("GET", pullspec)
+            digest = res.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(res.content).hexdigest()
+            children = [manifest["digest"] for manifest in res.json().get("manifests", [])
+                        # attestations are listed as manifests for an unknown platform
+                        if manifest.get("platform", {}).get("architecture") != "unknown"]
+        except (requests.RequestException, IOError, KeyError, ValueError) as e:
+            # e.g. the private nightly repo, which needs the credentials of the job
+            print("Could not get the manifest list {} from the registry ({}), using oc".format(pullspec, e))
+            digest, children = oc_manifest_list(pullspec)
+        return digest, children
 
+    def _token(self, response, repository):
+        """Get a pull token from the auth server a 401 `response` points to"""
+        challenge = response.headers.get("WWW-Authenticate", "")
+        if not challenge.lower().startswith("bearer "):
+            raise IOError("Unsupported registry authentication: {}".format(challenge))
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm")
+        params.setdefault("scope", "repository:{}:pull".format(repository))
+        res = self.session.get(realm, params=params, timeout=30)
+        res.raise_for_status()
+        body = res.json()
+        return "Bearer " + (body.get("token") or body["access_token"])
+
+    def _cache_path(self, pullspec):
+        return os.path.join(self.cache_dir, hashlib.sha256(pullspec.encode()).hexdigest() + ".json")
+
+    def _cached_digest(self, pullspec):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(pullspec)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("pullspec") != pullspec or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return entry["digest"]
+
+    def _cache_digest(self, pullspec, digest):
+        if not self.cache_dir:
+            return
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by another thread meanwhile
+                pass
+        path = self._cache_path(pullspec)
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, "w") as f:
+            json.dump({"pullspec": pullspec, "digest": digest, "time": time.time()}, f)
+        os.rename(tmp, path)
+
+
+def get_bus_producer(env, certificate, private_key, trusted_certificates, urls=None):
+    """This is just a wrapper around creating a producer. We're going to
+need this in multiple places so we want to ensure we do it the
+same way each time.
+    """
+    return AMQProducer(urls=urls or URLS[env or 'stage'],
+                       certificate=certificate,
+                       private_key=private_key,
+                       trusted_certificates=trusted_certificates,
+                       topic=TOPIC)
+
+
+def message_digest_url(product, release_name, client_type, arch):
+    """:return: the URL of the sha256sum.txt of a release of `product` on the mirror"""
     if product == 'openshift':
-        artifact_url = MESSAGE_DIGESTS[product].format(
+        return MESSAGE_DIGESTS[product].format(
             arch=arch,
             release_name=release_name,
             release_stage=client_type)
     elif product == 'rhcos':
         release_parts = release_name.split('.')
-        artifact_url = MESSAGE_DIGESTS[product].format(
+        return MESSAGE_DIGESTS[product].format(
             arch=arch,
             release_name_xy='.'.join(release_parts[:2]),
             release_name=release_name)
     elif product == 'coreos-installer':
-        artifact_url = MESSAGE_DIGESTS[product].format(
+        return MESSAGE_DIGESTS[product].format(
             arch=arch,
             release_name=release_name)
+    raise ValueError("No message digest for product {}".format(product))
+
+
+def release_pullspec(release_name, client_type, arch):
+    """:return: the pullspec of the release image of `release_name`"""
+    release_stage = "ocp-release-nightly" if client_type == 'ocp-dev-preview' else "ocp-release"
+    release_tag = get_release_tag(release_name, arch)
+    return "quay.io/openshift-release-dev/{}:{}".format(release_stage, release_tag)
 
-    artifact = get_digest_base64(artifact_url)
 
-    message = {
+def build_message_digest_message(requestor, product, request_id, sig_keyname, release_name, client_type, arch,
+                                 resolver=None):
+    """Build the request to sign the sha256sum.txt of a release of `product`
+    """
+    resolver = resolver or DigestResolver()
+    artifact = resolver.sha256sum_base64(message_digest_url(product, release_name, client_type, arch))
+
+    return {
         "artifact": artifact,
         "artifact_meta": {
             "product": product,
@@ -318,56 +477,12 @@ tools, as well as RHCOS bare-betal message digests.
         "sig_keyname": sig_keyname,
     }
 
-    validated = presend_validation(message)
-    if validated is True:
-        print("Message contains all required fields")
-        to_send = json.dumps(message)
-    else:
-        print("Message missing required field: {}".format(validated))
-        exit(1)
-
-    if noop:
-        print("Message we would have sent over the bus:")
-        print(to_send)
-    else:
-        producer, consumer = get_producer_consumer(env, client_cert, client_key, ca_certs)
-        consumer_thread = consumer_start(consumer, request_id)
-        producer_send_msg(producer, {}, to_send)
-        print("Message we sent over the bus:")
-        print(to_send)
-        print("Submitted request for signing. The mirror-artifacts job should be triggered when a response is sent back")
-        print("Waiting for consumer to receive data back from request")
-        consumer_thread.join()
-
 
-######################################################################
-@cli.command("json-digest", short_help="Sign a JSON digest claim")
-@requestor
-@product
-@request_id
-@sig_keyname
-@release_name_opt
-@client_cert
-@client_key
-@client_type
-@env_click_obj
-@noop
-@ca_certs
-@digest
-@arch_opt
-@click.pass_context
-def json_digest(ctx, requestor, product, request_id, sig_keyname,
-                release_name, client_cert, client_key, client_type, env, noop,
-                ca_certs, digest, arch):
-    """Sign a 'json digest'. These are JSON blobs that associate a
-pullspec with a sha256 digest. In the ART world, this is for "signing
-payload images". After the json digest is signed we publish the
-signature in a location which follows a specific directory pattern,
-thus allowing the signature to be looked up programmatically.
+def build_json_digest_message(requestor, product, request_id, sig_keyname, release_name, client_type, arch, digest,
+                              resolver=None):
+    """Build the request to sign the JSON claim for the release image of
+`release_name`, looking up its digest if not given
     """
-    global env_value
-    env_value = env
-
     json_claim = {
         "critical": {
             "image": {
@@ -383,20 +498,18 @@ thus allowing the signature to be looked up programmatically.
         },
     }
 
-    release_stage = "ocp-release-nightly" if client_type == 'ocp-dev-preview' else "ocp-release"
-    release_tag = get_release_tag(release_name, arch)
-    pullspec = "quay.io/openshift-release-dev/{}:{}".format(release_stage, release_tag)
+    pullspec = release_pullspec(release_name, client_type, arch)
     json_claim['critical']['identity']['docker-reference'] = pullspec
 
     if not digest:
-        digest = oc_image_info(pullspec)['digest']
+        digest = (resolver or DigestResolver()).image_digest(pullspec)
 
     json_claim['critical']['image']['docker-manifest-digest'] = digest
 
     print("ARTIFACT to send for signing (WILL BE base64 encoded first):")
     print(json.dumps(json_claim, indent=4))
 
-    message = {
+    return {
         "artifact": base64.b64encode(json.dumps(json_claim).encode()).decode(),
         "artifact_meta": {
             "product": product,
@@ -409,26 +522,925 @@ thus allowing the signature to be looked up programmatically.
         "sig_keyname": sig_keyname,
     }
 
+
+def build_manifest_list_messages(requestor, product, request_id, sig_keyname, release_name, client_type, digest,
+                                 resolver=None):
+    """Build the requests to sign the JSON claims for the multi-arch release
+image of `release_name`: its manifest list, at `digest` if given, and every
+manifest in it, which is what clients verify when pulling it. The requests
+for the manifests get the request_id followed by their short digest.
+    """
+    resolver = resolver or DigestResolver()
+    # dev-preview payloads are only pushed to the nightly repo when they are nightlies
+    repo = "ocp-release-nightly" if client_type == 'ocp-dev-preview' and 'nightly' in release_name else "ocp-release"
+    pullspec = "quay.io/openshift-release-dev/{}".format(repo)
+    if digest:
+        pullspec = "{}@{}".format(pullspec, digest)
+    else:
+        pullspec = "{}:{}".format(pullspec, get_release_tag(release_name, "multi"))
+    try:
+        index, children = resolver.manifest_list(pullspec)
+    except (subprocess.CalledProcessError, OSError, IndexError, KeyError, ValueError) as e:
+        print("Could not get the manifest list {} with oc either: {}".format(pullspec, e))
+        exit(1)
+    print("Signing manifest list {} and its {} manifest(s)".format(index, len(children)))
+    messages = [build_json_digest_message(requestor, product, request_id, sig_keyname, release_name, client_type,
+                                          "multi", index, resolver)]
+    for child in children:
+        messages.append(build_json_digest_message(requestor, product,
+                                                  "{}-{}".format(request_id, child.split(":", 1)[1][:12]),
+                                                  sig_keyname, release_name, client_type, "multi", child, resolver))
+    return messages
+
+
+def serialize_message(message):
+    """Check `message` has all the required fields and serialize it,
+exiting if it does not
+    """
     validated = presend_validation(message)
     if validated is True:
         print("Message contains all required fields")
-        to_send = json.dumps(message)
+        return json.dumps(message)
     else:
         print("Message missing required field: {}".format(validated))
         exit(1)
 
+
+def write_signature(signed_artifact, out_file):
+    """Write the base64 encoded `signed_artifact` from a robosignatory
+reply to `out_file`
+    """
+    directory = os.path.dirname(out_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(out_file, 'wb') as fp:
+        fp.write(base64.b64decode(signed_artifact))
+        fp.flush()
+    print("Wrote {} to disk".format(out_file))
+
+
+def get_bus_consumer(env, certificate, private_key, trusted_certificates, urls=None):
+    """This is just a wrapper around creating a consumer. We're going to
+do need this in multiple places though, so we want to ensure we do it
+the same way each time.
+    """
+    return AMQConsumer(urls=urls or URLS[env or 'stage'], certificate=certificate,
+                       private_key=private_key, trusted_certificates=trusted_certificates)
+
+
+def probe_broker(url, certificate, private_key, trusted_certificates, timeout=5):
+    """Time connecting to the broker at `url` and completing a TLS handshake
+with it
+
+    :return: the time it took in seconds, None if it failed
+    """
+    host, port = url.split("://", 1)[1].rsplit(":", 1)
+    start = time.time()
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+        try:
+            if url.startswith("amqps://"):
+                context = ssl.create_default_context(cafile=trusted_certificates)
+                context.load_cert_chain(certificate, private_key)
+                sock = context.wrap_socket(sock, server_hostname=host)
+        finally:
+            sock.close()
+    except (IOError, OSError, ValueError) as e:
+        print("Broker {} is unreachable: {}".format(url, e))
+        return None
+    return time.time() - start
+
+
+class Brokers(object):
+    """The brokers of an env, the fastest first.
+
+`probe` times a TLS handshake with all of them at once, so that the fastest
+reachable broker is used first instead of stalling on a slow one until the
+library times out. A broker which fails is moved last, so that the next
+attempt goes to the other one right away.
+    """
+
+    def __init__(self, env, certificate, private_key, trusted_certificates, timeout=5):
+        self.urls = list(URLS[env or 'stage'])
+        self.credentials = (certificate, private_key, trusted_certificates)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def probe(self):
+        latencies = concurrently(lambda url: probe_broker(url, *(self.credentials + (self.timeout,))), self.urls)
+        with self.lock:
+            self.latencies = latencies
+            # unreachable ones are still tried, last, in case only the probe failed
+            self.urls.sort(key=lambda url: (latencies[url] is None, latencies[url] or 0))
+        print("Brokers by latency: {}".format(", ".join(
+            "{} ({})".format(url, "unreachable" if latencies[url] is None else "{:.3f}s".format(latencies[url]))
+            for url in self.urls)))
+        return self.ordered()
+
+    def ordered(self):
+        with self.lock:
+            return list(self.urls)
+
+    def demote(self, url):
+        with self.lock:
+            if url in self.urls:
+                self.urls.remove(url)
+                self.urls.append(url)
+
+    def status(self):
+        with self.lock:
+            return [{"url": url, "latency": self.latencies.get(url)} for url in self.urls]
+
+
+def send_with_failover(brokers, env, certificate, private_key, trusted_certificates, messages):
+    """Send `messages` to the first of `brokers` accepting them
+
+    :return: the url of that broker
+    """
+    errors = []
+    for url in brokers.ordered():
+        try:
+            get_bus_producer(env, certificate, private_key, trusted_certificates, [url]).send_msgs(messages)
+            return url
+        except Exception as e:
+            print("Failed to send to {}: {}".format(url, e))
+            brokers.demote(url)
+            errors.append(str(e))
+    raise IOError("Failed to send to any broker: {}".format("; ".join(errors)))
+
+
+class SigningRequest(object):
+    """A request sent to robosignatory and waiting for its reply"""
+
+    def __init__(self, request_id, out_file, deadline=None):
+        self.request_id = request_id
+        self.out_file = out_file
+        self.deadline = deadline
+        self.error = None
+        # base64 encoded, kept instead of written when there is no out_file
+        self.signature = None
+        # the url of the broker the request was sent to
+        self.broker = None
+
+
+class SigningDispatcher(object):
+    """Route the replies of robosignatory to the requests waiting for them.
+
+Any number of requests can be outstanding. Each reply is matched to its
+request by request_id with a dict lookup, and the signature written where
+the request wants it. Requests past their deadline fail with a timeout.
+Replies to other requests are released for their consumer, or popped off the
+bus if nobody consumed them for `stale_after` seconds, and only counted, so
+that draining a busy queue does not flood the log. `dispatch` works on
+parsed message bodies and `clock` can be replaced, so that the dispatcher can
+be driven without a bus. A `persistent` dispatcher keeps consuming when no
+request is pending, for requests added later.
+    """
+
+    def __init__(self, stale_after=2 * 3600, clock=time.time, persistent=False):
+        self.stale_after = stale_after
+        self.clock = clock
+        self.persistent = persistent
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.deadlines = []
+        self.finished = {}
+        # requests handed back by wait_for, whose late replies are still ours
+        self.forgotten = collections.deque(maxlen=10000)
+        self.forgotten_ids = set()
+        self.stale = 0
+        self.foreign = 0
+        self.foreign_ids = set()
+
+    def add(self, request_id, out_file, timeout=None):
+        with self.condition:
+            if request_id in self.pending:
+                raise ValueError("Request {} is already pending".format(request_id))
+            deadline = self.clock() + timeout if timeout else None
+            self.pending[request_id] = SigningRequest(request_id, out_file, deadline)
+            if deadline:
+                heapq.heappush(self.deadlines, (deadline, request_id))
+
+    def _finish(self, request, error=None):
+        """Complete a pending request, unless it already timed out"""
+        if self.pending.pop(request.request_id, None) is None:
+            return
+        request.error = error
+        self.finished[request.request_id] = request
+        self.condition.notify_all()
+
+    def sent(self, request_ids, broker):
+        with self.condition:
+            for request_id in request_ids:
+                if request_id in self.pending:
+                    self.pending[request_id].broker = broker
+
+    def fail(self, request_id, error):
+        with self.condition:
+            request = self.pending.get(request_id)
+            if request:
+                self._finish(request, error)
+
+    def fail_all(self, error):
+        """Fail every pending request, e.g. once nothing consumes their replies"""
+        with self.condition:
+            for request in list(self.pending.values()):
+                print("No signature for {}: {}".format(request.request_id, error))
+                self._finish(request, error)
+
+    def expire(self):
+        """Fail the requests past their deadline"""
+        with self.condition:
+            now = self.clock()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, request_id = heapq.heappop(self.deadlines)
+                request = self.pending.get(request_id)
+                if request:
+                    print("Timed out waiting for a signature for {}".format(request_id))
+                    self._finish(request, IOError("Timed out waiting for robosignatory"))
+
+    def dispatch(self, body):
+        """Handle one reply from robosignatory
+
+        :return: whether to accept the message, i.e. pop it off the bus
+        """
+        request_id = body['msg']['request_id']
+        with self.condition:
+            # stays pending until its signature is written
+            request = self.pending.get(request_id)
+            if request is None:
+                if request_id in self.finished or request_id in self.forgotten_ids:
+                    # redelivered, or arrived after timing out
+                    return True
+                if self.clock() - body["timestamp"] >= self.stale_after:
+                    self.stale += 1
+                    return True
+                self.foreign += 1
+                if request_id not in self.foreign_ids:
+                    self.foreign_ids.add(request_id)
+                    print("Releasing reply to request {} we are not waiting for".format(request_id))
+                return False
+        error = None
+        if body['msg']['signing_status'] != 'success':
+            error = IOError("ERROR: robosignatory failed to sign artifact")
+        else:
+            # example: https://datagrepper.stage.engineering.redhat.com/id?id=2019-0304004b-d1e6-4e03-b28d-cfa1e5f59948&is_raw=true&size=extra-large
+            try:
+                if request.out_file is None:
+                    request.signature = body['msg']['signed_artifact']
+                else:
+                    write_signature(body['msg']['signed_artifact'], request.out_file)
+            except (IOError, OSError, TypeError, ValueError) as e:
+                error = e
+        with self.condition:
+            self._finish(request, error)
+            print("Got reply to {} sent to {}, {} signature(s) still pending".format(
+                request_id, request.broker, len(self.pending)))
+        return True
+
+    def done(self):
+        with self.condition:
+            return not self.pending
+
+    def callback(self, msg, data=None):
+        """Consumer callback, consuming until no request is pending"""
+        accept = self.dispatch(json.loads(msg.body))
+        self.expire()
+        return (True if self.done() and not self.persistent else None), accept
+
+    def consume(self, consumer, env):
+        """Consume the replies of robosignatory for `env` until no request is
+        pending, and fail the requests left once the consumer stops"""
+        try:
+            consumer.consume(ART_CONSUMER.format(env=env), self.callback, auto_accept=False)
+            error = IOError("Consumer stopped before all signatures were received")
+        except Exception as e:
+            error = IOError("Consumer failed: {}".format(e))
+        # nobody else would complete them, and wait() would block forever
+        # without a timeout
+        self.fail_all(error)
+
+    def start(self, consumer, env):
+        """Consume the replies of robosignatory for `env` in the background"""
+        t = threading.Thread(target=self.consume, args=(consumer, env))
+        # the consumer blocks while no message arrives, and must not keep us
+        # from exiting once every request timed out
+        t.daemon = True
+        t.start()
+        return t
+
+    def wait(self):
+        """Block until every request got its reply or timed out
+
+        :return: the requests which failed
+        """
+        with self.condition:
+            while self.pending:
+                timeout = 1.0
+                if self.deadlines:
+                    timeout = min(timeout, max(self.deadlines[0][0] - self.clock(), 0))
+                self.condition.wait(timeout)
+                self.expire()
+            if self.stale or self.foreign:
+                print("Popped {} stale message(s) and released {} for other requests".format(
+                    self.stale, self.foreign))
+            return [request for request in self.finished.values() if request.error]
+
+    def wait_for(self, request_id):
+        """Block until the request got its reply or timed out, and forget it
+
+        :return: the completed request
+        """
+        with self.condition:
+            while request_id not in self.finished:
+                self.condition.wait(1.0)
+                self.expire()
+            if len(self.forgotten) == self.forgotten.maxlen:
+                self.forgotten_ids.discard(self.forgotten[0])
+            self.forgotten.append(request_id)
+            self.forgotten_ids.add(request_id)
+            return self.finished.pop(request_id)
+
+
+class SignatureCache(object):
+    """Signatures already received from robosignatory, stored by what was
+signed: the sha256 of the artifact, the key and the type of signature. The
+same sha256sum.txt or JSON claim signed again, e.g. when retrying a
+promotion, gets the stored signature without a bus round trip. Stage and
+prod keys differ, so each env has its own store.
+    """
+
+    def __init__(self, directory, env):
+        self.directory = os.path.join(directory, env or 'stage')
+
+    def path(self, message):
+        digest = hashlib.sha256(base64.b64decode(message["artifact"])).hexdigest()
+        return os.path.join(self.directory, message["sig_keyname"], message["artifact_meta"]["type"],
+                            digest[:2], digest)
+
+    def get(self, message, out_file):
+        """Write the stored signature of `message` to `out_file`
+
+        :return: whether there was one
+        """
+        path = self.path(message)
+        if not os.path.isfile(path):
+            print("Signature cache miss for {}".format(message["request_id"]))
+            return False
+        print("Signature cache hit for {}: {}".format(message["request_id"], path))
+        directory = os.path.dirname(out_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copyfile(path, out_file)
+        print("Wrote {} to disk".format(out_file))
+        return True
+
+    def put(self, message, out_file):
+        path = self.path(message)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # readers only ever see complete signatures
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        shutil.copyfile(out_file, tmp)
+        os.rename(tmp, path)
+
+
+def request_signatures(env, client_cert, client_key, ca_certs, messages, timeout=None, daemon=None,
+                       signature_cache=None):
+    """Get the signatures of the serialized `messages`, from the
+`signature_cache` directory if they were already signed, else from
+robosignatory directly or through the signing service at `daemon`
+
+    :param messages: a list of (request_id, serialized message, signature file)
+    :return: the requests which failed
+    """
+    cache = SignatureCache(signature_cache, env) if signature_cache else None
+    if cache:
+        missing = []
+        for request_id, to_send, out_file in messages:
+            if not cache.get(json.loads(to_send), out_file):
+                missing.append((request_id, to_send, out_file))
+        messages = missing
+        if not messages:
+            return []
+    if daemon:
+        failed = request_signatures_from_daemon(daemon, messages, timeout)
+    else:
+        failed = request_signatures_from_bus(env, client_cert, client_key, ca_certs, messages, timeout)
+    if cache:
+        failed_ids = set(request.request_id for request in failed)
+        for request_id, to_send, out_file in messages:
+            if request_id not in failed_ids:
+                cache.put(json.loads(to_send), out_file)
+    return failed
+
+
+def request_signatures_from_bus(env, client_cert, client_key, ca_certs, messages, timeout=None):
+    """Send the serialized `messages` over one producer connection, and
+wait for their signatures on one consumer
+
+    :param messages: a list of (request_id, serialized message, signature file)
+    :return: the requests which failed
+    """
+    dispatcher = SigningDispatcher()
+    for request_id, _, out_file in messages:
+        dispatcher.add(request_id, out_file, timeout)
+    brokers = Brokers(env, client_cert, client_key, ca_certs)
+    consumer = get_bus_consumer(env, client_cert, client_key, ca_certs, brokers.probe())
+    dispatcher.start(consumer, env)
+    broker = send_with_failover(brokers, env, client_cert, client_key, ca_certs,
+                                [({}, to_send) for _, to_send, _ in messages])
+    dispatcher.sent([request_id for request_id, _, _ in messages], broker)
+    print("Submitted {} request(s) for signing to {}".format(len(messages), broker))
+    print("Waiting for consumer to receive data back from requests")
+    failed = dispatcher.wait()
+    for request in failed:
+        print("{} (sent to {}): {}".format(request.request_id, request.broker, request.error))
+    return failed
+
+
+class SigningService(object):
+    """Request signatures for local callers over long-lived bus connections.
+
+One consumer stays attached to the replies of robosignatory, reconnecting
+to the other broker when it drops, and with a backoff once both failed, and
+a persistent dispatcher hands each reply to the caller waiting for it. Requests are queued for a sender thread, which
+sends whatever accumulated in one batch, so a request only waits for the
+robosignatory round trip instead of an interpreter start and two TLS
+handshakes.
+    """
+
+    def __init__(self, env, client_cert, client_key, ca_certs, timeout=None):
+        self.env = env
+        self.credentials = (client_cert, client_key, ca_certs)
+        self.timeout = timeout
+        self.brokers = Brokers(env, client_cert, client_key, ca_certs)
+        self.consumer_broker = None
+        self.dispatcher = SigningDispatcher(persistent=True)
+        self.outbox = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.consuming = False
+        self.reconnects = 0
+        self.last_error = None
+        self.signed = 0
+        self.failed = 0
+        self.last_latency = None
+
+    def start(self):
+        self.brokers.probe()
+        for target in (self._consume, self._send):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _consume(self, max_backoff=60):
+        backoff = 1
+        failures = 0
+        while True:
+            broker = self.brokers.ordered()[0]
+            consumer = get_bus_consumer(self.env, *(self.credentials + ([broker],)))
+            connected = time.time()
+            with self.lock:
+                self.consuming = True
+                self.consumer_broker = broker
+            try:
+                consumer.consume(ART_CONSUMER.format(env=self.env), self.dispatcher.callback, auto_accept=False)
+                error = "consumer stopped"
+            except Exception as e:
+                error = str(e)
+            with self.lock:
+                self.consuming = False
+                self.reconnects += 1
+                self.last_error = error
+            self.brokers.demote(broker)
+            if time.time() - connected > max_backoff:
+                backoff = 1
+                failures = 0
+            failures += 1
+            if failures < len(self.brokers.urls):
+                print("Consumer disconnected from {} ({}), reconnecting to {}".format(
+                    broker, error, self.brokers.ordered()[0]))
+                continue
+            print("Consumer disconnected from {} ({}), reconnecting in {}s".format(broker, error, backoff))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            failures = 0
+            self.brokers.probe()
+
+    def _send(self):
+        while True:
+            batch = [self.outbox.get()]
+            try:
+                while True:
+                    batch.append(self.outbox.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                broker = send_with_failover(self.brokers, self.env, *(self.credentials +
+                                                                      ([({}, to_send) for _, to_send in batch],)))
+            except IOError as e:
+                with self.lock:
+                    self.last_error = str(e)
+                for request_id, _ in batch:
+                    self.dispatcher.fail(request_id, e)
+            else:
+                self.dispatcher.sent([request_id for request_id, _ in batch], broker)
+                print("Submitted {} request(s) for signing to {}".format(len(batch), broker))
+
+    def sign(self, message, timeout=None):
+        """Send `message` to robosignatory and block until its reply
+
+        :return: the completed request, with its signature or error
+        :raise ValueError: if a request with the same id is pending
+        """
+        start = time.time()
+        request_id = message["request_id"]
+        self.dispatcher.add(request_id, None, timeout or self.timeout)
+        self.outbox.put((request_id, json.dumps(message)))
+        request = self.dispatcher.wait_for(request_id)
+        with self.lock:
+            if request.error:
+                self.failed += 1
+            else:
+                self.signed += 1
+            self.last_latency = round(time.time() - start, 3)
+        return request
+
+    def status(self):
+        with self.lock, self.dispatcher.condition:
+            return {
+                "consuming": self.consuming,
+                "reconnects": self.reconnects,
+                "last_error": self.last_error,
+                # waiting to be sent, and sent but waiting for their reply
+                "queue_depth": self.outbox.qsize(),
+                "pending": len(self.dispatcher.pending),
+                "signed": self.signed,
+                "failed": self.failed,
+                "stale": self.dispatcher.stale,
+                "foreign": self.dispatcher.foreign,
+                "last_latency": self.last_latency,
+                "uptime": round(time.time() - self.started),
+                "consumer_broker": self.consumer_broker,
+                "brokers": self.brokers.status(),
+            }
+
+
+class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def signing_server(service, socket_path):
+    """Serve `GET /health` and `POST /sign` for `service` on the Unix socket
+`socket_path`. Callers get anything signed with the release keys, so there
+is no TCP listener: only the user running the service can connect.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_error(404)
+            status = service.status()
+            self.reply(200 if status["consuming"] else 503, status)
+
+        def do_POST(self):
+            if self.path != '/sign':
+                return self.send_error(404)
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                message = body["message"]
+                validated = presend_validation(message)
+                if validated is not True:
+                    raise ValueError("Message missing required field: {}".format(validated))
+                if message["sig_keyname"] not in SIG_KEYNAMES:
+                    raise ValueError("Unknown key: {}".format(message["sig_keyname"]))
+            except (KeyError, TypeError, ValueError) as e:
+                return self.reply(400, {"error": str(e)})
+            try:
+                request = service.sign(message, body.get("timeout"))
+            except ValueError as e:
+                return self.reply(409, {"error": str(e)})
+            if request.error:
+                return self.reply(502, {"request_id": request.request_id, "broker": request.broker,
+                                        "error": str(request.error)})
+            self.reply(200, {"request_id": request.request_id, "broker": request.broker,
+                             "signature": request.signature})
+
+        def log_message(self, format, *args):
+            # Unix socket peers have no address
+            sys.stderr.write("{} - - [{}] {}\n".format(
+                self.client_address[0] if self.client_address else "local",
+                self.log_date_time_string(), format % args))
+
+        def reply(self, code, body):
+            content = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    if os.path.exists(socket_path):
+        # left behind by a service which did not exit cleanly
+        os.unlink(socket_path)
+    # only the user running the service may request signatures through it
+    umask = os.umask(0o077)
+    try:
+        return ThreadingUnixServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path):
+        HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def daemon_request(address, method, path, body=None):
+    """Call the signing service listening on the Unix socket `address`
+
+    :return: the status and decoded JSON body of the response
+    """
+    conn = UnixHTTPConnection(address)
+    try:
+        conn.request(method, path, body and json.dumps(body), {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read().decode())
+    finally:
+        conn.close()
+
+
+def request_signatures_from_daemon(address, messages, timeout=None):
+    """Have the signing service at `address` request the signatures of the
+serialized `messages`, all at once, and write them locally
+
+    :param messages: a list of (request_id, serialized message, signature file)
+    :return: the requests which failed
+    """
+    def submit(request, to_send):
+        try:
+            status, reply = daemon_request(address, "POST", "/sign",
+                                           {"message": json.loads(to_send), "timeout": timeout})
+            request.broker = reply.get("broker")
+            if status != 200:
+                raise IOError(reply.get("error"))
+            write_signature(reply["signature"], request.out_file)
+            print("Got {} sent to {}".format(request.request_id, request.broker))
+        except (HTTPException, IOError, OSError, ValueError) as e:
+            request.error = e
+
+    signing = [SigningRequest(request_id, out_file) for request_id, _, out_file in messages]
+    threads = [threading.Thread(target=submit, args=(request, to_send))
+               for request, (_, to_send, _) in zip(signing, messages)]
+    for t in threads:
+        t.start()
+    print("Submitted {} request(s) to the signing service at {}".format(len(messages), address))
+    for t in threads:
+        t.join()
+    failed = [request for request in signing if request.error]
+    for request in failed:
+        print("{}: {}".format(request.request_id, request.error))
+    return failed
+
+
+######################################################################
+@cli.command("message-digest", short_help="Sign a sha256sum.txt file")
+@requestor
+@product
+@request_id
+@sig_keyname
+@release_name_opt
+@client_cert
+@client_key
+@client_type
+@env_click_obj
+@noop
+@ca_certs
+@arch_opt
+@timeout_opt
+@daemon_opt
+@signature_cache_opt
+@digest_cache_opt
+@click.pass_context
+def message_digest(ctx, requestor, product, request_id, sig_keyname,
+                   release_name, client_cert, client_key, client_type, env, noop,
+                   ca_certs, arch, timeout, daemon, signature_cache, digest_cache):
+    """Sign a 'message digest'. These are sha256sum.txt files produced by
+the 'sha256sum` command (hence the strange command name). In the ART
+world, this is for signing message digests from extracting OpenShift
+tools, as well as RHCOS bare-betal message digests.
+"""
+    message = build_message_digest_message(requestor, product, request_id, sig_keyname, release_name, client_type, arch,
+                                           DigestResolver(digest_cache))
+    to_send = serialize_message(message)
+
     if noop:
         print("Message we would have sent over the bus:")
         print(to_send)
     else:
-        producer, consumer = get_producer_consumer(env, client_cert, client_key, ca_certs)
-        consumer_thread = consumer_start(consumer, request_id)
-        producer_send_msg(producer, {}, to_send)
-        print("Message we sent over the bus:")
+        print("Message we are sending over the bus:")
         print(to_send)
-        print("Submitted request for signing. The mirror-artifacts job should be triggered when a response is sent back")
-        print("Waiting for consumer to receive data back from request")
-        consumer_thread.join()
+        if request_signatures(env, client_cert, client_key, ca_certs,
+                              [(request_id, to_send, message["artifact_meta"]["name"])], timeout, daemon,
+                              signature_cache):
+            exit(1)
+
+
+######################################################################
+@cli.command("json-digest", short_help="Sign a JSON digest claim")
+@requestor
+@product
+@request_id
+@sig_keyname
+@release_name_opt
+@client_cert
+@client_key
+@client_type
+@env_click_obj
+@noop
+@ca_certs
+@digest
+@arch_opt
+@timeout_opt
+@daemon_opt
+@signature_cache_opt
+@digest_cache_opt
+@click.option("--fan-out", is_flag=True, default=False,
+              help="With --arch multi, also sign the manifest of every arch in the manifest list")
+@click.pass_context
+def json_digest(ctx, requestor, product, request_id, sig_keyname,
+                release_name, client_cert, client_key, client_type, env, noop,
+                ca_certs, digest, arch, timeout, daemon, signature_cache,
+                digest_cache, fan_out):
+    """Sign a 'json digest'. These are JSON blobs that associate a
+pullspec with a sha256 digest. In the ART world, this is for "signing
+payload images". After the json digest is signed we publish the
+signature in a location which follows a specific directory pattern,
+thus allowing the signature to be looked up programmatically.
+
+With --fan-out, the claims for a multi-arch release image and for the
+manifest of each of its arches are all signed at once.
+    """
+    resolver = DigestResolver(digest_cache)
+    if fan_out:
+        if arch != "multi":
+            raise click.UsageError("--fan-out only applies to --arch multi")
+        messages = build_manifest_list_messages(requestor, product, request_id, sig_keyname, release_name,
+                                                client_type, digest, resolver)
+    else:
+        messages = [build_json_digest_message(requestor, product, request_id, sig_keyname, release_name, client_type,
+                                              arch, digest, resolver)]
+    to_send = [(message["request_id"], serialize_message(message), message["artifact_meta"]["name"])
+               for message in messages]
+
+    if noop:
+        print("Message(s) we would have sent over the bus:")
+        for _, serialized, _ in to_send:
+            print(serialized)
+    else:
+        print("Message(s) we are sending over the bus:")
+        for _, serialized, _ in to_send:
+            print(serialized)
+        if request_signatures(env, client_cert, client_key, ca_certs, to_send, timeout, daemon, signature_cache):
+            exit(1)
+
+######################################################################
+@cli.command("batch", short_help="Sign many artifacts over one bus connection")
+@requestor
+@sig_keyname
+@client_cert
+@client_key
+@env_click_obj
+@noop
+@ca_certs
+@click.option("--manifest", required=True, metavar="PATH", type=click.Path(exists=True),
+              help="JSON list of the signing requests to send")
+@timeout_opt
+@daemon_opt
+@signature_cache_opt
+@digest_cache_opt
+@click.pass_context
+def batch(ctx, requestor, sig_keyname, client_cert, client_key, env, noop, ca_certs, manifest, timeout, daemon,
+          signature_cache, digest_cache):
+    """Sign all the artifacts listed in a manifest at once. Every request is
+sent over a single producer connection and every reply is received by a
+single consumer, so this takes as long as the slowest signature instead of
+their sum. The manifest is a JSON list of objects like:
+
+
+    {"type": "message-digest", "product": "rhcos", "arch": "x86_64",
+     "release_name": "4.15.3", "request_id": "rhcos-message-digest-...",
+     "output": "rhcos/sha256sum.txt.gpg"}
+    {"type": "json-digest", "product": "openshift", "arch": "x86_64",
+     "release_name": "4.15.3", "client_type": "ocp", "digest": "sha256:...",
+     "request_id": "openshift-json-digest-..."}
+
+"fan_out": true on a multi json-digest also signs the manifest of each
+arch in its manifest list. "client_type" defaults to ocp, "digest" is
+looked up if missing, "requestor" and "sig_keyname" default to the
+options, and "output" to the name robosignatory gives the signature. The
+sha256sum.txt files and digests to look up are fetched concurrently.
+    """
+    with open(manifest) as f:
+        entries = json.load(f)
+
+    # look up everything to sign at once
+    resolver = DigestResolver(digest_cache)
+    urls = [message_digest_url(entry["product"], entry["release_name"], entry.get("client_type", "ocp"), entry["arch"])
+            for entry in entries if entry["type"] == "message-digest"]
+    pullspecs = [release_pullspec(entry["release_name"], entry.get("client_type", "ocp"), entry["arch"])
+                 for entry in entries
+                 if entry["type"] == "json-digest" and not entry.get("digest") and not entry.get("fan_out")]
+    resolver.prefetch(urls, pullspecs)
+
+    messages = []
+    request_ids = set()
+    outputs = set()
+    for entry in entries:
+        args = (entry.get("requestor", requestor), entry["product"], entry["request_id"],
+                entry.get("sig_keyname", sig_keyname), entry["release_name"], entry.get("client_type", "ocp"),
+                entry["arch"])
+        if args[3] not in SIG_KEYNAMES:
+            print("Unknown sig_keyname {}: {}".format(args[3], entry["request_id"]))
+            exit(1)
+        if entry["type"] == "message-digest":
+            built = [build_message_digest_message(*args, resolver=resolver)]
+        elif entry["type"] == "json-digest" and entry.get("fan_out"):
+            if entry["arch"] != "multi":
+                print("fan_out only applies to multi, not {}: {}".format(entry["arch"], entry["request_id"]))
+                exit(1)
+            built = build_manifest_list_messages(*(args[:-1] + (entry.get("digest"),)), resolver=resolver)
+        elif entry["type"] == "json-digest":
+            built = [build_json_digest_message(*(args + (entry.get("digest"),)), resolver=resolver)]
+        else:
+            print("Unknown signing request type: {}".format(entry["type"]))
+            exit(1)
+        for i, message in enumerate(built):
+            # "output" is for the artifact of the entry, not the manifests fanned out from it
+            out_file = entry.get("output", message["artifact_meta"]["name"]) if i == 0 else \
+                message["artifact_meta"]["name"]
+            if message["request_id"] in request_ids or out_file in outputs:
+                print("Duplicate request_id or output in manifest: {} {}".format(message["request_id"], out_file))
+                exit(1)
+            request_ids.add(message["request_id"])
+            outputs.add(out_file)
+            messages.append((message["request_id"], serialize_message(message), out_file))
+
+    if noop:
+        print("Messages we would have sent over the bus:")
+        for _, to_send, _ in messages:
+            print(to_send)
+        return
+
+    failed = request_signatures(env, client_cert, client_key, ca_certs, messages, timeout, daemon, signature_cache)
+    if failed:
+        print("ERROR: failed to get signatures for {}".format(", ".join(r.request_id for r in failed)))
+        exit(1)
+
+######################################################################
+@cli.command("serve", short_help="Run a signing service keeping its bus connections open")
+@client_cert
+@client_key
+@env_click_obj
+@ca_certs
+@click.option("--socket", "socket_path", required=True, metavar="PATH", type=click.Path(),
+              help="Accept requests over HTTP on this Unix socket")
+@click.option("--timeout", type=int, default=3600, metavar="SECONDS", show_default=True,
+              help="Fail the requests not giving a timeout if their signature did not come back after this long")
+@click.pass_context
+def serve(ctx, client_cert, client_key, env, ca_certs, socket_path, timeout):
+    """Keep a consumer of the replies of robosignatory connected and request
+signatures on behalf of local callers, so that each of them only waits for
+the robosignatory round trip. Requests are sent with --daemon by the other
+commands, or as JSON:
+
+\b
+    POST /sign {"message": {...}, "timeout": SECONDS}
+        200 {"request_id": ..., "signature": BASE64}
+        502 or 409 {"error": ...}
+    GET /health
+        200 while consuming, 503 while reconnecting, with the queue depth,
+        reconnects and counts of signed and failed requests
+    """
+    service = SigningService(env, client_cert, client_key, ca_certs, timeout)
+    service.start()
+    server = signing_server(service, socket_path)
+    print("Listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
 
 ######################################################################
 
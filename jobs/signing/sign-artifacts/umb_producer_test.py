@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+import base64
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest import TestCase, main
+
+from mock import MagicMock, patch
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import rhmsg.activemq.producer  # noqa: F401
+    import rhmsg.activemq.consumer  # noqa: F401
+except ImportError:
+    # umb_producer imports these at load time, nothing here connects to the bus
+    for name in ("rhmsg", "rhmsg.activemq", "rhmsg.activemq.producer", "rhmsg.activemq.consumer"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["rhmsg.activemq.producer"].AMQProducer = None
+    sys.modules["rhmsg.activemq.consumer"].AMQConsumer = None
+
+from umb_producer import (DigestResolver, SigningDispatcher, SigningRequest, build_manifest_list_messages,
+                          daemon_request, get_release_tag, signing_server)
+
+
+def sign_message(sig_keyname="test"):
+    return {
+        "artifact": "YXJ0aWZhY3Q=",
+        "artifact_meta": {"product": "openshift", "release_name": "4.15.3", "name": "sha256=abc",
+                          "type": "json-digest"},
+        "request_id": "request-1",
+        "requestor": "tester",
+        "sig_keyname": sig_keyname,
+    }
+
+
+class TestSigningServer(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp, "signing.sock")
+        self.service = MagicMock()
+        request = SigningRequest("request-1", None)
+        request.signature = "c2lnbmF0dXJl"
+        request.broker = "amqps://broker-1"
+        self.service.sign.return_value = request
+        self.server = signing_server(self.service, self.socket_path)
+        t = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_socket_private(self):
+        """ only the user running the service can connect """
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode) & 0o077, 0)
+
+    def test_sign(self):
+        status, reply = daemon_request(self.socket_path, "POST", "/sign", {"message": sign_message(), "timeout": 5})
+        self.assertEqual(status, 200)
+        self.assertEqual(reply, {"request_id": "request-1", "broker": "amqps://broker-1",
+                                 "signature": "c2lnbmF0dXJl"})
+        self.service.sign.assert_called_once_with(sign_message(), 5)
+
+    def test_sign_unknown_key(self):
+        """ only the keys the command line allows can be asked for """
+        status, reply = daemon_request(self.socket_path, "POST", "/sign", {"message": sign_message("other")})
+        self.assertEqual(status, 400)
+        self.assertEqual(reply, {"error": "Unknown key: other"})
+        self.assertFalse(self.service.sign.called)
+
+    def test_sign_invalid(self):
+        message = sign_message()
+        del message["requestor"]
+        status, reply = daemon_request(self.socket_path, "POST", "/sign", {"message": message})
+        self.assertEqual(status, 400)
+        self.assertEqual(reply, {"error": "Message missing required field: requestor"})
+
+    def test_health(self):
+        self.service.status.return_value = {"consuming": False}
+        self.assertEqual(daemon_request(self.socket_path, "GET", "/health"), (503, {"consuming": False}))
+
+
+def reply(request_id, timestamp, status="success", signature=None):
+    """ A message robosignatory sends back """
+    return {
+        "timestamp": timestamp,
+        "msg": {
+            "request_id": request_id,
+            "signing_status": status,
+            "signed_artifact": signature or base64.b64encode(request_id.encode()).decode(),
+        },
+    }
+
+
+class FakeMessage(object):
+    def __init__(self, body):
+        self.body = json.dumps(body)
+
+
+class FakeConsumer(object):
+    """ Feeds the bodies it is given to the callback, like AMQConsumer.consume until the callback returns a result """
+
+    def __init__(self, bodies, error=None):
+        self.bodies = bodies
+        self.error = error
+        self.released = 0
+
+    def consume(self, address, callback, data=None, selector=None, auto_accept=True, subscription_name=None):
+        for body in self.bodies:
+            result, accept = callback(FakeMessage(body), data)
+            if not accept:
+                self.released += 1
+            if result is not None:
+                return result
+        if self.error:
+            raise self.error
+
+
+class TestSigningDispatcher(TestCase):
+    def setUp(self):
+        self.now = 100000.0
+        self.dispatcher = SigningDispatcher(stale_after=3600, clock=lambda: self.now)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def out_file(self, request_id):
+        return os.path.join(self.tmp, request_id)
+
+    def read(self, request_id):
+        with open(self.out_file(request_id), "rb") as f:
+            return f.read()
+
+    def test_dispatch(self):
+        """ replies are written where their request wants them """
+        self.dispatcher.add("a", self.out_file("a"))
+        self.dispatcher.add("b", self.out_file("b"))
+        self.assertTrue(self.dispatcher.dispatch(reply("b", self.now)))
+        self.assertFalse(self.dispatcher.done())
+        self.assertTrue(self.dispatcher.dispatch(reply("a", self.now)))
+        self.assertTrue(self.dispatcher.done())
+        self.assertEqual(self.dispatcher.wait(), [])
+        self.assertEqual((self.read("a"), self.read("b")), (b"a", b"b"))
+
+    def test_dispatch_failed(self):
+        self.dispatcher.add("a", self.out_file("a"))
+        self.dispatcher.dispatch(reply("a", self.now, status="failure"))
+        failed = self.dispatcher.wait()
+        self.assertEqual([request.request_id for request in failed], ["a"])
+        self.assertIn("robosignatory failed", str(failed[0].error))
+        self.assertFalse(os.path.exists(self.out_file("a")))
+
+    def test_dispatch_stale_and_foreign(self):
+        """ old replies to other requests are popped, recent ones are released for their consumer """
+        self.dispatcher.add("a", self.out_file("a"))
+        self.assertTrue(self.dispatcher.dispatch(reply("old", self.now - 3600)))
+        self.assertFalse(self.dispatcher.dispatch(reply("other", self.now - 3599)))
+        self.assertFalse(self.dispatcher.dispatch(reply("other", self.now)))
+        self.assertEqual((self.dispatcher.stale, self.dispatcher.foreign), (1, 2))
+        self.assertEqual(self.dispatcher.foreign_ids, set(["other"]))
+        self.assertFalse(self.dispatcher.done())
+
+    def test_dispatch_duplicate(self):
+        """ redelivered replies are popped, and do not overwrite the signature """
+        self.dispatcher.add("a", self.out_file("a"))
+        self.dispatcher.dispatch(reply("a", self.now))
+        self.assertTrue(self.dispatcher.dispatch(reply("a", self.now, signature="b3RoZXI=")))
+        self.assertEqual(self.read("a"), b"a")
+        self.assertEqual((self.dispatcher.stale, self.dispatcher.foreign), (0, 0))
+
+    def test_add_pending(self):
+        self.dispatcher.add("a", self.out_file("a"))
+        self.assertRaises(ValueError, self.dispatcher.add, "a", self.out_file("a"))
+
+    def test_expire(self):
+        """ requests fail once past their deadline, and their late replies are popped """
+        self.dispatcher.add("a", self.out_file("a"), timeout=10)
+        self.dispatcher.add("b", self.out_file("b"), timeout=20)
+        self.now += 10
+        self.dispatcher.expire()
+        self.assertEqual(list(self.dispatcher.pending), ["b"])
+        self.assertTrue(self.dispatcher.dispatch(reply("a", self.now)))
+        self.assertFalse(os.path.exists(self.out_file("a")))
+        self.now += 10
+        failed = self.dispatcher.wait()
+        self.assertEqual(sorted(request.request_id for request in failed), ["a", "b"])
+        self.assertIn("Timed out", str(failed[0].error))
+
+    def test_wait_for(self):
+        """ a persistent dispatcher hands each request back to its caller, and forgets it """
+        dispatcher = SigningDispatcher(clock=lambda: self.now, persistent=True)
+        dispatcher.add("a", None)
+        t = threading.Timer(0.05, dispatcher.dispatch, args=(reply("a", self.now),))
+        t.start()
+        request = dispatcher.wait_for("a")
+        t.join()
+        self.assertEqual((request.request_id, request.error, request.signature), ("a", None, "YQ=="))
+        self.assertEqual(dispatcher.finished, {})
+        # its redelivery is still ours
+        self.assertTrue(dispatcher.dispatch(reply("a", self.now)))
+        self.assertEqual(dispatcher.foreign, 0)
+
+    def test_callback(self):
+        """ the consumer stops once no request is pending, unless the dispatcher is persistent """
+        self.dispatcher.add("a", self.out_file("a"))
+        self.assertEqual(self.dispatcher.callback(FakeMessage(reply("other", self.now))), (None, False))
+        self.assertEqual(self.dispatcher.callback(FakeMessage(reply("a", self.now))), (True, True))
+        dispatcher = SigningDispatcher(clock=lambda: self.now, persistent=True)
+        dispatcher.add("a", None)
+        self.assertEqual(dispatcher.callback(FakeMessage(reply("a", self.now))), (None, True))
+
+    def test_consume_busy_queue(self):
+        """ thousands of replies, most of them stale, foreign or duplicates, interleaved with ours """
+        count = 1000
+        bodies = []
+        for i in range(count):
+            request_id = "request-{}".format(i)
+            self.dispatcher.add(request_id, None, timeout=60)
+            bodies.append(reply("old-{}".format(i), self.now - 7200))
+            bodies.append(reply("other-{}".format(i % 10), self.now))
+            bodies.append(reply(request_id, self.now))
+            bodies.append(reply(request_id, self.now))
+            bodies.append(reply("old-{}".format(i), self.now - 7200))
+        consumer = FakeConsumer(bodies)
+        self.dispatcher.start(consumer, "stage").join(10)
+        self.assertEqual(self.dispatcher.wait(), [])
+        self.assertEqual(len(self.dispatcher.finished), count)
+        self.assertEqual(self.dispatcher.finished["request-7"].signature, "cmVxdWVzdC03")
+        self.assertEqual((self.dispatcher.stale, self.dispatcher.foreign), (2 * count - 1, count))
+        self.assertEqual(consumer.released, count)
+        self.assertEqual(len(self.dispatcher.foreign_ids), 10)
+
+    def test_consume_stopped(self):
+        """ the requests pending when the consumer stops fail, instead of being waited for forever """
+        for error in (None, IOError("connection reset")):
+            dispatcher = SigningDispatcher(clock=lambda: self.now)
+            dispatcher.add("a", None)
+            dispatcher.add("b", None)
+            start = time.time()
+            dispatcher.start(FakeConsumer([reply("a", self.now)], error), "stage")
+            failed = dispatcher.wait()
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual([request.request_id for request in failed], ["b"])
+            self.assertIn("connection reset" if error else "stopped", str(failed[0].error))
+
+
+class FakeRegistry(object):
+    """ A registry serving `manifests` ({(repository, reference): (content type, body)}) to the bearer token its
+    token endpoint hands out. The token does not give access to the `private` repositories. """
+
+    TOKEN = "t0k3n"
+
+    def __init__(self):
+        self.manifests = {}
+        self.private = set()
+        self.digest_header = True
+        self.requests = []
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.manifest(head=True)
+
+            def do_GET(self):
+                if self.path.startswith("/token?"):
+                    registry.requests.append(("GET", self.path.split("?")[0], None))
+                    return self.reply(200, "application/json", json.dumps({"token": registry.TOKEN}).encode())
+                self.manifest(head=False)
+
+            def manifest(self, head):
+                repository, reference = self.path[len("/v2/"):].rsplit("/manifests/", 1)
+                authorization = self.headers.get("Authorization")
+                registry.requests.append((self.command, self.path, authorization))
+                if authorization != "Bearer " + registry.TOKEN or repository in registry.private:
+                    self.send_response(401)
+                    self.send_header("WWW-Authenticate", 'Bearer realm="{}/token",service="quay.io"'.format(
+                        registry.url))
+                    self.send_header("Content-Length", "0")
+                    return self.end_headers()
+                if (repository, reference) not in registry.manifests:
+                    return self.reply(404, "application/json", b"{}")
+                content_type, body = registry.manifests[(repository, reference)]
+                self.reply(200, content_type, body, head)
+
+            def reply(self, code, content_type, body, head=False):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if code == 200 and registry.digest_header and content_type != "application/json":
+                    self.send_header("Docker-Content-Digest", "sha256:" + hashlib.sha256(body).hexdigest())
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        t = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, repository, reference, manifest, content_type):
+        body = json.dumps(manifest).encode()
+        digest = "sha256:" + hashlib.sha256(body).hexdigest()
+        self.manifests[(repository, reference)] = (content_type, body)
+        self.manifests[(repository, digest)] = (content_type, body)
+        return digest
+
+    def add_manifest_list(self, repository, reference, arches):
+        children = [self.add(repository, "{}-{}".format(reference, arch), {"arch": arch},
+                             "application/vnd.docker.distribution.manifest.v2+json") for arch in arches]
+        manifests = [{"digest": child, "platform": {"architecture": arch, "os": "linux"}}
+                     for child, arch in zip(children, arches)]
+        # an attestation
+        manifests.append({"digest": "sha256:" + "0" * 64, "platform": {"architecture": "unknown", "os": "unknown"}})
+        digest = self.add(repository, reference, {"manifests": manifests},
+                          "application/vnd.oci.image.index.v1+json")
+        return digest, children
+
+
+class TestManifestList(TestCase):
+    def setUp(self):
+        self.registry = FakeRegistry()
+        self.resolver = DigestResolver(registry_urls={"quay.io": self.registry.url})
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_manifest_list(self):
+        """ the manifests of every arch are listed, not attestations """
+        digest, children = self.registry.add_manifest_list("openshift-release-dev/ocp-release", "4.15.3-multi",
+                                                           ["amd64", "arm64"])
+        self.assertEqual(self.resolver.manifest_list("quay.io/openshift-release-dev/ocp-release:4.15.3-multi"),
+                         (digest, children))
+        self.assertEqual(self.resolver.manifest_list("quay.io/openshift-release-dev/ocp-release@" + digest),
+                         (digest, children))
+
+    @patch("umb_producer.subprocess.check_output")
+    def test_manifest_list_private(self, oc_mock):
+        """ oc, logged in to the registry by the job, is used for repositories needing credentials """
+        self.registry.private.add("openshift-release-dev/ocp-release-nightly")
+        oc_mock.return_value = json.dumps([
+            {"listDigest": "sha256:list", "digest": "sha256:amd64", "config": {"architecture": "amd64"}},
+            {"listDigest": "sha256:list", "digest": "sha256:arm64", "config": {"architecture": "arm64"}},
+        ]).encode()
+        pullspec = "quay.io/openshift-release-dev/ocp-release-nightly@sha256:list"
+        self.assertEqual(self.resolver.manifest_list(pullspec), ("sha256:list", ["sha256:amd64", "sha256:arm64"]))
+        oc_mock.assert_called_once_with(["oc", "image", "info", "--show-multiarch", "-o", "json", pullspec])
+
+    @patch("umb_producer.subprocess.check_output")
+    def test_manifest_list_manifest(self, oc_mock):
+        self.registry.private.add("openshift-release-dev/ocp-release")
+        oc_mock.return_value = json.dumps({"digest": "sha256:amd64", "config": {"architecture": "amd64"}}).encode()
+        self.assertEqual(self.resolver.manifest_list("quay.io/openshift-release-dev/ocp-release@sha256:amd64"),
+                         ("sha256:amd64", []))
+
+    def test_build_manifest_list_messages(self):
+        """ dev-preview releases are looked up in the nightly repo only when they are nightlies """
+        for repository, release_name in [("ocp-release-nightly", "4.16.0-0.nightly-multi-2024-03-01-000000"),
+                                         ("ocp-release", "4.16.0-ec.3")]:
+            digest, children = self.registry.add_manifest_list("openshift-release-dev/" + repository,
+                                                               get_release_tag(release_name, "multi"),
+                                                               ["amd64", "s390x"])
+            messages = build_manifest_list_messages("tester", "openshift", "request", "test", release_name,
+                                                    "ocp-dev-preview", None, self.resolver)
+            self.assertEqual([message["request_id"] for message in messages],
+                             ["request"] + ["request-" + child.split(":")[1][:12] for child in children])
+            self.assertEqual([message["artifact_meta"]["name"] for message in messages],
+                             [d.replace(":", "=") for d in [digest] + children])
+
+    @patch("umb_producer.subprocess.check_output")
+    def test_build_manifest_list_messages_error(self, oc_mock):
+        self.registry.private.add("openshift-release-dev/ocp-release")
+        oc_mock.side_effect = subprocess.CalledProcessError(1, ["oc"])
+        with self.assertRaises(SystemExit):
+            build_manifest_list_messages("tester", "openshift", "request", "test", "4.15.3", "ocp", "sha256:abc",
+                                         self.resolver)
+
+
+class TestDigestResolver(TestCase):
+    PULLSPEC = "quay.io/openshift-release-dev/ocp-release:4.15.3-x86_64"
+
+    def setUp(self):
+        self.registry = FakeRegistry()
+        self.digest = self.registry.add("openshift-release-dev/ocp-release", "4.15.3-x86_64", {"arch": "amd64"},
+                                        "application/vnd.docker.distribution.manifest.v2+json")
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.tmp)
+
+    def resolver(self, **kwargs):
+        return DigestResolver(registry_urls={"quay.io": self.registry.url}, **kwargs)
+
+    def test_image_digest(self):
+        """ the digest comes from a HEAD, with a pull token once the registry asks for one """
+        resolver = self.resolver()
+        self.assertEqual(resolver.image_digest(self.PULLSPEC), self.digest)
+        path = "/v2/openshift-release-dev/ocp-release/manifests/4.15.3-x86_64"
+        self.assertEqual(self.registry.requests, [
+            ("HEAD", path, None),
+            ("GET", "/token", None),
+            ("HEAD", path, "Bearer " + FakeRegistry.TOKEN),
+        ])
+        # looked up once
+        self.assertEqual(resolver.image_digest(self.PULLSPEC), self.digest)
+        self.assertEqual(len(self.registry.requests), 3)
+        # the token is reused for the repository
+        self.registry.add("openshift-release-dev/ocp-release", "4.15.3-s390x", {"arch": "s390x"},
+                          "application/vnd.docker.distribution.manifest.v2+json")
+        resolver.image_digest("quay.io/openshift-release-dev/ocp-release:4.15.3-s390x")
+        self.assertEqual(self.registry.requests[3:], [
+            ("HEAD", "/v2/openshift-release-dev/ocp-release/manifests/4.15.3-s390x", "Bearer " + FakeRegistry.TOKEN),
+        ])
+
+    def test_image_digest_by_digest(self):
+        self.assertEqual(self.resolver().image_digest("quay.io/openshift-release-dev/ocp-release@sha256:abc"),
+                         "sha256:abc")
+        self.assertEqual(self.registry.requests, [])
+
+    def test_image_digest_without_header(self):
+        """ the digest is the hash of the manifest when the registry does not send it """
+        self.registry.digest_header = False
+        self.assertEqual(self.resolver().image_digest(self.PULLSPEC), self.digest)
+        self.assertEqual([(method, auth) for method, _, auth in self.registry.requests[-2:]],
+                         [("HEAD", "Bearer " + FakeRegistry.TOKEN), ("GET", "Bearer " + FakeRegistry.TOKEN)])
+
+    @patch("umb_producer.subprocess.check_output")
+    def test_image_digest_oc(self, oc_mock):
+        """ oc is used when the registry cannot be asked """
+        oc_mock.return_value = json.dumps({"digest": "sha256:fromoc"}).encode()
+        pullspec = "quay.io/openshift-release-dev/ocp-release:4.15.4-x86_64"
+        self.assertEqual(self.resolver().image_digest(pullspec), "sha256:fromoc")
+        oc_mock.assert_called_once_with(["oc", "image", "info", "-o", "json", pullspec])
+
+    def test_image_digest_cache(self):
+        """ digests are stored for ttl seconds """
+        self.resolver(cache_dir=self.tmp).image_digest(self.PULLSPEC)
+        requests = len(self.registry.requests)
+        self.assertEqual(self.resolver(cache_dir=self.tmp).image_digest(self.PULLSPEC), self.digest)
+        self.assertEqual(len(self.registry.requests), requests)
+        # the tag moved, and the stored digest expired
+        digest = self.registry.add("openshift-release-dev/ocp-release", "4.15.3-x86_64", {"arch": "amd64", "v": 2},
+                                   "application/vnd.docker.distribution.manifest.v2+json")
+        path = os.path.join(self.tmp, os.listdir(self.tmp)[0])
+        with open(path) as f:
+            entry = json.load(f)
+        entry["time"] -= 301
+        with open(path, "w") as f:
+            json.dump(entry, f)
+        self.assertEqual(self.resolver(cache_dir=self.tmp, ttl=300).image_digest(self.PULLSPEC), digest)
+        self.assertGreater(len(self.registry.requests), requests)
+        self.assertEqual(self.resolver(cache_dir=self.tmp).image_digest(self.PULLSPEC), digest)
+
+    def test_prefetch(self):
+        pullspecs = []
+        for arch in ("x86_64", "s390x", "ppc64le", "aarch64"):
+            self.registry.add("openshift-release-dev/ocp-release", "4.16.0-" + arch, {"arch": arch},
+                              "application/vnd.docker.distribution.manifest.v2+json")
+            pullspecs.append("quay.io/openshift-release-dev/ocp-release:4.16.0-" + arch)
+        resolver = self.resolver()
+        resolver.prefetch(pullspecs=pullspecs)
+        requests = len(self.registry.requests)
+        self.assertEqual(sorted(resolver.digests), sorted(pullspecs))
+        for pullspec in pullspecs:
+            resolver.image_digest(pullspec)
+        self.assertEqual(len(self.registry.requests), requests)
+
+
+if __name__ == '__main__':
+    main()